@@ -0,0 +1,47 @@
+"""
+Microbenchmark for rendering email bodies through the TemplateRegistry.
+
+Compares, per message, what send_email used to pay through fastapi_mail (a new Jinja Environment from
+ConnectionConfig.template_engine(), so the template is loaded and compiled again), a shared Environment
+(compiled once, but the file is still checked for changes on every lookup) and the registry
+(compiled once per locale; the confirmation email is joined from precomputed static parts, the
+reminder digest loops over contacts so it is rendered by its precompiled template). fastapi_mail's
+environments do not autoescape while the registry escapes HTML templates, which is about all that is
+left of the reminder's cost over the shared environment.
+
+    python -m benchmarks.mail_templates
+"""
+import datetime
+import timeit
+
+from src.services.email import conf, mail_templates
+
+NUMBER = 2000
+
+CONFIRMATION = ("email_template.html",
+                {"username": "bench", "host": "http://localhost:8000/", "token": "x" * 160})
+REMINDER = ("birthday_reminder.html",
+            {"username": "bench", "days": 7,
+             "contacts": [{"first_name": f"Name{i}", "last_name": "Johns",
+                           "date_of_birth": datetime.date(1990, 1, i + 1)} for i in range(5)]})
+
+
+def main():
+    mail_templates.load()
+    shared = conf.template_engine()
+
+    for name, context in (CONFIRMATION, REMINDER):
+        per_message = timeit.timeit(lambda: conf.template_engine().get_template(name).render(**context),
+                                    number=NUMBER // 10) * 10
+        shared_env = timeit.timeit(lambda: shared.get_template(name).render(**context), number=NUMBER)
+        registry = timeit.timeit(lambda: mail_templates.render(name, **context), number=NUMBER)
+        static = "static parts" if mail_templates.get(name).static_parts else "compiled template"
+
+        print(f"{name} ({static})")
+        print(f"  environment per message: {per_message / NUMBER * 1e6:9.2f} us/msg")
+        print(f"  shared environment:      {shared_env / NUMBER * 1e6:9.2f} us/msg")
+        print(f"  template registry:       {registry / NUMBER * 1e6:9.2f} us/msg ({per_message / registry:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,28 @@
-import redis.asyncio as redis
+import asyncio
+import logging
+import os
+from datetime import date
 
 from src.conf.config import settings
 from src.routes import contacts, auth, users
 from sqlalchemy.orm import Session
-from src.database.db import get_db
+from src.database.db import get_db, maybe_await, pool_status, SessionLocal
+from src.database.redis_pool import open_redis, close_redis, redis_pool_status
+from src.repository import contacts as repository_contacts
+from src.repository import users as repository_users
 from sqlalchemy import text
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_limiter import FastAPILimiter
+from fastapi.staticfiles import StaticFiles
 
+from src.services.birthday_digest import birthday_digest
+from src.services.birthday_reminders import run_birthday_reminders
+from src.services.bloom import registered_emails
+from src.services.email import run_mail_worker
+from src.services.rate_limit import RateLimitHeadersMiddleware
+from src.services.user_cache import user_cache
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -16,6 +30,10 @@ app.include_router(auth.router, prefix='/api')
 app.include_router(contacts.router, prefix='/api')
 app.include_router(users.router, prefix='/api')
 
+if settings.avatar_storage == 'local':
+    os.makedirs(settings.avatar_local_dir, exist_ok=True)
+    app.mount(settings.avatar_local_url, StaticFiles(directory=settings.avatar_local_dir), name='avatars')
+
 origins = [
     "http://localhost:3000"
     ]
@@ -27,6 +45,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RateLimitHeadersMiddleware)
 
 
 @app.on_event("startup")
@@ -38,9 +57,75 @@ It's a good place to initialize things that are used by the app, such as databas
 :return: A future, so we need to await it
 :doc-author: Trelent
 """
-    r = await redis.Redis(host=settings.redis_host, port=settings.redis_port, db=0, encoding="utf-8",
-                          decode_responses=True)
-    await FastAPILimiter.init(r)
+    await open_redis()
+    user_cache.start_listener()
+    app.state.birthday_digest_task = asyncio.create_task(birthday_digest.run_daily(rebuild_birthday_digests))
+    app.state.user_bloom_task = asyncio.create_task(rebuild_registered_emails()) \
+        if settings.user_bloom_enabled else None
+    app.state.mail_worker_task = asyncio.create_task(run_mail_worker()) \
+        if settings.mail_worker_in_process else None
+    app.state.birthday_reminders_task = asyncio.create_task(run_birthday_reminders()) \
+        if settings.birthday_reminder_in_process else None
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+The shutdown function is called when the application stops.
+It stops the background listener that drops locally cached users when another worker changes them,
+the daily birthday digest job, a running rebuild of the registered emails filter, the in-process
+birthday reminders scheduler and mail worker, then closes the shared Redis pool.
+
+:return: Nothing
+:doc-author: Trelent
+"""
+    user_cache.stop_listener()
+    app.state.birthday_digest_task.cancel()
+    if app.state.user_bloom_task is not None:
+        app.state.user_bloom_task.cancel()
+    if app.state.birthday_reminders_task is not None:
+        app.state.birthday_reminders_task.cancel()
+        await asyncio.gather(app.state.birthday_reminders_task, return_exceptions=True)
+    if app.state.mail_worker_task is not None:
+        app.state.mail_worker_task.cancel()
+        # let the worker close its SMTP connections before the Redis pool goes away
+        await asyncio.gather(app.state.mail_worker_task, return_exceptions=True)
+    await close_redis()
+
+
+async def rebuild_birthday_digests(today: date):
+    """
+The rebuild_birthday_digests function prebuilds every user's birthday digest for today in its own database session.
+It is called once a day, shortly after midnight, by the task started in startup.
+
+:param today: date: The day the digests are for
+:return: Nothing
+:doc-author: Trelent
+"""
+    db = SessionLocal()
+    try:
+        await repository_contacts.rebuild_birthday_digests(db, today)
+    finally:
+        await maybe_await(db.close())
+
+
+async def rebuild_registered_emails():
+    """
+The rebuild_registered_emails function fills the Bloom filter of registered emails from the users table.
+Only one worker rebuilds a filter that is not ready yet; until it is, lookups go to the database.
+
+:return: Nothing
+:doc-author: Trelent
+"""
+    if not await registered_emails.claim_rebuild():
+        return
+    db = SessionLocal()
+    try:
+        await registered_emails.rebuild(repository_users.stream_user_emails(db, settings.user_bloom_batch_size))
+    except Exception:
+        logger.exception("registered emails filter rebuild failed")
+    finally:
+        await maybe_await(db.close())
 
 
 @app.get("/")
@@ -49,7 +134,7 @@ async def root():
 
 
 @app.get("/api/healthchecker")
-def healthchecker(db: Session = Depends(get_db)):
+async def healthchecker(db: Session = Depends(get_db)):
     """
 The healthchecker function is a simple function that checks if the database is configured correctly.
 It does this by executing a SQL query and checking if it returns any results. If it doesn't, then we know something's wrong.
@@ -59,7 +144,7 @@ It does this by executing a SQL query and checking if it returns any results. If
 :doc-author: Trelent
 """
     try:
-        result = db.execute(text("SELECT 1")).fetchone()
+        result = (await maybe_await(db.execute(text("SELECT 1")))).fetchone()
         if result is None:
             raise HTTPException(status_code=500, detail="Database is not configured correctly")
         return {"message": "Welcome to FastAPI!"}
@@ -68,5 +153,38 @@ It does this by executing a SQL query and checking if it returns any results. If
         raise HTTPException(status_code=500, detail="Error connecting to the database")
 
 
+@app.get("/api/healthchecker/pool")
+async def pool_stats():
+    """
+The pool_stats function reports the state of the database connection pool.
+It shows checked-out, idle and overflow connections and how long requests waited for one,
+which tells whether latency spikes come from pool exhaustion.
+
+:return: A dictionary with the pool counters
+:doc-author: Trelent
+"""
+    return pool_status()
+
+
+@app.get("/api/healthchecker/user-cache")
+async def user_cache_stats():
+    """
+The user_cache_stats function reports the hit, miss and eviction counters of the current-user cache
+for this worker, for both the in-process tier and Redis.
+
+:return: A dictionary with the cache counters
+:doc-author: Trelent
+"""
+    return user_cache.stats()
 
 
+@app.get("/api/healthchecker/redis")
+async def redis_pool_stats():
+    """
+The redis_pool_stats function reports the state of the shared Redis connection pool for this worker.
+A pool that stays at max_connections with nothing idle means requests are queueing for a connection.
+
+:return: A dictionary with the pool counters
+:doc-author: Trelent
+"""
+    return redis_pool_status()
@@ -0,0 +1,31 @@
+"""Add contact birthday key
+
+Revision ID: 5c2e7a1f9b3d
+Revises: 63b5fed793b6
+Create Date: 2023-05-02 18:41:09.318520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2e7a1f9b3d'
+down_revision = '63b5fed793b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('contact', sa.Column('birthday_key', sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE contact "
+        "SET birthday_key = EXTRACT(MONTH FROM date_of_birth) * 100 + EXTRACT(DAY FROM date_of_birth) "
+        "WHERE date_of_birth IS NOT NULL"
+    )
+    op.create_index('ix_contact_user_id_birthday_key', 'contact', ['user_id', 'birthday_key'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contact_user_id_birthday_key', table_name='contact')
+    op.drop_column('contact', 'birthday_key')
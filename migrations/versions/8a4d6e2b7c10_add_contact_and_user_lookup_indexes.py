@@ -0,0 +1,53 @@
+"""Add contact and user lookup indexes
+
+Revision ID: 8a4d6e2b7c10
+Revises: 5c2e7a1f9b3d
+Create Date: 2023-05-04 11:27:53.604118
+
+Every contact query is scoped to the owner, so each index leads with user_id:
+
+    ix_contact_user_id_id              get_contacts ordered by id, keyset on id
+    ix_contact_user_id_last_name_id    get_contacts filtered or ordered by last_name
+    ix_contact_user_id_first_name_id   get_contacts filtered or ordered by first_name
+    ix_contact_user_id_email_id        get_contacts ordered by email
+    ix_users_email_lower               get_user_by_email (lower(email) = lower(:email))
+
+update_contact and remove_contact look rows up by primary key. verify_email_phone
+uses the unique email and phone constraints. tests/test_query_plans.py runs
+EXPLAIN on each repository query and fails if one of them falls back to a full scan.
+
+The indexes are built CONCURRENTLY on PostgreSQL so the tables stay writable.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6e2b7c10'
+down_revision = '5c2e7a1f9b3d'
+branch_labels = None
+depends_on = None
+
+
+CONTACT_INDEXES = {
+    'ix_contact_user_id_id': ['user_id', 'id'],
+    'ix_contact_user_id_last_name_id': ['user_id', 'last_name', 'id'],
+    'ix_contact_user_id_first_name_id': ['user_id', 'first_name', 'id'],
+    'ix_contact_user_id_email_id': ['user_id', 'email', 'id'],
+}
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, columns in CONTACT_INDEXES.items():
+            op.create_index(name, 'contact', columns, unique=False, postgresql_concurrently=True)
+        op.create_index('ix_users_email_lower', 'users', [sa.text('lower(email)')], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_email_lower', table_name='users', postgresql_concurrently=True)
+        for name in reversed(list(CONTACT_INDEXES)):
+            op.drop_index(name, table_name='contact', postgresql_concurrently=True)
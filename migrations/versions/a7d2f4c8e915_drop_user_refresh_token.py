@@ -0,0 +1,28 @@
+"""Drop user refresh token
+
+Revision ID: a7d2f4c8e915
+Revises: e3b8c5d1f706
+Create Date: 2023-05-10 09:42:17.603581
+
+Refresh tokens are tracked per rotation family in Redis (src/services/refresh_tokens.py),
+so users.refresh_token is no longer read or written. The downgrade restores an empty
+column; the tokens it held are not recoverable.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d2f4c8e915'
+down_revision = 'e3b8c5d1f706'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.drop_column('users', 'refresh_token')
+
+
+def downgrade() -> None:
+    op.add_column('users', sa.Column('refresh_token', sa.String(length=255), nullable=True))
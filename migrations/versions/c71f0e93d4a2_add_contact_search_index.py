@@ -0,0 +1,30 @@
+"""Add contact search index
+
+Revision ID: c71f0e93d4a2
+Revises: 8a4d6e2b7c10
+Create Date: 2023-05-06 16:02:38.770215
+
+Trigram GIN index over first_name, last_name, email and phone, used by
+search_contacts for ILIKE substring matches and word_similarity (%>) matches.
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71f0e93d4a2'
+down_revision = '8a4d6e2b7c10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    with op.get_context().autocommit_block():
+        op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_contact_search_trgm ON contact "
+                   "USING gin ((first_name || ' ' || last_name || ' ' || email || ' ' || phone) gin_trgm_ops)")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_contact_search_trgm")
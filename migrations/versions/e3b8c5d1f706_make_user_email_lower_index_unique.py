@@ -0,0 +1,37 @@
+"""Make user email lower index unique
+
+Revision ID: e3b8c5d1f706
+Revises: c71f0e93d4a2
+Create Date: 2023-05-09 10:14:22.518034
+
+users.email is unique as typed, but get_user_by_email matches lower(email), so two
+signups racing with Tony@example.com and tony@example.com could both be stored.
+ix_users_email_lower is rebuilt as a unique index to reject the second one.
+
+The upgrade fails if the table already holds emails that differ only in case;
+merge or rename those accounts first.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8c5d1f706'
+down_revision = 'c71f0e93d4a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_email_lower', table_name='users', postgresql_concurrently=True)
+        op.create_index('ix_users_email_lower', 'users', [sa.text('lower(email)')], unique=True,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_email_lower', table_name='users', postgresql_concurrently=True)
+        op.create_index('ix_users_email_lower', 'users', [sa.text('lower(email)')], unique=False,
+                        postgresql_concurrently=True)
@@ -1,23 +1,200 @@
+import inspect
+import time
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from src.conf.config import settings
 
 
 SQLALCHEMY_DATABASE_URL = settings.sqlalchemy_database_url
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
+SQLALCHEMY_ASYNC_DATABASE_URL = settings.sqlalchemy_async_database_url
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+class PoolWaitStats:
+    """Accumulates how long callers waited to check a connection out of the pool."""
 
-# Dependency
-def get_db():
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        if timed_out:
+            self.timeouts += 1
+        else:
+            self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        attempts = self.checkouts + self.timeouts
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.total_wait / attempts * 1000, 3) if attempts else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+
+class _WaitTimingMixin:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.wait_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.wait_stats.record(time.perf_counter() - start)
+        return connection
+
+
+class TimedQueuePool(_WaitTimingMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_WaitTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(url: str, is_async: bool = False) -> dict:
+    """
+The engine_options function builds the create_engine keyword arguments from settings.
+Pool sizing and the statement timeout only apply to server databases, so SQLite urls
+get just the echo flag.
+
+:param url: str: The database url the engine is created for
+:param is_async: bool: Whether the engine is created with create_async_engine
+:return: A dictionary of keyword arguments for create_engine or create_async_engine
+:doc-author: Trelent
+"""
+    options = {"echo": settings.db_echo}
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        return options
+
+    options.update(
+        poolclass=TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+    if settings.db_statement_timeout and backend == "postgresql":
+        if is_async:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(settings.db_statement_timeout)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={settings.db_statement_timeout}"}
+    return options
+
+
+if settings.database_async:
+    engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL,
+                                 **engine_options(SQLALCHEMY_ASYNC_DATABASE_URL, is_async=True))
+    SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+else:
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def pool_status(pool=None) -> dict:
+    """
+The pool_status function reports the live state of the connection pool.
+It returns how many connections are checked out, idle in the pool and opened as overflow,
+together with the wait time statistics gathered on checkout.
+
+:param pool: The pool to inspect, defaults to the pool of the application engine
+:return: A dictionary with the pool counters
+:doc-author: Trelent
+"""
+    pool = pool if pool is not None else engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+    data = {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+    }
+    wait_stats = getattr(pool, "wait_stats", None)
+    if wait_stats is not None:
+        data.update(wait_stats.as_dict())
+    return data
+
+
+async def maybe_await(result):
+    """
+The maybe_await function lets the same code drive both a Session and an AsyncSession.
+An AsyncSession returns awaitables from execute, commit, refresh, delete and close,
+while a Session returns the final value straight away.
+
+:param result: The value returned by a session method
+:return: The awaited result for an AsyncSession, or the result itself for a Session
+:doc-author: Trelent
+"""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+async def execute(db, statement):
+    """
+The execute function runs a statement on either kind of session without holding the event loop:
+an AsyncSession is awaited, a Session runs it in the thread pool. Background jobs that issue many
+queries on the API's loop use it instead of maybe_await(db.execute(...)).
+
+:param db: Session: The session to run the statement on
+:param statement: The statement to execute
+:return: The result of the statement
+:doc-author: Trelent
+"""
+    if isinstance(db, AsyncSession):
+        return await db.execute(statement)
+    return await run_in_threadpool(db.execute, statement)
+
+
+async def stream_partitions(db, statement, scalars: bool = False):
+    """
+The stream_partitions function reads a yield_per statement through a server-side cursor, one partition at a time.
+An AsyncSession streams it natively; with a Session the execute and every partition fetch run in the thread pool,
+so a long scan by a background job does not hold the event loop.
+
+:param db: Session: The session to run the statement on
+:param statement: The select statement, with execution_options(yield_per=...)
+:param scalars: bool: Yield lists of the first column instead of rows
+:return: An async iterator of partitions
+:doc-author: Trelent
+"""
+    if isinstance(db, AsyncSession):
+        result = await db.stream(statement)
+        async for partition in (result.scalars() if scalars else result).partitions():
+            yield partition
+    else:
+        result = await run_in_threadpool(db.execute, statement)
+        partitions = (result.scalars() if scalars else result).partitions()
+        while (partition := await run_in_threadpool(next, partitions, None)) is not None:
+            yield partition
+
+
+async def get_db():
     """
 The get_db function is a context manager that returns the database session.
 It also handles any exceptions that may occur during the session, and closes
-the connection when it's done.
+the connection when it's done. Depending on settings.database_async the session
+is either a Session or an AsyncSession.
 
 :return: A database session that can be used to query the database
 :doc-author: Trelent
@@ -26,7 +203,7 @@ the connection when it's done.
     try:
         yield db
     except SQLAlchemyError as err:
-        db.rollback()
+        await maybe_await(db.rollback())
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
     finally:
-        db.close()
+        await maybe_await(db.close())
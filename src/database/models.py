@@ -1,10 +1,40 @@
-from sqlalchemy import Column, Integer, String, func, DATE, DateTime, ForeignKey, Boolean
+from datetime import date, timedelta
+
+from sqlalchemy import Column, Integer, String, func, DATE, DateTime, ForeignKey, Boolean, Index, DDL, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 
 Base = declarative_base()
 
 
+def birthday_key(value: date | None) -> int | None:
+    """
+The birthday_key function turns a date into its month and day packed as MMDD, e.g. 1008 for October 8.
+Ordering by this number orders birthdays through the year regardless of the birth year.
+
+:param value: date | None: The date of birth
+:return: The MMDD integer, or None when there is no date
+:doc-author: Trelent
+"""
+    if value is None:
+        return None
+    return value.month * 100 + value.day
+
+
+def birthday_window(today: date, days: int) -> tuple[int, int, bool]:
+    """
+The birthday_window function gives the birthday_key range of the days days after today, today included.
+When the window runs past December 31 it wraps, and matches keys from start to 1231 and from 101 to end.
+
+:param today: date: The first day of the window
+:param days: int: The length of the window after today
+:return: The start key, the end key and whether the window wraps
+:doc-author: Trelent
+"""
+    last_day = today + timedelta(days=days)
+    return birthday_key(today), birthday_key(last_day), last_day.year != today.year
+
+
 class Contact(Base):
     __tablename__ = "contact"
     id = Column(Integer, primary_key=True)
@@ -13,11 +43,25 @@ class Contact(Base):
     email = Column(String, unique=True, nullable=False)
     phone = Column(String, unique=True, nullable=False)
     date_of_birth = Column(DATE)
+    birthday_key = Column(Integer)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     user_id = Column('user_id', ForeignKey('users.id', ondelete='CASCADE'), default=None)
     user = relationship('User', backref="contact")
 
+    __table_args__ = (
+        Index('ix_contact_user_id_id', 'user_id', 'id'),
+        Index('ix_contact_user_id_last_name_id', 'user_id', 'last_name', 'id'),
+        Index('ix_contact_user_id_first_name_id', 'user_id', 'first_name', 'id'),
+        Index('ix_contact_user_id_email_id', 'user_id', 'email', 'id'),
+        Index('ix_contact_user_id_birthday_key', 'user_id', 'birthday_key'),
+    )
+
+    @validates('date_of_birth')
+    def _sync_birthday_key(self, key, value):
+        self.birthday_key = birthday_key(value)
+        return value
+
 
 class User(Base):
     __tablename__ = "users"
@@ -26,6 +70,39 @@ class User(Base):
     email = Column(String(250), nullable=False, unique=True)
     password = Column(String(255), nullable=False)
     created_at = Column('crated_at', DateTime, default=func.now())
-    refresh_token = Column(String(255), nullable=True)
     confirmed = Column(Boolean, default=False)
     avatar = Column(String(255), nullable=True)
+
+
+Index('ix_users_email_lower', func.lower(User.email), unique=True)
+
+
+# Full text search over contacts. PostgreSQL matches the document expression through a
+# pg_trgm GIN index; SQLite keeps an external content FTS5 table in sync with triggers.
+CONTACT_SEARCH_DOCUMENT = "(first_name || ' ' || last_name || ' ' || email || ' ' || phone)"
+
+event.listen(Contact.__table__, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+event.listen(Contact.__table__, "after_create",
+             DDL(f"CREATE INDEX IF NOT EXISTS ix_contact_search_trgm ON contact "
+                 f"USING gin ({CONTACT_SEARCH_DOCUMENT} gin_trgm_ops)").execute_if(dialect="postgresql"))
+
+for statement in (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS contact_search USING fts5("
+    "first_name, last_name, email, phone, content='contact', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS contact_search_ai AFTER INSERT ON contact BEGIN "
+    "INSERT INTO contact_search(rowid, first_name, last_name, email, phone) "
+    "VALUES (new.id, new.first_name, new.last_name, new.email, new.phone); END",
+    "CREATE TRIGGER IF NOT EXISTS contact_search_ad AFTER DELETE ON contact BEGIN "
+    "INSERT INTO contact_search(contact_search, rowid, first_name, last_name, email, phone) "
+    "VALUES ('delete', old.id, old.first_name, old.last_name, old.email, old.phone); END",
+    "CREATE TRIGGER IF NOT EXISTS contact_search_au AFTER UPDATE ON contact BEGIN "
+    "INSERT INTO contact_search(contact_search, rowid, first_name, last_name, email, phone) "
+    "VALUES ('delete', old.id, old.first_name, old.last_name, old.email, old.phone); "
+    "INSERT INTO contact_search(rowid, first_name, last_name, email, phone) "
+    "VALUES (new.id, new.first_name, new.last_name, new.email, new.phone); END",
+    "INSERT INTO contact_search(contact_search) VALUES ('rebuild')",
+):
+    event.listen(Contact.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Contact.__table__, "after_drop",
+             DDL("DROP TABLE IF EXISTS contact_search").execute_if(dialect="sqlite"))
@@ -0,0 +1,68 @@
+import logging
+
+import redis.asyncio as redis
+
+from src.conf.config import settings
+
+logger = logging.getLogger(__name__)
+
+# One blocking pool for the whole process: the caches, the session store and the rate limiter
+# all borrow from it, so settings.redis_max_connections bounds the sockets a worker opens to Redis.
+# No connection is opened until open_redis() runs in startup (or the first command is sent).
+pool = redis.BlockingConnectionPool(
+    host=settings.redis_host,
+    port=settings.redis_port,
+    db=0,
+    max_connections=settings.redis_max_connections,
+    timeout=settings.redis_pool_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+    socket_connect_timeout=settings.redis_socket_connect_timeout,
+    health_check_interval=settings.redis_health_check_interval,
+)
+redis_client = redis.Redis(connection_pool=pool)
+
+
+async def open_redis() -> None:
+    """
+The open_redis function warms up the shared Redis pool when the application starts.
+A Redis outage is logged rather than raised: every Redis user in the app degrades on its own.
+
+:return: Nothing
+:doc-author: Trelent
+"""
+    try:
+        await redis_client.ping()
+    except redis.RedisError as err:
+        logger.warning("redis is not reachable at startup: %s", err)
+
+
+async def close_redis() -> None:
+    """
+The close_redis function closes every connection of the shared Redis pool when the application stops.
+
+:return: Nothing
+:doc-author: Trelent
+"""
+    await redis_client.close()
+    await pool.disconnect()
+
+
+def redis_pool_status(connection_pool: redis.BlockingConnectionPool = pool) -> dict:
+    """
+The redis_pool_status function reports how many connections of the shared Redis pool exist and are in use.
+
+:param connection_pool: The pool to inspect, defaults to the application pool
+:return: A dictionary with the pool counters; counters this redis-py version does not expose are None
+:doc-author: Trelent
+"""
+    # redis-py has no public counters; these internals moved between releases, so a missing one reads as None
+    connections = getattr(connection_pool, "_connections", None)
+    queue = getattr(getattr(connection_pool, "pool", None), "_queue", None)
+    created = len(connections) if connections is not None else None
+    idle = sum(1 for connection in queue if connection is not None) if queue is not None else None
+    return {
+        "max_connections": connection_pool.max_connections,
+        "created": created,
+        "in_use": created - idle if created is not None and idle is not None else None,
+        "idle": idle,
+    }
@@ -1,66 +1,213 @@
+import base64
+import json
 from typing import List
-from datetime import date, timedelta
-from sqlalchemy import or_, and_
+from datetime import date
+from sqlalchemy import (or_, and_, select, insert, update, delete, tuple_, case, func, literal_column, table, column,
+                        bindparam, String)
+from sqlalchemy.exc import IntegrityError
 
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.database.models import Contact, User
-from src.schemas import ContactModel
+from src.database.db import execute, maybe_await, stream_partitions
+from src.database.models import Contact, User, birthday_key, birthday_window, CONTACT_SEARCH_DOCUMENT
+from src.schemas import ContactModel, ContactSelection, ContactPartialModel
+from src.services.birthday_digest import birthday_digest
+from src.services.response_cache import response_cache
 
 
-async def get_contact_by_id(contact_id: int, db: Session):
+async def get_contact_by_id(contact_id: int, db: Session | AsyncSession, user: User | None = None):
     """
 The get_contact_by_id function returns a contact from the database by its id.
 
 :param contact_id: int: Specify the id of the contact that we want to retrieve
 :param db: Session: Pass in the database session to be used for querying
+:param user: User: Only return the contact if it belongs to this user
 :return: A contact object
 :doc-author: Trelent
 """
-    return db.query(Contact).filter(Contact.id == contact_id).first()
+    stmt = select(Contact).filter(Contact.id == contact_id)
+    if user is not None:
+        stmt = stmt.filter(Contact.user_id == user.id)
+    result = await maybe_await(db.execute(stmt))
+    return result.scalars().first()
 
 
-async def get_contacts(skip: int,
-                       limit: int,
+SORT_KEYS = {
+    "id": Contact.id,
+    "first_name": Contact.first_name,
+    "last_name": Contact.last_name,
+    "email": Contact.email,
+}
+
+
+def encode_cursor(sort_by: str, contact: Contact) -> str:
+    """
+The encode_cursor function packs the position of the last contact on a page into an opaque token.
+The token holds the sort key, its value for that contact and the contact id, so the next page
+can continue right after it.
+
+:param sort_by: str: The name of the column the page is ordered by
+:param contact: Contact: The last contact of the page
+:return: A url safe cursor string
+:doc-author: Trelent
+"""
+    payload = json.dumps([sort_by, getattr(contact, sort_by), contact.id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_by: str) -> tuple:
+    """
+The decode_cursor function unpacks a cursor created by encode_cursor.
+It raises ValueError when the cursor is malformed or was issued for another sort order.
+
+:param cursor: str: The cursor received from the client
+:param sort_by: str: The name of the column the page is ordered by
+:return: A tuple of the sort value and the contact id to continue after
+:doc-author: Trelent
+"""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key, value, contact_id = json.loads(payload)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if key != sort_by or not isinstance(contact_id, int):
+        raise ValueError("Cursor does not match the sort order")
+    return value, contact_id
+
+
+async def get_contacts(limit: int,
                        first_name: str,
                        last_name: str,
                        email: str,
-                       db: Session):
+                       db: Session | AsyncSession,
+                       user: User,
+                       cursor: str | None = None,
+                       sort_by: str = "id"):
 
     """
-The get_contacts function returns a list of contacts from the database.
+The get_contacts function returns a page of the user's contacts from the database.
+    Pages are ordered by (sort_by, id) and continue after the position stored in the cursor,
+    so every page costs the same index range scan, whatever filters are applied.
 
-:param skip: int: Skip a number of records in the database
 :param limit: int: Limit the number of results returned
 :param first_name: str: Filter the contacts by first name
 :param last_name: str: Filter the contacts by last name
 :param email: str: Filter the contacts by email
 :param db: Session: Pass the database session to the function
-:return: A list of contacts
+:param user: User: Get the contacts of the current user only
+:param cursor: str | None: The next_cursor of the previous page
+:param sort_by: str: The column the contacts are ordered by
+:return: A tuple of the list of contacts and the cursor of the next page, or None for the last page
 :doc-author: Trelent
 """
+    sort_column = SORT_KEYS[sort_by]
+    stmt = select(Contact).filter(Contact.user_id == user.id)
+
     if first_name:
-            if last_name or email:
-                return db.query(Contact).select_from(Contact)\
-                                  .filter(Contact.first_name == first_name,
-                                          or_(Contact.last_name == last_name, Contact.email == email)).all()
-            else:
-                return db.query(Contact).filter(Contact.first_name == first_name).all()
-
-    if last_name:
+        if last_name or email:
+            stmt = stmt.filter(Contact.first_name == first_name,
+                               or_(Contact.last_name == last_name, Contact.email == email))
+        else:
+            stmt = stmt.filter(Contact.first_name == first_name)
+    elif last_name:
         if email:
-            return db.query(Contact).select_from(Contact) \
-                .filter(Contact.last_name == last_name, Contact.email == email).all()
+            stmt = stmt.filter(Contact.last_name == last_name, Contact.email == email)
+        else:
+            stmt = stmt.filter(Contact.last_name == last_name)
+    elif email:
+        stmt = stmt.filter(Contact.email == email)
+
+    if sort_by == "id":
+        order_by = (Contact.id,)
+    else:
+        order_by = (sort_column, Contact.id)
+
+    if cursor:
+        value, contact_id = decode_cursor(cursor, sort_by)
+        if sort_by == "id":
+            stmt = stmt.filter(Contact.id > contact_id)
         else:
-            return db.query(Contact).filter(Contact.last_name == last_name).all()
+            stmt = stmt.filter(tuple_(sort_column, Contact.id) > tuple_(value, contact_id))
+
+    result = await maybe_await(db.execute(stmt.order_by(*order_by).limit(limit + 1)))
+    contacts = result.scalars().all()
+
+    next_cursor = None
+    if len(contacts) > limit:
+        contacts = contacts[:limit]
+        next_cursor = encode_cursor(sort_by, contacts[-1])
+    return contacts, next_cursor
 
-    if email:
-        return db.query(Contact).filter(Contact.email == email).all()
 
-    return db.query(Contact).offset(skip).limit(limit).all()
+def _escape_like(value: str) -> str:
+    return value.replace("!", "!!").replace("%", "!%").replace("_", "!_")
 
 
-async def verify_email_phone(email: str, phone: str, db: Session):
+async def search_contacts(q: str, skip: int, limit: int, db: Session | AsyncSession, user: User):
+    """
+The search_contacts function finds the user's contacts whose name, email or phone match the query.
+    On PostgreSQL it matches substrings with ILIKE and misspelled words with pg_trgm word similarity,
+    both served by the ix_contact_search_trgm index, and ranks by similarity.
+    On SQLite it matches substrings through the contact_search FTS5 table ranked by bm25.
+    Queries shorter than a trigram fall back to a prefix match.
+
+:param q: str: The search query
+:param skip: int: Skip the first n results
+:param limit: int: Limit the number of results returned
+:param db: Session: Pass the database session to the function
+:param user: User: Search the contacts of the current user only
+:return: A list of matching contacts, best match first
+:doc-author: Trelent
+"""
+    dialect = db.get_bind().dialect.name
+    stmt = select(Contact).filter(Contact.user_id == user.id)
+
+    if dialect == "postgresql":
+        document = literal_column(CONTACT_SEARCH_DOCUMENT, String)
+        query = bindparam("search_query", q, String)
+        pattern = bindparam("search_pattern", f"%{_escape_like(q)}%", String)
+        stmt = stmt.filter(or_(document.ilike(pattern, escape="!"), document.op("%>")(query))) \
+            .order_by(func.word_similarity(query, document).desc(), Contact.id)
+    elif dialect == "sqlite" and len(q) >= 3:
+        search = table("contact_search", column("rowid"), column("rank"))
+        phrase = '"' + q.replace('"', '""') + '"'
+        stmt = stmt.join(search, search.c.rowid == Contact.id) \
+            .filter(literal_column("contact_search").match(phrase)) \
+            .order_by(search.c.rank, Contact.id)
+    else:
+        pattern = f"{_escape_like(q)}%"
+        stmt = stmt.filter(or_(*(field.ilike(pattern, escape="!") for field in
+                                 (Contact.first_name, Contact.last_name, Contact.email, Contact.phone)))) \
+            .order_by(Contact.last_name, Contact.id)
+
+    result = await maybe_await(db.execute(stmt.offset(skip).limit(limit)))
+    return result.scalars().all()
+
+
+async def stream_contacts(db: Session | AsyncSession, user: User, columns: tuple, batch_size: int):
+    """
+The stream_contacts function reads all of the user's contacts through a server-side cursor.
+    Rows are fetched batch_size at a time (yield_per), so memory stays constant however
+    large the address book is; with a Session every fetch runs in the thread pool, so a large
+    export does not hold up other requests.
+
+:param db: Session: Pass the database session to the function
+:param user: User: Read the contacts of the current user only
+:param columns: tuple: The names of the Contact columns to read
+:param batch_size: int: The number of rows fetched per round trip
+:return: An async iterator of lists of rows, ordered by id
+:doc-author: Trelent
+"""
+    table = Contact.__table__
+    stmt = select(*(table.c[name] for name in columns)).filter(table.c.user_id == user.id) \
+        .order_by(table.c.id).execution_options(yield_per=batch_size)
+    async for partition in stream_partitions(db, stmt):
+        yield partition
+
+
+async def verify_email_phone(email: str, phone: str, db: Session | AsyncSession):
     """
 The verify_email_phone function is used to verify that the email and phone number provided by the user are not already in use.
     If either of them are, then an error message will be returned to the user.
@@ -71,11 +218,13 @@ The verify_email_phone function is used to verify that the email and phone numbe
 :return: A tuple of email and phone data
 :doc-author: Trelent
 """
-    email_data = db.query(Contact.email).filter(Contact.email == email).first()
+    result = await maybe_await(db.execute(select(Contact.email).filter(Contact.email == email)))
+    email_data = result.first()
     if email_data:
         return email_data
 
-    phone_data = db.query(Contact.phone).filter(Contact.phone == phone).first()
+    result = await maybe_await(db.execute(select(Contact.phone).filter(Contact.phone == phone)))
+    phone_data = result.first()
     if phone_data:
         return phone_data
 
@@ -83,33 +232,134 @@ The verify_email_phone function is used to verify that the email and phone numbe
 
 
 async def get_contact_birthday(skip: int,
-                               limit: int, db: Session):
+                               limit: int, db: Session | AsyncSession, user: User,
+                               days: int = 7, today: date | None = None):
     """
-The get_contact_birthday function returns a list of contacts with birthdays in the next 7 days.
+The get_contact_birthday function returns the user's contacts with birthdays in the next days days.
+    The window is matched in the database against the indexed birthday_key column (MMDD),
+    and a window that runs past December 31 continues from January 1.
     The function takes two arguments: skip and limit, which are used to paginate the results.
-    It also takes a db Session object as an argument.
 
 :param skip: int: Skip the first n number of contacts
 :param limit: int: Limit the number of contacts returned by the function
 :param db: Session: Pass the database session to the function
-:return: A list of contacts with birthday in the next 7 days
+:param user: User: Get the contacts of the current user only
+:param days: int: The length of the window after today, today included
+:param today: date | None: The first day of the window, defaults to date.today()
+:return: A list of contacts with birthday in the next days, nearest first
 :doc-author: Trelent
 """
-    contacts_with_next_birth = []
-    today = date.today()
-    all_contacts = db.query(Contact).offset(skip).limit(limit).all()
-    for contact in all_contacts:
-        if contact.date_of_birth.month == today.month:
-            if 0 <= (contact.date_of_birth.day - today.day) <= 7:
-                contacts_with_next_birth.append(contact)
-        else:
-            continue
-    return contacts_with_next_birth
+    stmt = _birthday_statement(user.id, days, today or date.today())
+    result = await maybe_await(db.execute(stmt.offset(skip).limit(limit)))
+    return result.scalars().all()
+
+
+def _birthday_statement(user_id: int, days: int, today: date):
+    start, end, wraps = birthday_window(today, days)
+    stmt = select(Contact).filter(Contact.user_id == user_id)
+    if not wraps:
+        return stmt.filter(Contact.birthday_key.between(start, end)) \
+            .order_by(Contact.birthday_key, Contact.id)
+    return stmt.filter(or_(Contact.birthday_key >= start, Contact.birthday_key <= end)) \
+        .order_by(case((Contact.birthday_key >= start, 0), else_=1), Contact.birthday_key, Contact.id)
+
+
+async def get_birthday_digest(skip: int, limit: int, db: Session | AsyncSession, user: User,
+                              days: int = 7, today: date | None = None) -> list:
+    """
+The get_birthday_digest function answers the upcoming-birthday list from the user's daily digest in Redis.
+    The digest covers settings.birthday_digest_days days and is built with get_contact_birthday on the first
+    read of the day; longer windows, and pages past the end of a truncated digest, query the database directly.
+
+:param skip: int: Skip the first n number of contacts
+:param limit: int: Limit the number of contacts returned by the function
+:param db: Session: Pass the database session to the function
+:param user: User: Get the contacts of the current user only
+:param days: int: The length of the window after today, today included
+:param today: date | None: The first day of the window, defaults to date.today()
+:return: A list of contacts with birthday in the next days, nearest first
+:doc-author: Trelent
+"""
+    today = today or date.today()
+    if days <= birthday_digest.days:
+        digest = await birthday_digest.get(user.id, today)
+        if digest is None:
+            digest = await build_birthday_digest(db, user.id, today)
+        contacts = birthday_digest.select(digest, today, days, skip, limit)
+        if contacts is not None:
+            return contacts
+    return await get_contact_birthday(skip, limit, db, user, days, today)
+
+
+async def build_birthday_digest(db: Session | AsyncSession, user_id: int, today: date) -> dict:
+    """
+The build_birthday_digest function queries the user's birthdays for the whole digest window and stores them.
+    The query runs in the thread pool with a sync Session, as the daily rebuild calls this once per user.
+
+:param db: Session: Pass the database session to the function
+:param user_id: int: The owner of the contacts
+:param today: date: The day the digest is for
+:return: The stored digest
+:doc-author: Trelent
+"""
+    stmt = _birthday_statement(user_id, birthday_digest.days, today).limit(birthday_digest.size + 1)
+    result = await execute(db, stmt)
+    return await birthday_digest.store(user_id, today, result.scalars().all())
+
+
+async def rebuild_birthday_digests(db: Session | AsyncSession, today: date) -> None:
+    """
+The rebuild_birthday_digests function prebuilds today's birthday digest of every user who has contacts.
+    It is run once a day by the background job started in main.py; with a sync Session every query
+    runs in the thread pool, so the rebuild does not stall requests on the API's event loop.
+
+:param db: Session: Pass the database session to the function
+:param today: date: The day the digests are for
+:return: None
+:doc-author: Trelent
+"""
+    result = await execute(db, select(Contact.user_id).distinct())
+    for user_id in result.scalars().all():
+        await build_birthday_digest(db, user_id, today)
+
+
+async def stream_upcoming_birthdays(db: Session | AsyncSession, today: date, days: int, after_user_id: int,
+                                    batch_size: int):
+    """
+The stream_upcoming_birthdays function reads every contact whose birthday falls in the next days days,
+    together with the email and username of its owner, through a server-side cursor.
+    Rows are ordered by owner, then nearest birthday first, so each user's contacts arrive together;
+    only confirmed users are included, and only those with an id above after_user_id, so a run can resume.
+    With a sync Session the cursor is read in the thread pool, so the daily job does not stall the API.
+
+:param db: Session: Pass the database session to the function
+:param today: date: The first day of the window
+:param days: int: The length of the window after today, today included
+:param after_user_id: int: Skip the users up to and including this id
+:param batch_size: int: The number of rows fetched per round trip
+:return: An async iterator of lists of rows with user_id, email, username, first_name, last_name and date_of_birth
+:doc-author: Trelent
+"""
+    start, end, wraps = birthday_window(today, days)
+    stmt = select(Contact.user_id, User.email, User.username, Contact.first_name, Contact.last_name,
+                  Contact.date_of_birth).join(User, User.id == Contact.user_id) \
+        .filter(Contact.user_id > after_user_id, User.confirmed.is_(True))
+    if not wraps:
+        stmt = stmt.filter(Contact.birthday_key.between(start, end)) \
+            .order_by(Contact.user_id, Contact.birthday_key, Contact.id)
+    else:
+        stmt = stmt.filter(or_(Contact.birthday_key >= start, Contact.birthday_key <= end)) \
+            .order_by(Contact.user_id, case((Contact.birthday_key >= start, 0), else_=1), Contact.birthday_key,
+                      Contact.id)
+    async for partition in stream_partitions(db, stmt.execution_options(yield_per=batch_size)):
+        yield partition
 
 
-async def create_contact(body: ContactModel, db: Session, user: User):
+async def create_contact(body: ContactModel, db: Session | AsyncSession, user: User):
     """
 The create_contact function creates a new contact in the database.
+    It is a single INSERT ... RETURNING statement; a duplicate email or phone is rejected by the
+    unique constraints and raises IntegrityError after the transaction is rolled back.
 
 :param body: ContactModel: Get the data from the request body
 :param db: Session: Access the database
@@ -117,14 +367,48 @@ The create_contact function creates a new contact in the database.
 :return: The contact created
 :doc-author: Trelent
 """
-    contact = Contact(**body.dict(), user_id=user.id)
-    db.add(contact)
-    db.commit()
-    db.refresh(contact)
+    stmt = insert(Contact).values(**body.dict(), birthday_key=birthday_key(body.date_of_birth), user_id=user.id) \
+        .returning(Contact)
+    try:
+        result = await maybe_await(db.execute(stmt))
+        contact = result.scalars().one()
+        db.expunge(contact)
+        await maybe_await(db.commit())
+    except IntegrityError:
+        await maybe_await(db.rollback())
+        raise
+    await response_cache.bump(user.id)
+    await birthday_digest.upsert(contact)
     return contact
 
 
-async def update_contact(contact_id: int, body: ContactModel, db: Session, user: User):
+async def create_contacts(bodies: List[ContactModel], db: Session | AsyncSession, user: User) -> set:
+    """
+The create_contacts function inserts many contacts in one executemany call, which SQLAlchemy
+    sends as multi-row INSERT statements (insertmanyvalues). Rows whose email or phone already exists are skipped by ON CONFLICT DO NOTHING,
+    and the emails of the rows that were inserted come back through RETURNING.
+
+:param bodies: List[ContactModel]: The validated contacts to insert
+:param db: Session: Access the database
+:param user: User: The owner of the new contacts
+:return: The set of emails that were inserted
+:doc-author: Trelent
+"""
+    if not bodies:
+        return set()
+    dialect_insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+    rows = [dict(**body.dict(), birthday_key=birthday_key(body.date_of_birth), user_id=user.id) for body in bodies]
+    stmt = dialect_insert(Contact.__table__).on_conflict_do_nothing().returning(Contact.__table__.c.email)
+    result = await maybe_await(db.execute(stmt, rows))
+    inserted = set(result.scalars().all())
+    await maybe_await(db.commit())
+    if inserted:
+        await response_cache.bump(user.id)
+        await birthday_digest.invalidate(user.id)
+    return inserted
+
+
+async def update_contact(contact_id: int, body: ContactModel, db: Session | AsyncSession, user: User):
     """
 The update_contact function updates a contact in the database.
     Args:
@@ -138,18 +422,23 @@ The update_contact function updates a contact in the database.
 :return: The updated contact object
 :doc-author: Trelent
 """
-    contact = db.query(Contact).filter(and_(Contact.id == contact_id, Contact.user_id == user.id)).first()
+    result = await maybe_await(db.execute(select(Contact).filter(and_(Contact.id == contact_id,
+                                                                      Contact.user_id == user.id))))
+    contact = result.scalars().first()
     if contact:
         contact.first_name = body.first_name
         contact.last_name = body.last_name
         contact.email = body.email
         contact.phone = body.phone
         contact.date_of_birth = body.date_of_birth
-        db.commit()
+        await maybe_await(db.commit())
+        await maybe_await(db.refresh(contact))
+        await response_cache.bump(user.id)
+        await birthday_digest.upsert(contact)
     return contact
 
 
-async def remove_contact(contact_id: int, db: Session, user: User):
+async def remove_contact(contact_id: int, db: Session | AsyncSession, user: User):
     """
 The remove_contact function removes a contact from the database.
     Args:
@@ -163,8 +452,78 @@ The remove_contact function removes a contact from the database.
 :return: A contact object
 :doc-author: Trelent
 """
-    contact = db.query(Contact).filter(and_(Contact.id == contact_id, Contact.user_id == user.id)).first()
+    result = await maybe_await(db.execute(select(Contact).filter(and_(Contact.id == contact_id,
+                                                                      Contact.user_id == user.id))))
+    contact = result.scalars().first()
     if contact:
-        db.delete(contact)
-        db.commit()
+        await maybe_await(db.delete(contact))
+        await maybe_await(db.commit())
+        await response_cache.bump(user.id)
+        await birthday_digest.discard(user.id, contact_id)
     return contact
+
+
+def _selection_filter(selection: ContactSelection, user: User) -> list:
+    conditions = [Contact.user_id == user.id]
+    if selection.ids is not None:
+        conditions.append(Contact.id.in_(selection.ids))
+    if selection.first_name is not None:
+        conditions.append(Contact.first_name == selection.first_name)
+    if selection.last_name is not None:
+        conditions.append(Contact.last_name == selection.last_name)
+    if selection.email is not None:
+        conditions.append(Contact.email == selection.email)
+    return conditions
+
+
+async def update_contacts(selection: ContactSelection, body: ContactPartialModel,
+                          db: Session | AsyncSession, user: User) -> List[int]:
+    """
+The update_contacts function applies a partial update to many of the user's contacts at once.
+    The selected contacts are changed by a single UPDATE statement and their ids come back
+    through RETURNING. A unique email or phone clash rolls the whole update back.
+
+:param selection: ContactSelection: The ids and/or field values that select the contacts
+:param body: ContactPartialModel: The fields to change, unset fields are left as they are
+:param db: Session: Pass the database session to the function
+:param user: User: Update the contacts of the current user only
+:return: The ids of the updated contacts
+:doc-author: Trelent
+"""
+    values = body.dict(exclude_none=True)
+    if "date_of_birth" in values:
+        values["birthday_key"] = birthday_key(values["date_of_birth"])
+    stmt = update(Contact).filter(*_selection_filter(selection, user)).values(**values) \
+        .returning(Contact.id).execution_options(synchronize_session=False)
+    try:
+        result = await maybe_await(db.execute(stmt))
+        ids = result.scalars().all()
+        await maybe_await(db.commit())
+    except IntegrityError:
+        await maybe_await(db.rollback())
+        raise
+    if ids:
+        await response_cache.bump(user.id)
+        await birthday_digest.invalidate(user.id)
+    return ids
+
+
+async def remove_contacts(selection: ContactSelection, db: Session | AsyncSession, user: User) -> List[int]:
+    """
+The remove_contacts function deletes many of the user's contacts with a single DELETE statement.
+
+:param selection: ContactSelection: The ids and/or field values that select the contacts
+:param db: Session: Pass the database session to the function
+:param user: User: Delete the contacts of the current user only
+:return: The ids of the deleted contacts
+:doc-author: Trelent
+"""
+    stmt = delete(Contact).filter(*_selection_filter(selection, user)) \
+        .returning(Contact.id).execution_options(synchronize_session=False)
+    result = await maybe_await(db.execute(stmt))
+    ids = result.scalars().all()
+    await maybe_await(db.commit())
+    if ids:
+        await response_cache.bump(user.id)
+        await birthday_digest.invalidate(user.id)
+    return ids
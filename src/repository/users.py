@@ -1,57 +1,107 @@
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from src.conf.config import settings
+from src.database.db import maybe_await, stream_partitions
 from src.database.models import User
 from src.schemas import UserModel
+from src.services.bloom import registered_emails
+from src.services.user_cache import user_cache
 
 
-async def get_user_by_email(email: str, db: Session) -> User | None:
+async def get_user_by_email(email: str, db: Session | AsyncSession) -> User | None:
     """
 The get_user_by_email function takes in an email and a database session,
 and returns the user associated with that email. If no such user exists, it returns None.
+Emails are compared case-insensitively, which is served by the ix_users_email_lower index.
+Emails known to have no account are answered without a query: from the user cache's negative
+entries and, when settings.user_bloom_enabled, from the Bloom filter of registered emails.
 
 :param email: str: Specify the email of the user that we want to retrieve
 :param db: Session: Pass the database session to the function
 :return: The first user that matches the email address, or none if no such user exists
 :doc-author: Trelent
 """
-    return db.query(User).filter(User.email == email).first()
+    if await user_cache.is_missing(email):
+        return None
+    if settings.user_bloom_enabled and not await registered_emails.might_contain(email.lower()):
+        await user_cache.set_missing(email)
+        return None
+    result = await maybe_await(db.execute(select(User).filter(func.lower(User.email) == email.lower())))
+    user = result.scalars().first()
+    if user is None:
+        await user_cache.set_missing(email)
+    return user
 
 
-async def create_user(body: UserModel, db: Session) -> User:
+async def create_user(body: UserModel, db: Session | AsyncSession) -> User:
     """
 The create_user function creates a new user in the database.
+The email is added to the Bloom filter of registered emails before the insert, so the filter never
+misses a stored user; this raises redis.RedisError if that is not possible. After the insert the
+user is written to the cache, replacing any negative entry in every worker; a lookup that missed the
+user just before the commit cannot cache the email as missing over it. An email that is already taken,
+in any letter case, is rejected by the unique ix_users_email_lower index and raises IntegrityError
+after the transaction is rolled back.
 
 :param body: UserModel: Specify the type of data that will be passed to the function
 :param db: Session: Access the database
 :return: A user object
 :doc-author: Trelent
 """
+    if settings.user_bloom_enabled:
+        await registered_emails.add(body.email.lower())
     new_user = User(**body.dict())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    try:
+        await maybe_await(db.commit())
+    except IntegrityError:
+        await maybe_await(db.rollback())
+        raise
+    await maybe_await(db.refresh(new_user))
+    await user_cache.set(new_user)
     return new_user
 
 
-async def update_token(user: User, token: str | None, db: Session) -> None:
+async def stream_user_emails(db: Session | AsyncSession, batch_size: int):
+    """
+The stream_user_emails function reads the lowercased email of every user through a server-side cursor,
+batch_size rows per round trip. It feeds the rebuild of the Bloom filter of registered emails;
+with a Session the scan runs in the thread pool.
+
+:param db: Session: Pass the database session to the function
+:param batch_size: int: The number of rows fetched per round trip
+:return: An async iterator of lists of emails
+:doc-author: Trelent
+"""
+    stmt = select(func.lower(User.email)).execution_options(yield_per=batch_size)
+    async for partition in stream_partitions(db, stmt, scalars=True):
+        yield list(partition)
+
+
+async def update_password(user: User, password: str, db: Session | AsyncSession) -> None:
     """
-The update_token function updates the refresh token for a user.
+The update_password function stores a new password hash for a user,
+e.g. when a hash made with an outdated bcrypt cost is upgraded on login.
 
-:param user: User: Get the user's id, which is used to find the user in the database
-:param token: str | None: Update the refresh_token field in the database
+:param user: User: The user whose password hash is replaced
+:param password: str: The new password hash
 :param db: Session: Pass the database session to the function
 :return: None
 :doc-author: Trelent
 """
-    user.refresh_token = token
-    db.commit()
+    user.password = password
+    await maybe_await(db.commit())
 
 
-async def confirmed_email(email: str, db: Session) -> None:
+async def confirmed_email(email: str, db: Session | AsyncSession) -> None:
 
     """
 The confirmed_email function takes in an email and a database session,
 and sets the confirmed field of the user with that email to True.
+The user's cache entry is rewritten so it never reports a stale confirmed flag.
 
 
 :param email: str: Get the email of the user who's account is being confirmed
@@ -61,12 +111,13 @@ and sets the confirmed field of the user with that email to True.
 """
     user = await get_user_by_email(email, db)
     user.confirmed = True
-    db.commit()
+    await maybe_await(db.commit())
+    await user_cache.set(user)
 
 
-async def update_avatar(email, url: str, db: Session) -> User:
+async def update_avatar(email, url: str, db: Session | AsyncSession) -> User:
     """
-The update_avatar function updates the avatar of a user.
+The update_avatar function updates the avatar of a user and rewrites the user's cache entry.
 
 :param email: Find the user in the database
 :param url: str: Specify the type of data that is being passed in
@@ -76,6 +127,7 @@ The update_avatar function updates the avatar of a user.
 """
     user = await get_user_by_email(email, db)
     user.avatar = url
-    db.commit()
-    db.refresh(user)
+    await maybe_await(db.commit())
+    await maybe_await(db.refresh(user))
+    await user_cache.set(user)
     return user
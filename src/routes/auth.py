@@ -1,7 +1,9 @@
 from typing import List
 
-from fastapi import APIRouter, HTTPException, Depends, status, Security, BackgroundTasks, Request
+import redis
+from fastapi import APIRouter, HTTPException, Depends, status, Security, Request
 from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from src.database.db import get_db
@@ -9,6 +11,7 @@ from src.schemas import UserModel, UserResponse, TokenModel
 from src.repository import users as repository_users
 from src.services.auth import auth_service
 from src.services.email import send_email
+from src.services.user_cache import user_cache
 
 from src.schemas import UserModel, UserResponse, TokenModel, RequestEmail
 
@@ -18,15 +21,16 @@ security = HTTPBearer()
 
 
 @router.post("/signup", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def signup(body: UserModel, background_tasks: BackgroundTasks, request: Request, db: Session = Depends(get_db)):
+async def signup(body: UserModel, request: Request, db: Session = Depends(get_db)):
     """
 The signup function creates a new user in the database.
     It takes in a UserModel object, which is validated by pydantic.
-    If the email already exists, it will return an HTTP 409 error code (conflict).
-    Otherwise, it will create a new user and send them an email to verify their account.
+    If the email already exists, in any letter case, it will return an HTTP 409 error code (conflict),
+    also when a concurrent signup takes it between the check and the insert.
+    Otherwise, it will create a new user and queue an email to verify their account in the mail outbox.
+    If the Bloom filter of registered emails cannot record the email, it returns 503 and creates nothing.
 
 :param body: UserModel: Validate the data passed in the request body
-:param background_tasks: BackgroundTasks: Add a task to the background tasks queue
 :param request: Request: Get the base url of the application
 :param db: Session: Get the database session
 :return: A dictionary with two keys: user and detail
@@ -35,9 +39,14 @@ The signup function creates a new user in the database.
     exist_user = await repository_users.get_user_by_email(body.email, db)
     if exist_user:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Account already exists")
-    body.password = auth_service.get_password_hash(body.password)
-    new_user = await repository_users.create_user(body, db)
-    background_tasks.add_task(send_email, new_user.email, new_user.username, request.base_url)
+    body.password = await auth_service.get_password_hash(body.password)
+    try:
+        new_user = await repository_users.create_user(body, db)
+    except redis.RedisError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="User registry unavailable")
+    except IntegrityError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Account already exists")
+    await send_email(new_user.email, new_user.username, request.base_url)
     return {"user": new_user, "detail": "User successfully created"}
 
 
@@ -58,12 +67,13 @@ The login function is used to authenticate a user.
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email")
     if not user.confirmed:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Email not confirmed")
-    if not auth_service.verify_password(body.password, user.password):
+    if not await auth_service.verify_password(body.password, user.password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid password")
+    if auth_service.password_needs_update(user.password):
+        await repository_users.update_password(user, await auth_service.get_password_hash(body.password), db)
     # Generate JWT
     access_token = await auth_service.create_access_token(data={"sub": user.email})
     refresh_token = await auth_service.create_refresh_token(data={"sub": user.email})
-    await repository_users.update_token(user, refresh_token, db)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
@@ -72,23 +82,18 @@ async def refresh_token(credentials: HTTPAuthorizationCredentials = Security(sec
     """
 The refresh_token function is used to refresh the access token.
     The function takes in a refresh token and returns an access_token, a new refresh_token, and the type of token.
-    If the user's current refresh_token does not match what was passed into this function then it will return an error.
+    The refresh token is rotated in Redis: it can be used once, and reusing it revokes the session.
 
 :param credentials: HTTPAuthorizationCredentials: Get the token from the request header
 :param db: Session: Get the database session
 :return: A dictionary with the access token, refresh token and a bearer type
 :doc-author: Trelent
 """
-    token = credentials.credentials
-    email = await auth_service.decode_refresh_token(token)
-    user = await repository_users.get_user_by_email(email, db)
-    if user.refresh_token != token:
-        await repository_users.update_token(user, None, db)
+    email, refresh_token = await auth_service.rotate_refresh_token(credentials.credentials)
+    user = await user_cache.get(email) or await repository_users.get_user_by_email(email, db)
+    if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
-
     access_token = await auth_service.create_access_token(data={"sub": email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": email})
-    await repository_users.update_token(user, refresh_token, db)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
@@ -118,17 +123,15 @@ The confirmed_email function is used to confirm a user's email address.
 
 
 @router.post('/request_email')
-async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, request: Request,
-                        db: Session = Depends(get_db)):
+async def request_email(body: RequestEmail, request: Request, db: Session = Depends(get_db)):
     """
 The request_email function is used to send an email to the user with a link that they can click on
 to confirm their email address. The function takes in a RequestEmail object, which contains the
 email of the user who wants to confirm their account. It then checks if there is already a confirmed
-user with that email address, and if so returns an error message saying as much. If not, it sends
-an email containing a confirmation link.
+user with that email address, and if so returns an error message saying as much. If not, it queues
+an email containing a confirmation link in the mail outbox.
 
 :param body: RequestEmail: Get the email from the request body
-:param background_tasks: BackgroundTasks: Add a task to the background tasks queue
 :param request: Request: Get the base_url of the application
 :param db: Session: Get the database session
 :return: A message to the user
@@ -136,8 +139,8 @@ an email containing a confirmation link.
 """
     user = await repository_users.get_user_by_email(body.email, db)
 
-    if user.confirmed:
+    if user and user.confirmed:
         return {"message": "Your email is already confirmed"}
     if user:
-        background_tasks.add_task(send_email, user.email, user.username, request.base_url)
+        await send_email(user.email, user.username, request.base_url)
     return {"message": "Check your email for confirmation."}
@@ -1,90 +1,153 @@
+from datetime import date
 from typing import List, Optional
 
-from fastapi import APIRouter, HTTPException, Depends, status, Query
-from fastapi_limiter.depends import RateLimiter
+from fastapi import APIRouter, HTTPException, Depends, status, Query, UploadFile, File, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from src.database.db import get_db
 from src.database.models import User
-from src.schemas import ContactModel, ContactResponse
+from src.schemas import (ContactModel, ContactResponse, ContactPage, ContactImportReport, ContactSelection,
+                         ContactBulkUpdate, ContactBulkResponse)
 from src.repository import contacts as repository_contacts
 from src.services.auth import auth_service
+from src.services import contacts_io
+from src.services.rate_limit import RateLimiter
+from src.services.response_cache import response_cache
 
 router = APIRouter(prefix='/contacts', tags=["contacts"])
 
 
-@router.get("/", response_model=list[ContactResponse], name='Get all contacts or Get by first_name, last_name, or email',
+@router.get("/", response_model=ContactPage, name='Get all contacts or Get by first_name, last_name, or email',
             description='No more than 10 requests per minute',
             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def get_contact_by_name(skip: int = 0, limit: int = Query(default=10, ge=1, le=50),
+async def get_contact_by_name(request: Request, limit: int = Query(default=10, ge=1, le=50),
+                              cursor: Optional[str] = Query(default=None),
+                              sort_by: str = Query(default='id', regex='^(id|first_name|last_name|email)$'),
                               first_name: Optional[str] = Query(default=None),
                               last_name: Optional[str] = Query(default=None),
                               email: Optional[str] = Query(default=None),
                               db: Session = Depends(get_db),
                               current_user: User = Depends(auth_service.get_current_user)):
     """
-The get_contact_by_name function is used to retrieve a contact by name.
+The get_contact_by_name function is used to retrieve a page of contacts, optionally filtered by name or email.
     The function takes in the following parameters:
-        skip (int): The number of contacts to skip before returning results. Default value is 0.
         limit (int): The maximum number of contacts to return per request. Default value is 10, with a minimum of 1 and maximum of 50 allowed values for this parameter.
-        first_name (str): A string containing the first name associated with the contact being searched for in the database, if any exists; default value None means that no search will be performed on this field when searching for a contact record in the
+        cursor (str): The next_cursor returned with the previous page; omit it to get the first page.
+        sort_by (str): The column the contacts are ordered by: id, first_name, last_name or email.
 
-:param skip: int: Skip a number of records
+:param request: Request: Read If-None-Match and build the response cache key
 :param limit: int: Limit the number of results returned
-:param ge: Set the minimum value for a parameter
-:param le: Limit the number of results returned by the query
+:param cursor: Optional[str]: Continue after the last contact of the previous page
+:param sort_by: str: Order the contacts by this column
 :param first_name: Optional[str]: Specify that the first_name parameter is optional
 :param last_name: Optional[str]: Filter the results by last name
 :param email: Optional[str]: Filter the contacts by email
 :param db: Session: Pass the database session to the function
 :param current_user: User: Get the current user from the database
-:return: A contact by name
+:return: A page of contacts and the cursor of the next page, or 304 if the client's ETag still matches
 :doc-author: Trelent
 """
-    contact = await repository_contacts.get_contacts(skip, limit,
-                                                     first_name, last_name,
-                                                     email, db)
-    if contact is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
-    return contact
+    async def build():
+        try:
+            contacts, next_cursor = await repository_contacts.get_contacts(limit, first_name, last_name, email,
+                                                                           db, current_user, cursor, sort_by)
+        except ValueError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+        return {"items": contacts, "next_cursor": next_cursor}
+
+    return await response_cache.respond(request, current_user.id, ContactPage, build)
+
+
+@router.get("/search", response_model=list[ContactResponse], name='Search contacts by name, email or phone')
+async def search_contacts(q: str = Query(min_length=1, max_length=100), skip: int = Query(default=0, ge=0),
+                          limit: int = Query(default=10, ge=1, le=50), db: Session = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+The search_contacts function returns the user's contacts that match q by prefix, substring or a close spelling
+in the first name, last name, email or phone, best match first.
+
+:param q: str: The search query
+:param skip: int: Skip the first n results
+:param limit: int: Limit the number of results returned
+:param db: Session: Get the database session
+:param current_user: User: Get the user who is currently logged in
+:return: A ranked list of contacts
+:doc-author: Trelent
+"""
+    return await repository_contacts.search_contacts(q, skip, limit, db, current_user)
+
+
+@router.get("/export", response_class=StreamingResponse, name='Export all contacts as CSV or NDJSON')
+async def export_contacts(format: str = Query(default='ndjson', regex='^(csv|ndjson)$'),
+                          gzip: bool = Query(default=False), db: Session = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+The export_contacts function streams the user's whole address book in one response.
+    The contacts are read through a server-side cursor, so memory does not grow with the number of rows.
+
+:param format: str: csv or ndjson
+:param gzip: bool: Compress the file with gzip
+:param db: Session: Get the database session
+:param current_user: User: Get the user who is currently logged in
+:return: A streaming response with the exported file
+:doc-author: Trelent
+"""
+    filename = f"contacts.{format}"
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(contacts_io.export_contacts(db, current_user, format, gzip), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 @router.get("/birthday", response_model=list[ContactResponse], name='Show contacts with birthday at the next 7 days')
-async def get_birthday(skip: int = 0, limit: int = Query(default=10, ge=1, le=50), db: Session = Depends(get_db),
+async def get_birthday(request: Request, skip: int = 0, limit: int = Query(default=10, ge=1, le=50),
+                       days: int = Query(default=7, ge=0, le=365), db: Session = Depends(get_db),
                        current_user: User = Depends(auth_service.get_current_user)):
     """
-The get_birthday function returns a list of contacts with birthdays in the current month.
+The get_birthday function returns a list of the user's contacts with birthdays in the next days days.
 
+:param request: Request: Read If-None-Match and build the response cache key
 :param skip: int: Skip the first n records in a query
 :param limit: int: Limit the number of contacts returned
-:param ge: Set a minimum value for the limit parameter
-:param le: Limit the number of results returned
+:param days: int: The number of days to look ahead, 7 by default
 :param db: Session: Get the database session
 :param current_user: User: Get the user who is currently logged in
-:return: A list of contacts with the same birthday as the current user
+:return: A list of contacts with upcoming birthdays, nearest first, or 304 if the client's ETag still matches
 :doc-author: Trelent
 """
-    contacts = await repository_contacts.get_contact_birthday(skip, limit, db)
-    return contacts
+    today = date.today()
+
+    async def build():
+        return await repository_contacts.get_birthday_digest(skip, limit, db, current_user, days, today)
+
+    return await response_cache.respond(request, current_user.id, list[ContactResponse], build, today)
 
 
 @router.get("/{contact_id}", response_model=ContactResponse, name='Get contact by ID')
-async def get_contact(contact_id: int, db: Session = Depends(get_db),
+async def get_contact(contact_id: int, request: Request, db: Session = Depends(get_db),
                       current_user: User = Depends(auth_service.get_current_user)):
     """
 The get_contact function is a GET request that returns the contact with the given ID.
 If no such contact exists, it raises an HTTP 404 error.
 
 :param contact_id: int: Get the contact id from the path
+:param request: Request: Read If-None-Match and build the response cache key
 :param db: Session: Get a database session
 :param current_user: User: Get the current user from the database
-:return: A contact object
+:return: A contact object, or 304 if the client's ETag still matches
 :doc-author: Trelent
 """
-    contact = await repository_contacts.get_contact_by_id(contact_id, db)
-    if contact is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
-    return contact
+    async def build():
+        contact = await repository_contacts.get_contact_by_id(contact_id, db, current_user)
+        if contact is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
+        return contact
+
+    return await response_cache.respond(request, current_user.id, ContactResponse, build)
 
 
 @router.post("/", response_model=ContactResponse, description='No more than 10 requests per minute',
@@ -94,7 +157,7 @@ async def create_contact(body: ContactModel, db: Session = Depends(get_db),
     """
 The create_contact function creates a new contact in the database.
     It takes an email, phone and name as input parameters.
-    The function returns the newly created contact object.
+    The function returns the newly created contact object, or 409 if the email or phone is already taken.
 
 :param body: ContactModel: Validate the data that is sent in the request body
 :param db: Session: Pass the database connection to the function
@@ -102,11 +165,69 @@ The create_contact function creates a new contact in the database.
 :return: A contactmodel object
 :doc-author: Trelent
 """
-    contact_data = await repository_contacts.verify_email_phone(body.email, body.phone, db)
-    if contact_data:
+    try:
+        return await repository_contacts.create_contact(body, db, current_user)
+    except IntegrityError:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Email or phone is existed')
 
-    return await repository_contacts.create_contact(body, db, current_user)
+
+@router.post("/import", response_model=ContactImportReport, description='No more than 5 requests per minute',
+             dependencies=[Depends(RateLimiter(times=5, seconds=60))])
+async def import_contacts(file: UploadFile = File(),
+                          format: Optional[str] = Query(default=None, regex='^(csv|ndjson)$'),
+                          db: Session = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+The import_contacts function creates contacts in bulk from an uploaded CSV or NDJSON file.
+    The file is read row by row and inserted in large batches; rows with invalid data or an
+    email or phone that already exists are skipped and listed in the report.
+
+:param file: UploadFile: The CSV or NDJSON file with the contacts
+:param format: Optional[str]: csv or ndjson, guessed from the file name when omitted
+:param db: Session: Pass the database connection to the function
+:param current_user: User: Get the current user
+:return: The import report with the imported and failed counts and the row errors
+:doc-author: Trelent
+"""
+    fmt = format or ("csv" if (file.filename or "").lower().endswith(".csv") else "ndjson")
+    return await contacts_io.import_contacts(file.file, fmt, db, current_user)
+
+
+@router.patch("/bulk", response_model=ContactBulkResponse, name='Update many contacts at once')
+async def update_contacts(body: ContactBulkUpdate, db: Session = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+The update_contacts function applies the same partial update to every contact in the selection.
+    Contacts are selected by a list of ids, by first_name, last_name or email, or by both.
+
+:param body: ContactBulkUpdate: The selection and the fields to change
+:param db: Session: Pass the database session to the repository layer
+:param current_user: User: Get the user_id from the jwt token
+:return: The ids of the updated contacts
+:doc-author: Trelent
+"""
+    try:
+        ids = await repository_contacts.update_contacts(body.selection, body.values, db, current_user)
+    except IntegrityError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Email or phone is existed')
+    return {"ids": ids}
+
+
+@router.post("/bulk/delete", response_model=ContactBulkResponse, name='Delete many contacts at once')
+async def remove_contacts(body: ContactSelection, db: Session = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+The remove_contacts function deletes every contact in the selection.
+    Contacts are selected by a list of ids, by first_name, last_name or email, or by both.
+
+:param body: ContactSelection: The ids and/or field values that select the contacts
+:param db: Session: Pass the database session to the repository
+:param current_user: User: Get the current user from the database
+:return: The ids of the deleted contacts
+:doc-author: Trelent
+"""
+    ids = await repository_contacts.remove_contacts(body, db, current_user)
+    return {"ids": ids}
 
 
 @router.put("/{contact_id}", response_model=ContactResponse)
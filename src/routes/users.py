@@ -1,13 +1,11 @@
 from fastapi import APIRouter, Depends, status, UploadFile, File
 from sqlalchemy.orm import Session
-import cloudinary
-import cloudinary.uploader
 
 from src.database.db import get_db
 from src.database.models import User
 from src.repository import users as repository_users
 from src.services.auth import auth_service
-from src.conf.config import settings
+from src.services.avatars import avatar_pipeline
 from src.schemas import UserDb
 
 
@@ -34,22 +32,17 @@ async def update_avatar_user(file: UploadFile = File(), current_user: User = Dep
 The update_avatar_user function updates the avatar of a user.
     The function takes in an UploadFile object, which is a file that has been uploaded to the server.
     It also takes in a User object and Session object as dependencies.
+    The image is checked, cropped to a square avatar and stored by the avatar pipeline off the event loop;
+    uploading the same image again leaves the user untouched.
 
-:param file: UploadFile: Upload the file to cloudinary
+:param file: UploadFile: The image to make the avatar from
 :param current_user: User: Get the current user
 :param db: Session: Access the database
 :return: The updated user object
 :doc-author: Trelent
 """
-    cloudinary.config(
-        cloud_name=settings.cloudinary_name,
-        api_key=settings.cloudinary_api_key,
-        api_secret=settings.cloudinary_api_secret,
-        secure=True
-    )
-    public_id = f'Web9_FastapiAPP/{current_user.username}{current_user.id}'
-    cloudinary.uploader.upload(file.file, public_id=public_id, overwrite=True)
-    src_url = cloudinary.CloudinaryImage(public_id)\
-                        .build_url(width=250, height=250, crop='fill', version=auth_service.r.get('version'))
+    src_url = await avatar_pipeline.process(file)
+    if src_url == current_user.avatar:
+        return current_user
     user = await repository_users.update_avatar(current_user.email, src_url, db)
     return user
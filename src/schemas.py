@@ -1,6 +1,7 @@
 from datetime import datetime, date
+from typing import List, Optional
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, root_validator
 
 
 class ContactModel(BaseModel):
@@ -25,6 +26,58 @@ class ContactResponse(BaseModel):
         orm_mode = True
 
 
+class ContactPage(BaseModel):
+    items: List[ContactResponse]
+    next_cursor: Optional[str] = None
+
+
+class ContactSelection(BaseModel):
+    ids: Optional[List[int]] = Field(default=None, max_items=10000)
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    email: Optional[EmailStr] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_not_empty(cls, values):
+        if all(value is None for value in values.values()):
+            raise ValueError("ids or a filter is required")
+        return values
+
+
+class ContactPartialModel(BaseModel):
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    email: Optional[EmailStr] = None
+    phone: Optional[str] = None
+    date_of_birth: Optional[date] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_not_empty(cls, values):
+        if all(value is None for value in values.values()):
+            raise ValueError("at least one field to update is required")
+        return values
+
+
+class ContactBulkUpdate(BaseModel):
+    selection: ContactSelection
+    values: ContactPartialModel
+
+
+class ContactBulkResponse(BaseModel):
+    ids: List[int]
+
+
+class ContactImportError(BaseModel):
+    line: int
+    detail: str
+
+
+class ContactImportReport(BaseModel):
+    imported: int = 0
+    failed: int = 0
+    errors: List[ContactImportError] = []
+
+
 class UserModel(BaseModel):
     username: str = Field(min_length=5, max_length=16)
     email: str
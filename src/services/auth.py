@@ -1,36 +1,99 @@
+import asyncio
+import hashlib
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from typing import Optional
 
 import redis
-
 from jose import JWTError, jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-import pickle
 
 from src.database.db import get_db
 from src.repository import users as repository_users
 from src.conf.config import settings
+from src.services.refresh_tokens import Rotation, refresh_token_store
+from src.services.user_cache import LRUCache, user_cache
 
 
 class Auth:
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
+    # bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+    hash_executor = ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt")
 
     SECRET_KEY = settings.secret_key_jwt
     ALGORITHM = settings.algorithm
 
     oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
-    r = redis.Redis(host=settings.redis_host,
-                    port=settings.redis_port,
-                    db=0)
+    token_cache = LRUCache(settings.jwt_cache_size, ttl=0)
+
+    async def _run_hasher(self, func, *args):
+        """
+    The _run_hasher function runs a bcrypt call in the hash_executor pool instead of on the event loop.
+    At most password_hash_workers hashes run at once; a call that does not finish within
+    password_hash_timeout seconds (queueing included) is cancelled and answered with 503,
+    so a login burst backs off instead of piling up.
+
+    :param self: Represent the instance of the class
+    :param func: The passlib function to call
+    :param args: Arguments for func
+    :return: Whatever func returns
+    :doc-author: Trelent
+    """
+        future = self.hash_executor.submit(func, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=settings.password_hash_timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many authentication requests, try again later",
+                                headers={"Retry-After": "1"})
 
-    def verify_password(self, plain_password, hashed_password):
-        return self.pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(self, plain_password, hashed_password):
+        return await self._run_hasher(self.pwd_context.verify, plain_password, hashed_password)
 
-    def get_password_hash(self, password: str):
-        return self.pwd_context.hash(password)
+    async def get_password_hash(self, password: str):
+        return await self._run_hasher(self.pwd_context.hash, password)
+
+    def password_needs_update(self, hashed_password: str) -> bool:
+        return self.pwd_context.needs_update(hashed_password)
+
+    def decode_token(self, token: str):
+        """
+    The decode_token function verifies a JWT and returns its claims.
+    Verified claims are cached under a SHA-256 digest of the token until the token's exp,
+    so a client reusing the same token skips the signature check. Invalid tokens are never cached
+    and expired ones drop out of the cache at exp, so both keep raising JWTError.
+
+    :param self: Represent the instance of the class
+    :param token: str: The encoded JWT
+    :return: A read-only mapping of the token claims
+    :doc-author: Trelent
+    """
+        key = hashlib.sha256(token.encode()).digest()
+        claims = self.token_cache.get(key)
+        if claims is None:
+            claims = MappingProxyType(jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM]))
+            ttl = claims.get("exp", 0) - time.time()
+            if ttl > 0:
+                self.token_cache.set(key, claims, ttl=ttl)
+        return claims
+
+    def forget_token(self, token: str):
+        """
+    The forget_token function drops a token from the verified-token cache, e.g. once it has been revoked.
+
+    :param self: Represent the instance of the class
+    :param token: str: The encoded JWT
+    :return: Nothing
+    :doc-author: Trelent
+    """
+        self.token_cache.pop(hashlib.sha256(token.encode()).digest())
 
     # define a function to generate a new access token
     async def create_access_token(self, data: dict, expires_delta: Optional[float] = None):
@@ -58,6 +121,7 @@ class Auth:
     async def create_refresh_token(self, data: dict, expires_delta: Optional[float] = None):
         """
     The create_refresh_token function creates a refresh token for the user.
+        Each call starts a new rotation family in Redis, so every login is an independent session.
         Args:
             data (dict): A dictionary containing the user's id and username.
             expires_delta (Optional[float]): The number of seconds until the token expires, defaults to None.
@@ -68,35 +132,51 @@ class Auth:
     :return: A refresh token that is encoded using the secret_key and algorithm
     :doc-author: Trelent
     """
+        expires_delta = expires_delta or timedelta(days=7).total_seconds()
+        family, jti = uuid.uuid4().hex, uuid.uuid4().hex
+        try:
+            await refresh_token_store.start(family, jti, int(expires_delta))
+        except redis.RedisError:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Session store unavailable")
+        return self._encode_refresh_token(data, family, jti, expires_delta)
+
+    def _encode_refresh_token(self, data: dict, family: str, jti: str, expires_delta: float):
         to_encode = data.copy()
-        if expires_delta:
-            expire = datetime.utcnow() + timedelta(seconds=expires_delta)
-        else:
-            expire = datetime.utcnow() + timedelta(days=7)
-        to_encode.update({"iat": datetime.utcnow(), "exp": expire, "scope": "refresh_token"})
-        encoded_refresh_token = jwt.encode(to_encode, self.SECRET_KEY, algorithm=self.ALGORITHM)
-        return encoded_refresh_token
+        expire = datetime.utcnow() + timedelta(seconds=expires_delta)
+        to_encode.update({"iat": datetime.utcnow(), "exp": expire, "scope": "refresh_token", "fam": family,
+                          "jti": jti})
+        return jwt.encode(to_encode, self.SECRET_KEY, algorithm=self.ALGORITHM)
 
-    async def decode_refresh_token(self, refresh_token: str):
+    async def rotate_refresh_token(self, refresh_token: str, expires_delta: Optional[float] = None):
         """
-    The decode_refresh_token function is used to decode the refresh token.
-    It takes a refresh_token as an argument and returns the email of the user if it's valid.
-    If not, it raises an HTTPException with status code 401 (UNAUTHORIZED) and detail 'Could not validate credentials'.
-
+    The rotate_refresh_token function exchanges a refresh token for its successor in the same rotation family.
+    The old token is consumed; presenting it again revokes the whole family, so a stolen token stops working
+    for both the thief and the owner as soon as either of them uses it after the other.
+    Only Redis is touched, the users table is not written.
 
-    :param self: Represent the instance of a class
-    :param refresh_token: str: Pass the refresh token to the function
-    :return: The email of the user
+    :param self: Represent the instance of the class
+    :param refresh_token: str: The refresh token sent by the client
+    :param expires_delta: Optional[float]: Set the expiry time of the new token in seconds
+    :return: The email of the user and the new refresh token
     :doc-author: Trelent
     """
         try:
-            payload = jwt.decode(refresh_token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
-            if payload['scope'] == 'refresh_token':
-                email = payload['sub']
-                return email
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid scope for token')
+            payload = self.decode_token(refresh_token)
         except JWTError:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate credentials')
+        if payload.get('scope') != 'refresh_token' or 'fam' not in payload or 'jti' not in payload:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid scope for token')
+        expires_delta = expires_delta or timedelta(days=7).total_seconds()
+        jti = uuid.uuid4().hex
+        try:
+            outcome = await refresh_token_store.rotate(payload['fam'], payload['jti'], jti, int(expires_delta))
+        except redis.RedisError:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Session store unavailable")
+        finally:
+            self.forget_token(refresh_token)
+        if outcome is not Rotation.ROTATED:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+        return payload['sub'], self._encode_refresh_token({"sub": payload['sub']}, payload['fam'], jti, expires_delta)
 
     async def get_current_user(self, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
         """
@@ -107,7 +187,7 @@ class Auth:
     :param self: Represent the instance of the class
     :param token: str: Get the token from the authorization header
     :param db: Session: Get the database session
-    :return: A user object, which is used to identify the user
+    :return: A UserSnapshot of the user, served from the Redis user cache when possible
     :doc-author: Trelent
     """
         credentials_exception = HTTPException(
@@ -118,7 +198,7 @@ class Auth:
 
         try:
             # Decode JWT
-            payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+            payload = self.decode_token(token)
             if payload['scope'] == 'access_token':
                 email = payload["sub"]
                 if email is None:
@@ -128,17 +208,12 @@ class Auth:
         except JWTError as e:
             raise credentials_exception
 
-        user = self.r.get(f"user:{email}")
-        print(f'User get from Cashe')
+        user = await user_cache.get(email)
         if user is None:
             user = await repository_users.get_user_by_email(email, db)
-            print(f'User get from Postgres_Db')
             if user is None:
                 raise credentials_exception
-            self.r.set(f"user:{email}", pickle.dumps(user))
-            self.r.expire(f"user:{email}", 900)
-        else:
-            user = pickle.loads(user)
+            user = await user_cache.set(user)
         return user
 
     def create_email_token(self, data: dict):
@@ -170,7 +245,7 @@ class Auth:
     :doc-author: Trelent
     """
         try:
-            payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+            payload = self.decode_token(token)
             email = payload["sub"]
             return email
         except JWTError as e:
@@ -0,0 +1,112 @@
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import cloudinary
+import cloudinary.uploader
+
+from src.conf.config import Settings
+
+CONTENT_TYPE = "image/webp"
+
+
+class AvatarStorage(ABC):
+    """
+    Where avatar files are kept. Names are content hashes, so a name that is already stored holds the
+    same bytes and put() leaves it alone. Methods block and are run in the avatar pipeline's thread pool.
+    """
+
+    @property
+    @abstractmethod
+    def kind(self) -> str:
+        """Short backend name; it namespaces the cached URLs."""
+
+    @abstractmethod
+    def put(self, name: str, data: bytes) -> str:
+        """Store data under name unless it is already there and return its public URL."""
+
+
+class CloudinaryStorage(AvatarStorage):
+    """Cloudinary uploads with overwrite disabled: an existing public id is kept and its URL returned."""
+
+    kind = "cloudinary"
+
+    def __init__(self, folder: str, cloud_name: str, api_key: int, api_secret: str):
+        self.folder = folder
+        cloudinary.config(cloud_name=cloud_name, api_key=api_key, api_secret=api_secret, secure=True)
+
+    def put(self, name: str, data: bytes) -> str:
+        public_id = f"{self.folder}/{name.rpartition('.')[0]}"
+        return cloudinary.uploader.upload(data, public_id=public_id, overwrite=False, format="webp")["secure_url"]
+
+
+class LocalStorage(AvatarStorage):
+    """Files in a local folder, served by the app under base_url."""
+
+    kind = "local"
+
+    def __init__(self, root: str | Path, base_url: str):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip("/")
+
+    def put(self, name: str, data: bytes) -> str:
+        path = self.root / name
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # write next to the target and rename, so a reader never sees a partial file
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return f"{self.base_url}/{name}"
+
+
+class S3Storage(AvatarStorage):
+    """Objects in an S3-compatible bucket (AWS, MinIO, R2...). Needs boto3, installed with the `s3` extra."""
+
+    kind = "s3"
+
+    def __init__(self, bucket: str, prefix: str, public_url: str, client=None, **client_options):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", **client_options)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/")
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def put(self, name: str, data: bytes) -> str:
+        key = f"{self.prefix}/{name}"
+        if not self.exists(key):
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=CONTENT_TYPE,
+                                   CacheControl="public, max-age=31536000, immutable")
+        return f"{self.public_url}/{key}"
+
+
+def create_avatar_storage(config: Settings) -> AvatarStorage:
+    if config.avatar_storage == "cloudinary":
+        return CloudinaryStorage(config.avatar_folder, config.cloudinary_name, config.cloudinary_api_key,
+                                 config.cloudinary_api_secret)
+    if config.avatar_storage == "local":
+        return LocalStorage(config.avatar_local_dir, config.avatar_local_url)
+    if config.avatar_storage == "s3":
+        options = {"endpoint_url": config.avatar_s3_endpoint_url, "region_name": config.avatar_s3_region,
+                   "aws_access_key_id": config.avatar_s3_access_key,
+                   "aws_secret_access_key": config.avatar_s3_secret_key}
+        return S3Storage(config.avatar_s3_bucket, config.avatar_folder, config.avatar_s3_public_url,
+                         **{key: value for key, value in options.items() if value})
+    raise ValueError(f"Unknown avatar storage {config.avatar_storage!r}")
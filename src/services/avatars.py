@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import redis.asyncio as redis
+from fastapi import HTTPException, UploadFile, status
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from src.conf.config import settings
+from src.database.redis_pool import redis_client
+from src.services.avatar_storage import AvatarStorage, create_avatar_storage
+
+logger = logging.getLogger(__name__)
+
+# Leading bytes of the formats accepted as avatars.
+SIGNATURES = {
+    b"\xff\xd8\xff": "JPEG",
+    b"\x89PNG\r\n\x1a\n": "PNG",
+    b"GIF87a": "GIF",
+    b"GIF89a": "GIF",
+}
+
+
+def sniff(head: bytes) -> str | None:
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return next((kind for signature, kind in SIGNATURES.items() if head.startswith(signature)), None)
+
+
+class AvatarPipeline:
+    """
+    Turns an uploaded image into a size x size avatar and puts it in the avatar storage.
+
+    The upload is read in chunks: it is rejected with 415 unless it starts like a JPEG, PNG, GIF or WebP
+    file, and with 413 as soon as it grows past max_bytes or declares more than max_pixels pixels.
+    Decoding, cropping and re-encoding run in a thread pool, and so does the blocking storage call,
+    so the event loop never waits on them; at most `workers` avatars are processed at once and a job that
+    does not finish within `timeout` seconds (queueing included) is answered with 503.
+
+    Avatars are named by a hash of the uploaded bytes and of the size and quality they are rendered at,
+    and each name's URL is kept in Redis for url_ttl seconds: uploading the same image again is answered
+    from there without decoding or storing anything.
+    """
+
+    def __init__(self, storage: AvatarStorage, client: redis.Redis, size: int, max_bytes: int, max_pixels: int,
+                 quality: int, workers: int, timeout: float, url_ttl: int, chunk_size: int = 64 * 1024):
+        self.storage = storage
+        self.redis = client
+        self.url_ttl = url_ttl
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="avatar")
+
+    async def read(self, file: UploadFile) -> bytes:
+        buffer = bytearray()
+        while chunk := await file.read(self.chunk_size):
+            if not buffer and sniff(chunk[:12]) is None:
+                raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                                    detail="Avatar must be a JPEG, PNG, GIF or WebP image")
+            buffer += chunk
+            if len(buffer) > self.max_bytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"Avatar must not exceed {self.max_bytes // (1024 * 1024)} MB")
+        if not buffer:
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Avatar file is empty")
+        return bytes(buffer)
+
+    def resize(self, data: bytes) -> bytes:
+        """Center-crop and scale an image to size x size and encode it as WebP. Runs in the executor."""
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if image.width * image.height > self.max_pixels:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                        detail="Avatar has too many pixels")
+                # JPEG can decode straight to a smaller scale, which is most of the work for phone photos
+                image.draft("RGB", (self.size * 2, self.size * 2))
+                image = ImageOps.exif_transpose(image)
+                image = ImageOps.fit(image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB"),
+                                     (self.size, self.size), Image.LANCZOS)
+                out = io.BytesIO()
+                image.save(out, format="WEBP", quality=self.quality)
+                return out.getvalue()
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Avatar image is invalid")
+
+    def name(self, data: bytes) -> str:
+        digest = hashlib.sha256(f"{self.size}:{self.quality}:".encode())
+        digest.update(data)
+        return f"{digest.hexdigest()}.webp"
+
+    def url_key(self, name: str) -> str:
+        return f"avatars:{self.storage.kind}:{name}"
+
+    async def cached_url(self, name: str) -> str | None:
+        try:
+            url = await self.redis.get(self.url_key(name))
+        except redis.RedisError as err:
+            logger.warning("avatar url get failed: %s", err)
+            return None
+        return None if url is None else url.decode()
+
+    async def cache_url(self, name: str, url: str) -> None:
+        try:
+            await self.redis.set(self.url_key(name), url, ex=self.url_ttl)
+        except redis.RedisError as err:
+            logger.warning("avatar url set failed: %s", err)
+
+    async def _run(self, func, *args):
+        future = self.executor.submit(func, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many avatar uploads, try again later", headers={"Retry-After": "5"})
+
+    async def process(self, file: UploadFile) -> str:
+        """Validate, resize and store an avatar and return its URL."""
+        data = await self.read(file)
+        name = self.name(data)
+        url = await self.cached_url(name)
+        if url is None:
+            avatar = await self._run(self.resize, data)
+            url = await self._run(self.storage.put, name, avatar)
+            await self.cache_url(name, url)
+        return url
+
+
+avatar_pipeline = AvatarPipeline(create_avatar_storage(settings), redis_client, size=settings.avatar_size,
+                                 max_bytes=settings.avatar_max_bytes, max_pixels=settings.avatar_max_pixels,
+                                 quality=settings.avatar_quality, workers=settings.avatar_workers,
+                                 timeout=settings.avatar_timeout, url_ttl=settings.avatar_url_ttl)
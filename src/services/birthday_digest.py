@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Awaitable, Callable, Iterable
+
+import orjson
+import redis.asyncio as redis
+
+from src.conf.config import settings
+from src.database.models import Contact, birthday_key, birthday_window
+from src.database.redis_pool import redis_client
+from src.schemas import ContactResponse
+
+logger = logging.getLogger(__name__)
+
+DIGEST_VERSION = 1
+
+
+def in_window(key: int, window: tuple[int, int, bool]) -> bool:
+    start, end, wraps = window
+    return key >= start or key <= end if wraps else start <= key <= end
+
+
+def sort_key(entry: dict, window: tuple[int, int, bool]) -> tuple:
+    start, _, wraps = window
+    return (1 if wraps and entry["key"] < start else 0), entry["key"], entry["contact"]["id"]
+
+
+class BirthdayDigest:
+    """
+    Per-user, per-day list of the contacts whose birthday falls in the next `days` days, kept in Redis.
+
+    A digest is built from the database once a day (by the daily job or on the first read) and then
+    patched in place by single contact writes; bulk writes drop it so the next read rebuilds it.
+    Entries hold the birthday_key and the serialized ContactResponse, ordered like get_contact_birthday,
+    so a shorter window is a filter over the same list. If a user has more than `size` contacts in
+    the window the digest is marked truncated and reads past its end go to the database.
+    """
+
+    def __init__(self, client: redis.Redis, days: int, size: int, ttl: int):
+        self.redis = client
+        self.days = days
+        self.size = size
+        self.ttl = ttl
+
+    @staticmethod
+    def key(user_id: int, today: date) -> str:
+        return f"birthdays:v{DIGEST_VERSION}:{user_id}:{today.isoformat()}"
+
+    @staticmethod
+    def entry(contact: Contact) -> dict:
+        return {"key": birthday_key(contact.date_of_birth), "contact": ContactResponse.from_orm(contact).dict()}
+
+    async def get(self, user_id: int, today: date) -> dict | None:
+        try:
+            data = await self.redis.get(self.key(user_id, today))
+        except redis.RedisError as err:
+            logger.warning("birthday digest get failed: %s", err)
+            return None
+        return None if data is None else orjson.loads(data)
+
+    async def store(self, user_id: int, today: date, contacts: Iterable[Contact]) -> dict:
+        entries = [self.entry(contact) for contact in contacts]
+        data = orjson.dumps({"truncated": len(entries) > self.size, "entries": entries[:self.size]})
+        try:
+            await self.redis.set(self.key(user_id, today), data, ex=self.ttl)
+        except redis.RedisError as err:
+            logger.warning("birthday digest store failed: %s", err)
+        return orjson.loads(data)
+
+    def select(self, digest: dict, today: date, days: int, skip: int, limit: int) -> list[dict] | None:
+        """
+        Return the contacts of a digest within days of today, or None if a truncated digest
+        cannot answer the requested page.
+        """
+        window = birthday_window(today, days)
+        contacts = [entry["contact"] for entry in digest["entries"] if in_window(entry["key"], window)]
+        if digest["truncated"] and skip + limit > len(contacts):
+            return None
+        return contacts[skip:skip + limit]
+
+    async def _patch(self, user_id: int, today: date, change: Callable[[dict], None]) -> None:
+        key = self.key(user_id, today)
+
+        async def apply(pipe):
+            data = await pipe.get(key)
+            if data is None:
+                return
+            digest = orjson.loads(data)
+            change(digest)
+            pipe.multi()
+            pipe.set(key, orjson.dumps(digest), ex=self.ttl)
+
+        try:
+            await self.redis.transaction(apply, key)
+        except redis.RedisError as err:
+            logger.warning("birthday digest patch failed, dropping it: %s", err)
+            await self.invalidate(user_id, today)
+
+    async def upsert(self, contact: Contact, today: date | None = None) -> None:
+        today = today or date.today()
+        window = birthday_window(today, self.days)
+
+        def change(digest):
+            entries = [e for e in digest["entries"] if e["contact"]["id"] != contact.id]
+            key = birthday_key(contact.date_of_birth)
+            entry = self.entry(contact) if key is not None and in_window(key, window) else None
+            # past the end of a truncated digest the database may hold contacts it never stored
+            if entry is not None and digest["truncated"] and \
+                    (not entries or sort_key(entry, window) > sort_key(entries[-1], window)):
+                entry = None
+            if entry is not None:
+                entries.append(entry)
+                entries.sort(key=lambda e: sort_key(e, window))
+                if len(entries) > self.size:
+                    digest["truncated"] = True
+                    entries = entries[:self.size]
+            digest["entries"] = entries
+
+        await self._patch(contact.user_id, today, change)
+
+    async def discard(self, user_id: int, contact_id: int, today: date | None = None) -> None:
+        def change(digest):
+            digest["entries"] = [e for e in digest["entries"] if e["contact"]["id"] != contact_id]
+
+        await self._patch(user_id, today or date.today(), change)
+
+    async def invalidate(self, user_id: int, today: date | None = None) -> None:
+        try:
+            await self.redis.delete(self.key(user_id, today or date.today()))
+        except redis.RedisError as err:
+            logger.warning("birthday digest invalidate failed: %s", err)
+
+    async def claim_day(self, today: date) -> bool:
+        """Let only one worker run the daily rebuild for today."""
+        try:
+            return bool(await self.redis.set(f"birthdays:v{DIGEST_VERSION}:rebuild:{today.isoformat()}", 1,
+                                             nx=True, ex=self.ttl))
+        except redis.RedisError as err:
+            logger.warning("birthday digest claim failed: %s", err)
+            return False
+
+    async def run_daily(self, rebuild: Callable[[date], Awaitable[None]]) -> None:
+        """Call rebuild(today) shortly after every midnight, in one worker only."""
+        while True:
+            today = date.today()
+            if await self.claim_day(today):
+                try:
+                    await rebuild(today)
+                except Exception:
+                    logger.exception("birthday digest rebuild failed")
+            next_run = datetime.combine(today + timedelta(days=1), time.min)
+            await asyncio.sleep(max((next_run - datetime.now()).total_seconds(), 1))
+
+
+birthday_digest = BirthdayDigest(redis_client, days=settings.birthday_digest_days,
+                                 size=settings.birthday_digest_size, ttl=settings.birthday_digest_ttl)
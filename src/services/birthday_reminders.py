@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import uuid
+from datetime import date, datetime
+from itertools import groupby
+from typing import AsyncIterator, Awaitable, Callable
+
+import redis.asyncio as redis
+
+from src.conf.config import settings
+from src.database.db import SessionLocal, maybe_await
+from src.database.redis_pool import close_redis, redis_client
+from src.repository import contacts as repository_contacts
+from src.services.email import BIRTHDAY_REMINDER, mail_outbox
+from src.services.mail_outbox import MailOutbox
+
+logger = logging.getLogger(__name__)
+
+REMINDERS_VERSION = 1
+CHECKPOINT_TTL = 2 * 24 * 3600
+
+# Delete the lease only if it still holds this worker's token: after it ran out another worker may own it.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class BirthdayReminders:
+    """
+    Daily email digest of each user's contacts with a birthday in the next `days` days.
+
+    Once a day, from `hour` o'clock, one worker takes a lease on the day and streams the matching contacts
+    ordered by owner, batch_size rows at a time. A user's digest is queued in the mail outbox as soon as all of
+    their contacts have been read, and the id of the last user queued is saved as the day's checkpoint, which
+    also renews the lease. If the worker dies, the lease runs out after `lease` seconds and the next worker to
+    poll resumes after the checkpoint; a user queued right before the crash is not mailed twice, because the
+    outbox drops a second digest for the same address and day. The day is part of that dedup key, so a run
+    that finishes late never blocks the next day's digests.
+    """
+
+    def __init__(self, client: redis.Redis, outbox: MailOutbox, days: int, hour: int, batch_size: int, lease: int,
+                 poll_interval: float, clock: Callable[[], datetime] = datetime.now):
+        self.redis = client
+        self.outbox = outbox
+        self.days = days
+        self.hour = hour
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.tokens: dict[date, str] = {}
+        self._release = client.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def key(today: date) -> str:
+        return f"birthdays:v{REMINDERS_VERSION}:reminders:{today.isoformat()}"
+
+    def lock_key(self, today: date) -> str:
+        return f"{self.key(today)}:lock"
+
+    async def checkpoint(self, today: date) -> tuple[int, bool]:
+        """Return the id of the last user queued today and whether today's run is finished."""
+        data = await self.redis.hgetall(self.key(today))
+        return int(data.get(b"user_id", 0)), data.get(b"done") == b"1"
+
+    async def save(self, today: date, user_id: int, done: bool = False) -> None:
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key(today), mapping={"user_id": user_id, "done": int(done)})
+        pipe.expire(self.key(today), CHECKPOINT_TTL)
+        pipe.expire(self.lock_key(today), self.lease)
+        await pipe.execute()
+
+    async def claim(self, today: date) -> bool:
+        token = uuid.uuid4().hex
+        if not await self.redis.set(self.lock_key(today), token, nx=True, ex=self.lease):
+            return False
+        self.tokens[today] = token
+        return True
+
+    async def release(self, today: date) -> None:
+        token = self.tokens.pop(today, None)
+        if token is not None:
+            await self._release(keys=[self.lock_key(today)], args=[token], client=self.redis)
+
+    async def _queue(self, today: date, rows: list) -> int:
+        async def queue(user_rows: list) -> bool:
+            contacts = [{"first_name": row.first_name, "last_name": row.last_name,
+                         "date_of_birth": row.date_of_birth.isoformat()} for row in user_rows]
+            return await self.outbox.enqueue(BIRTHDAY_REMINDER, user_rows[0].email,
+                                             {"username": user_rows[0].username, "days": self.days,
+                                              "contacts": contacts},
+                                             dedup_ttl=CHECKPOINT_TTL, dedup_id=today.isoformat())
+
+        results = await asyncio.gather(*(queue(list(user_rows))
+                                         for _, user_rows in groupby(rows, key=lambda row: row.user_id)))
+        return sum(results)
+
+    async def send(self, today: date, stream: Callable[[int], AsyncIterator[list]]) -> int:
+        """
+        Queue today's digests from stream(after_user_id), which yields batches of rows ordered by user_id,
+        starting after the checkpoint. Return the number of digests queued.
+        """
+        after, done = await self.checkpoint(today)
+        if done:
+            return 0
+        queued = 0
+        pending = []
+        async for batch in stream(after):
+            rows = pending + list(batch)
+            # the last user of a batch may have more contacts in the next one
+            split = next(i for i, row in enumerate(rows) if row.user_id == rows[-1].user_id)
+            complete, pending = rows[:split], rows[split:]
+            if complete:
+                queued += await self._queue(today, complete)
+                await self.save(today, complete[-1].user_id)
+        if pending:
+            queued += await self._queue(today, pending)
+        await self.save(today, pending[-1].user_id if pending else after, done=True)
+        return queued
+
+    async def run_daily(self, send_day: Callable[[date], Awaitable[int]]) -> None:
+        """Every poll_interval seconds, call send_day(today) if today's reminders are due and not sent yet."""
+        while True:
+            now = self.clock()
+            today = now.date()
+            try:
+                if now.hour >= self.hour and not (await self.checkpoint(today))[1] and await self.claim(today):
+                    try:
+                        logger.info("queued %d birthday reminders for %s", await send_day(today), today)
+                    finally:
+                        await self.release(today)
+            except redis.RedisError as err:
+                logger.warning("birthday reminders unavailable, retrying: %s", err)
+            except Exception:
+                logger.exception("birthday reminders failed, resuming at the next poll")
+            await asyncio.sleep(self.poll_interval)
+
+
+birthday_reminders = BirthdayReminders(redis_client, mail_outbox, days=settings.birthday_reminder_days,
+                                       hour=settings.birthday_reminder_hour,
+                                       batch_size=settings.birthday_reminder_batch_size,
+                                       lease=settings.birthday_reminder_lease,
+                                       poll_interval=settings.birthday_reminder_poll_interval)
+
+
+async def send_birthday_reminders(today: date) -> int:
+    """
+The send_birthday_reminders function queues today's birthday digests in its own database session,
+    resuming after the last user a previous run got to.
+
+:param today: date: The day the reminders are for
+:return: The number of digests queued
+:doc-author: Trelent
+"""
+    db = SessionLocal()
+    try:
+        return await birthday_reminders.send(
+            today, lambda after: repository_contacts.stream_upcoming_birthdays(db, today, birthday_reminders.days,
+                                                                               after, birthday_reminders.batch_size))
+    finally:
+        await maybe_await(db.close())
+
+
+async def run_birthday_reminders():
+    """
+The run_birthday_reminders function sends the daily birthday digests until it is cancelled.
+    It runs inside the API when settings.birthday_reminder_in_process is set, or on its own with
+    python -m src.services.birthday_reminders; only one worker sends a given day's digests.
+
+:return: Nothing
+:doc-author: Trelent
+"""
+    await birthday_reminders.run_daily(send_birthday_reminders)
+
+
+if __name__ == "__main__":
+    async def main():
+        try:
+            await run_birthday_reminders()
+        finally:
+            await close_redis()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import math
+from typing import AsyncIterator, Iterable
+
+import redis.asyncio as redis
+
+from src.conf.config import settings
+from src.database.redis_pool import redis_client
+
+logger = logging.getLogger(__name__)
+
+FILTER_VERSION = 1
+
+
+class BloomFilter:
+    """
+    Bloom filter kept in a Redis bitmap, so every worker shares it and adds are visible at once.
+
+    It is sized for `capacity` items at `error_rate` false positives. Bits are only ever set: items
+    added while rebuild() scans the source of truth land in the same bitmap, and rebuild() marks the
+    filter ready only after the scan, so a "definitely absent" answer is never given before that.
+    Until then, and whenever Redis is unavailable, might_contain() answers True and callers fall back
+    to the database.
+
+    The key holds the bitmap size and hash count, so a new capacity or error rate starts an empty filter
+    that is rebuilt before use instead of reading the old bitmap with the wrong positions.
+    """
+
+    def __init__(self, client: redis.Redis, name: str, capacity: int, error_rate: float):
+        self.redis = client
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.key = f"bloom:v{FILTER_VERSION}:{name}:{self.size}:{self.hashes}"
+        self.ready_key = f"{self.key}:ready"
+        self.rebuild_key = f"{self.key}:rebuild"
+
+    def positions(self, item: str) -> list[int]:
+        # double hashing (Kirsch-Mitzenmacher): k positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def _set_bits(self, pipe, items: Iterable[str]) -> None:
+        for item in items:
+            for position in self.positions(item):
+                pipe.setbit(self.key, position, 1)
+
+    async def add(self, item: str) -> None:
+        """
+        Add an item. Redis errors are raised: callers must add an item before storing it, as a filter
+        that misses a stored item would report it as absent.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self._set_bits(pipe, [item])
+        await pipe.execute()
+
+    async def might_contain(self, item: str) -> bool:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(self.ready_key)
+        for position in self.positions(item):
+            pipe.getbit(self.key, position)
+        try:
+            ready, *bits = await pipe.execute()
+        except redis.RedisError as err:
+            logger.warning("bloom filter lookup failed: %s", err)
+            return True
+        return not ready or all(bits)
+
+    async def claim_rebuild(self) -> bool:
+        """Let only one worker rebuild a filter that is not ready yet."""
+        try:
+            if await self.redis.exists(self.ready_key):
+                return False
+            return bool(await self.redis.set(self.rebuild_key, 1, nx=True, ex=3600))
+        except redis.RedisError as err:
+            logger.warning("bloom filter claim failed: %s", err)
+            return False
+
+    async def rebuild(self, batches: AsyncIterator[list[str]]) -> None:
+        async for batch in batches:
+            pipe = self.redis.pipeline(transaction=False)
+            self._set_bits(pipe, batch)
+            await pipe.execute()
+        await self.redis.set(self.ready_key, 1)
+        await self.redis.delete(self.rebuild_key)
+
+
+registered_emails = BloomFilter(redis_client, "users:emails", capacity=settings.user_bloom_capacity,
+                                error_rate=settings.user_bloom_error_rate)
@@ -0,0 +1,167 @@
+import csv
+import io
+import json
+import zlib
+from typing import AsyncIterator, BinaryIO, Iterator
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+
+from src.conf.config import settings
+from src.database.models import User
+from src.repository import contacts as repository_contacts
+from src.schemas import ContactModel
+
+
+def read_records(file: BinaryIO, fmt: str) -> Iterator[tuple[int, dict | Exception]]:
+    """
+The read_records function reads an uploaded CSV or NDJSON file one record at a time.
+    CSV files need a header row with the ContactModel field names. NDJSON files hold one
+    JSON object per line and blank lines are skipped. A record that cannot be parsed is
+    yielded as the exception, so one bad line does not stop the import. Lines are decoded
+    one at a time, so a line that is not UTF-8 is reported by its own number; in a CSV file
+    it, like any other error of the CSV reader, ends the import at that record.
+
+:param file: BinaryIO: The uploaded file
+:param fmt: str: Either csv or ndjson
+:return: An iterator of (line number the record starts on, record or exception) pairs
+:doc-author: Trelent
+"""
+    if fmt == "csv":
+        reader = csv.reader(data.decode("utf-8") for data in file)
+        line = 1
+        try:
+            header = next(reader, None)
+            line = reader.line_num + 1
+            for values in reader:
+                if values:
+                    yield line, dict(zip(header, values))
+                # quoted fields can span lines, so the next record starts after the lines read so far
+                line = reader.line_num + 1
+        except (UnicodeDecodeError, csv.Error) as err:
+            yield line, ValueError(f"Unreadable CSV, the rest of the file was not imported: {err}")
+    else:
+        for line, data in enumerate(file, start=1):
+            try:
+                text_line = data.decode("utf-8")
+                if not text_line.strip():
+                    continue
+                yield line, json.loads(text_line)
+            except ValueError as err:
+                yield line, err
+
+
+def _error_detail(err: Exception) -> str:
+    if isinstance(err, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in err.errors())
+    return str(err)
+
+
+def _parse_batch(records: Iterator[tuple[int, dict | Exception]], size: int) -> tuple[list, list, bool]:
+    """Validate up to size records (in the thread pool); return the valid ones, the errors and if the file ended."""
+    valid, errors = [], []
+    for line, record in records:
+        if isinstance(record, Exception):
+            errors.append((line, _error_detail(record)))
+        else:
+            try:
+                valid.append((line, ContactModel.parse_obj(record)))
+            except ValidationError as err:
+                errors.append((line, _error_detail(err)))
+        if len(valid) + len(errors) >= size:
+            return valid, errors, False
+    return valid, errors, True
+
+
+async def import_contacts(file: BinaryIO, fmt: str, db: Session, user: User) -> dict:
+    """
+The import_contacts function streams contacts from an uploaded file into the database.
+    Records are read and validated with ContactModel in the thread pool, settings.contacts_import_batch_size
+    at a time, so parsing a large file does not hold the event loop, and the valid ones of each batch are
+    inserted together, so memory stays flat whatever the file size. Records that fail validation or clash
+    with an existing email or phone are reported by the line they start on, up to
+    settings.contacts_import_max_errors of them.
+
+:param file: BinaryIO: The uploaded file
+:param fmt: str: Either csv or ndjson
+:param db: Session: Access the database
+:param user: User: The owner of the imported contacts
+:return: A dictionary with the imported and failed counts and the errors by line
+:doc-author: Trelent
+"""
+    report = {"imported": 0, "failed": 0, "errors": []}
+
+    def fail(line: int, detail: str):
+        report["failed"] += 1
+        if len(report["errors"]) < settings.contacts_import_max_errors:
+            report["errors"].append({"line": line, "detail": detail})
+
+    async def flush(batch: list):
+        if not batch:
+            return
+        inserted = await repository_contacts.create_contacts([body for _, body in batch], db, user)
+        for line, body in batch:
+            if body.email in inserted:
+                inserted.discard(body.email)
+                report["imported"] += 1
+            else:
+                fail(line, "Email or phone is existed")
+
+    records = read_records(file, fmt)
+    done = False
+    while not done:
+        valid, errors, done = await run_in_threadpool(_parse_batch, records, settings.contacts_import_batch_size)
+        for line, detail in errors:
+            fail(line, detail)
+        await flush(valid)
+    return report
+
+
+EXPORT_COLUMNS = ("id", "first_name", "last_name", "email", "phone", "date_of_birth", "created_at", "updated_at")
+
+
+async def export_contacts(db: Session, user: User, fmt: str, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+The export_contacts function streams the user's whole address book as CSV or NDJSON.
+    Contacts are read from a server-side cursor in batches of settings.contacts_export_batch_size
+    and each batch is encoded and yielded as one chunk, optionally gzip compressed.
+
+:param db: Session: Access the database
+:param user: User: The owner of the exported contacts
+:param fmt: str: Either csv or ndjson
+:param compress: bool: Gzip the output
+:return: An async iterator of encoded chunks
+:doc-author: Trelent
+"""
+    gzip = zlib.compressobj(wbits=31) if compress else None
+
+    def encode(text: str) -> bytes:
+        data = text.encode("utf-8")
+        return gzip.compress(data) if gzip else data
+
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+    else:
+        buffer, writer = None, None
+
+    async for rows in repository_contacts.stream_contacts(db, user, EXPORT_COLUMNS,
+                                                          settings.contacts_export_batch_size):
+        if writer:
+            writer.writerows(rows)
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            chunk = "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str) + "\n" for row in rows)
+        encoded = encode(chunk)
+        if encoded:
+            yield encoded
+
+    tail = encode(buffer.getvalue()) if writer else b""
+    if gzip:
+        tail += gzip.flush()
+    if tail:
+        yield tail
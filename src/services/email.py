@@ -1,11 +1,23 @@
+import asyncio
+import logging
+import os
+import socket
+from email.message import EmailMessage
+from email.utils import formataddr
 from pathlib import Path
 
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
-from fastapi_mail.errors import ConnectionErrors
+import redis.asyncio as redis
+from fastapi_mail import ConnectionConfig
 from pydantic import EmailStr
 
 from src.services.auth import auth_service
 from src.conf.config import settings
+from src.database.redis_pool import close_redis, redis_client
+from src.services.mail_outbox import MailOutbox, MailSender
+from src.services.mail_templates import TemplateRegistry
+from src.services.smtp_pool import SMTPPool
+
+logger = logging.getLogger(__name__)
 
 conf = ConnectionConfig(
     MAIL_USERNAME=settings.mail_username,
@@ -22,31 +34,105 @@ conf = ConnectionConfig(
 
 )
 
+CONFIRM_EMAIL = "confirm_email"
+BIRTHDAY_REMINDER = "birthday_reminder"
+
+mail_templates = TemplateRegistry(conf.TEMPLATE_FOLDER, locales={locale: {} for locale in settings.mail_locales},
+                                  default_locale=settings.mail_default_locale)
+
+mail_outbox = MailOutbox(redis_client, dedup_ttl=settings.mail_dedup_ttl, max_len=settings.mail_outbox_max_len)
+
 
-async def send_email(email: EmailStr, username: str, host: str):
+async def send_email(email: EmailStr, username: str, host: str) -> bool:
     """
-The send_email function sends an email to the user with a link to confirm their email address.
-    The function takes in three parameters:
-        -email: EmailStr, the user's email address.
-        -username: str, the username of the user who is registering for an account.  This will be used in a greeting message within the body of the email sent to them.
-        -host: str, this is where we are hosting our application (i.e., localhost).  This will be used as part of a URL that they can click on within their browser.
+The send_email function queues an email to the user with a link to confirm their email address.
+    The message is written to the mail outbox in Redis and sent by the mail worker, so the request
+    only pays for one Redis round trip. A confirmation email queued for the same address within
+    settings.mail_dedup_ttl seconds is not queued again.
 
 :param email: EmailStr: Specify the email address of the recipient
 :param username: str: Pass the username to the template
 :param host: str: Pass the hostname to the template
-:return: A coroutine which is a special type of object that can be used with await or yield from
+:return: True if the email was queued, False if it was a duplicate or the outbox is unavailable
+:doc-author: Trelent
+"""
+    try:
+        return await mail_outbox.enqueue(CONFIRM_EMAIL, email, {"username": username, "host": str(host)})
+    except redis.RedisError as err:
+        logger.error("could not queue confirmation email to %s: %s", email, err)
+        return False
+
+
+async def render_confirmation_email(email: str, data: dict) -> EmailMessage:
+    """
+The render_confirmation_email function builds the confirmation email for an outbox entry.
+    The verification token is created here, when the email is sent, not when it was queued.
+
+:param email: str: The address of the recipient
+:param data: dict: The username and host the email was queued with
+:return: The message, ready to be sent
+:doc-author: Trelent
+"""
+    token_verification = auth_service.create_email_token({"sub": email})
+    message = EmailMessage()
+    message["Subject"] = "Confirm your email "
+    message["From"] = formataddr((conf.MAIL_FROM_NAME, conf.MAIL_FROM))
+    message["To"] = email
+    message.set_content(mail_templates.render("email_template.html", data.get("locale"), host=data["host"],
+                                              username=data["username"], token=token_verification),
+                        subtype="html")
+    return message
+
+
+async def render_birthday_reminder(email: str, data: dict) -> EmailMessage:
+    """
+The render_birthday_reminder function builds the daily digest of a user's upcoming contact birthdays.
+
+:param email: str: The address of the recipient
+:param data: dict: The username, the window in days and the contacts it was queued with
+:return: The message, ready to be sent
+:doc-author: Trelent
+"""
+    message = EmailMessage()
+    message["Subject"] = "Upcoming birthdays of your contacts"
+    message["From"] = formataddr((conf.MAIL_FROM_NAME, conf.MAIL_FROM))
+    message["To"] = email
+    message.set_content(mail_templates.render("birthday_reminder.html", data.get("locale"), username=data["username"],
+                                              days=data["days"], contacts=data["contacts"]),
+                        subtype="html")
+    return message
+
+
+mail_sender = MailSender(mail_outbox, SMTPPool(conf, size=settings.mail_pool_size, timeout=conf.TIMEOUT),
+                         renderers={CONFIRM_EMAIL: render_confirmation_email,
+                                    BIRTHDAY_REMINDER: render_birthday_reminder},
+                         batch_size=settings.mail_batch_size,
+                         max_attempts=settings.mail_max_attempts, retry_base=settings.mail_retry_base,
+                         retry_max=settings.mail_retry_max, claim_idle=settings.mail_claim_idle)
+
+
+async def run_mail_worker():
+    """
+The run_mail_worker function compiles the email templates and drains the mail outbox until it is cancelled.
+    It runs inside the API when settings.mail_worker_in_process is set, or on its own with
+    python -m src.services.email; any number of workers can share the outbox.
+
+:return: Nothing
 :doc-author: Trelent
 """
+    mail_templates.load()
     try:
-        token_verification = auth_service.create_email_token({"sub": email})
-        message = MessageSchema(
-            subject="Confirm your email ",
-            recipients=[email],
-            template_body={"host": host, "username": username, "token": token_verification},
-            subtype=MessageType.html
-        )
-
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="email_template.html")
-    except ConnectionErrors as err:
-        print(err)
+        await mail_sender.run(consumer=f"{socket.gethostname()}-{os.getpid()}")
+    finally:
+        await mail_sender.pool.close()
+
+
+if __name__ == "__main__":
+    async def main():
+        try:
+            await run_mail_worker()
+        finally:
+            await close_redis()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
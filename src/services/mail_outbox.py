@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from email.message import Message
+from typing import Awaitable, Callable
+
+import orjson
+import redis.asyncio as redis
+
+from src.services.smtp_pool import SMTPPool
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_VERSION = 1
+
+# Queue a message unless the same kind of message was queued for the recipient within ARGV[1] seconds.
+# The dedup key and the stream entry are written together, so a failed enqueue never blocks a later one.
+ENQUEUE_SCRIPT = """
+if redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[1]) then
+    return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*',
+                      'kind', ARGV[3], 'recipient', ARGV[4], 'data', ARGV[5], 'attempts', ARGV[6])
+end
+return false
+"""
+
+# Move retries that are due from the retry set back onto the stream.
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, raw in ipairs(due) do
+    local entry = cjson.decode(raw)
+    redis.call('XADD', KEYS[1], '*', 'kind', entry[1], 'recipient', entry[2], 'data', entry[3],
+               'attempts', entry[4])
+    redis.call('ZREM', KEYS[2], raw)
+end
+return #due
+"""
+
+
+@dataclass(slots=True)
+class OutboxEntry:
+    id: str
+    kind: str
+    recipient: str
+    data: dict
+    attempts: int
+
+    @classmethod
+    def from_stream(cls, entry_id: bytes, fields: dict) -> "OutboxEntry":
+        return cls(id=entry_id.decode(), kind=fields[b"kind"].decode(), recipient=fields[b"recipient"].decode(),
+                   data=orjson.loads(fields[b"data"]), attempts=int(fields[b"attempts"]))
+
+
+class MailOutbox:
+    """
+    Durable queue of outgoing emails: a Redis stream read by MailSender workers through a consumer group.
+
+    An entry holds the message kind, the recipient and the data to render it with, not the rendered
+    message, so tokens in it are minted when it is sent. An entry stays pending in the group until it is
+    acknowledged, so a worker that dies mid-batch leaves it to be reclaimed by another one.
+    Failed entries wait in a sorted set scored by their due time and are put back on the stream when due.
+    """
+
+    group = "senders"
+
+    def __init__(self, client: redis.Redis, dedup_ttl: int, max_len: int):
+        self.redis = client
+        self.dedup_ttl = dedup_ttl
+        self.max_len = max_len
+        self.stream = f"mail:v{OUTBOX_VERSION}:outbox"
+        self.retry_key = f"mail:v{OUTBOX_VERSION}:retry"
+        self.dead_key = f"mail:v{OUTBOX_VERSION}:dead"
+        self._enqueue = client.register_script(ENQUEUE_SCRIPT)
+        self._promote = client.register_script(PROMOTE_SCRIPT)
+
+    @staticmethod
+    def dedup_key(kind: str, recipient: str, dedup_id: str | None = None) -> str:
+        key = f"mail:v{OUTBOX_VERSION}:dedup:{kind}:{recipient.lower()}"
+        return key if dedup_id is None else f"{key}:{dedup_id}"
+
+    async def enqueue(self, kind: str, recipient: str, data: dict, dedup_ttl: int | None = None,
+                      dedup_id: str | None = None) -> bool:
+        """
+        Queue a message; return False if the recipient already got one of this kind within dedup_ttl
+        (the outbox's own unless given). With a dedup_id only a message with the same id counts, e.g. the
+        digest of the same day.
+        """
+        entry_id = await self._enqueue(keys=[self.stream, self.dedup_key(kind, recipient, dedup_id)],
+                                       args=[dedup_ttl or self.dedup_ttl, self.max_len, kind, recipient,
+                                             orjson.dumps(data), 0],
+                                       client=self.redis)
+        return entry_id is not None
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as err:
+            if "BUSYGROUP" not in str(err):
+                raise
+
+    async def read(self, consumer: str, count: int, block_ms: int | None, claim_idle_ms: int) -> list[OutboxEntry]:
+        """Return entries abandoned by other consumers for claim_idle_ms, or else new ones (waiting up to block_ms)."""
+        _, claimed, *_ = await self.redis.xautoclaim(self.stream, self.group, consumer, claim_idle_ms, count=count)
+        entries = [(entry_id, fields) for entry_id, fields in claimed if fields]
+        if not entries:
+            streams = await self.redis.xreadgroup(self.group, consumer, {self.stream: ">"}, count=count,
+                                                  block=block_ms)
+            entries = [entry for _, stream_entries in streams or [] for entry in stream_entries]
+        return [OutboxEntry.from_stream(entry_id, fields) for entry_id, fields in entries]
+
+    async def ack(self, ids: list[str]) -> None:
+        if ids:
+            pipe = self.redis.pipeline()
+            pipe.xack(self.stream, self.group, *ids)
+            pipe.xdel(self.stream, *ids)
+            await pipe.execute()
+
+    async def retry(self, entry: OutboxEntry, due: float) -> None:
+        raw = orjson.dumps([entry.kind, entry.recipient, orjson.dumps(entry.data).decode(), entry.attempts + 1])
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.retry_key, {raw: due})
+        pipe.xack(self.stream, self.group, entry.id)
+        pipe.xdel(self.stream, entry.id)
+        await pipe.execute()
+
+    async def dead_letter(self, entry: OutboxEntry, error: str) -> None:
+        pipe = self.redis.pipeline()
+        pipe.xadd(self.dead_key, {"kind": entry.kind, "recipient": entry.recipient, "data": orjson.dumps(entry.data),
+                                  "attempts": entry.attempts + 1, "error": error}, maxlen=self.max_len,
+                  approximate=True)
+        pipe.xack(self.stream, self.group, entry.id)
+        pipe.xdel(self.stream, entry.id)
+        await pipe.execute()
+
+    async def promote_due(self, now: float, limit: int = 100) -> int:
+        return await self._promote(keys=[self.stream, self.retry_key], args=[now, limit], client=self.redis)
+
+
+class MailSender:
+    """
+    Drains a MailOutbox over an SMTPPool.
+
+    Each round reads up to batch_size entries, renders them with the renderer registered for their kind
+    and sends them in up to pool.size chunks, one pooled connection per chunk. Sent entries are acknowledged
+    together; failed ones are retried after retry_base * 2**attempts seconds (at most retry_max) and go to
+    the dead-letter stream after max_attempts.
+    """
+
+    def __init__(self, outbox: MailOutbox, pool: SMTPPool,
+                 renderers: dict[str, Callable[[str, dict], Awaitable[Message]]], batch_size: int,
+                 max_attempts: int, retry_base: float, retry_max: float, claim_idle: float,
+                 clock: Callable[[], float] = time.time):
+        self.outbox = outbox
+        self.pool = pool
+        self.renderers = renderers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.claim_idle = claim_idle
+        self.clock = clock
+        self.idle_delay = 5.0
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.retry_base * 2 ** attempts, self.retry_max)
+
+    async def _failed(self, entry: OutboxEntry, error: Exception) -> None:
+        if entry.attempts + 1 >= self.max_attempts:
+            logger.error("giving up on %s email to %s: %s", entry.kind, entry.recipient, error)
+            await self.outbox.dead_letter(entry, repr(error))
+        else:
+            logger.warning("%s email to %s failed, retrying: %s", entry.kind, entry.recipient, error)
+            await self.outbox.retry(entry, self.clock() + self.backoff(entry.attempts))
+
+    async def run_once(self, consumer: str, block_ms: int | None = None) -> int:
+        """Send one batch and return the number of entries handled."""
+        await self.outbox.promote_due(self.clock())
+        entries = await self.outbox.read(consumer, self.batch_size, block_ms, int(self.claim_idle * 1000))
+        ready = []
+        for entry in entries:
+            renderer = self.renderers.get(entry.kind)
+            try:
+                if renderer is None:
+                    raise ValueError(f"no renderer for {entry.kind!r}")
+                ready.append((entry, await renderer(entry.recipient, entry.data)))
+            except Exception as err:
+                await self.outbox.dead_letter(entry, repr(err))
+        chunks = [ready[i::self.pool.size] for i in range(min(self.pool.size, len(ready)))]
+        results = await asyncio.gather(*(self.pool.send_batch([message for _, message in chunk]) for chunk in chunks))
+        sent = []
+        for chunk, errors in zip(chunks, results):
+            for (entry, _), error in zip(chunk, errors):
+                if error is None:
+                    sent.append(entry.id)
+                else:
+                    await self._failed(entry, error)
+        await self.outbox.ack(sent)
+        return len(entries)
+
+    async def run(self, consumer: str, block_ms: int = 1000) -> None:
+        """
+        Send batches until cancelled; Redis outages are waited out. block_ms must stay below the Redis
+        socket timeout, as a blocked read holds its connection for that long.
+        """
+        while True:
+            try:
+                await self.outbox.ensure_group()
+                while True:
+                    await self.run_once(consumer, block_ms)
+            except redis.RedisError as err:
+                logger.warning("mail outbox unavailable, retrying: %s", err)
+            except Exception:
+                logger.exception("mail sender failed, restarting")
+            await asyncio.sleep(self.idle_delay)
@@ -0,0 +1,111 @@
+import re
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader, Template, TemplateNotFound, meta, nodes, select_autoescape
+from markupsafe import escape
+
+# Placeholder rendered in place of the n-th per-message variable while a template is split into static parts.
+MARKER = "\x00{}\x00"
+MARKER_RE = re.compile("\x00(\\d+)\x00")
+
+
+def printed_only(ast: nodes.Template, names: set[str]) -> bool:
+    """Return True if the template only prints the given variables as {{ name }} and pulls in no other template."""
+    def visit(node: nodes.Node, parent: nodes.Node | None) -> bool:
+        if isinstance(node, (nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport)):
+            return False
+        if isinstance(node, nodes.Name) and node.name in names and not isinstance(parent, nodes.Output):
+            return False
+        return all(visit(child, node) for child in node.iter_child_nodes())
+
+    return visit(ast, None)
+
+
+class CompiledTemplate:
+    """
+    A template specialised for one locale.
+
+    When every per-message variable is only printed ({{ name }}), the template is rendered once with
+    placeholders and split into its fully static parts, and rendering a message is joining those parts
+    with the escaped values. Templates that use per-message variables in filters or control flow
+    (loops, conditions) are rendered by Jinja with the locale's static context bound once.
+    """
+
+    def __init__(self, template: Template, names: list[str] | None, autoescape: bool):
+        self.template = template
+        self.autoescape = autoescape
+        self.parts: list[str] | None = None
+        self.names: list[str] = []
+        if names is not None:
+            output = template.render({name: MARKER.format(i) for i, name in enumerate(names)})
+            pieces = MARKER_RE.split(output)
+            self.parts, self.names = pieces[::2], [names[int(i)] for i in pieces[1::2]]
+
+    def render(self, **context) -> str:
+        if self.parts is None:
+            return self.template.render(context)
+        out = [self.parts[0]]
+        for name, part in zip(self.names, self.parts[1:]):
+            value = context.get(name, "")
+            out.append(str(escape(value)) if self.autoescape else str(value))
+            out.append(part)
+        return "".join(out)
+
+    @property
+    def static_parts(self) -> bool:
+        return self.parts is not None
+
+
+class TemplateRegistry:
+    """
+    Email templates compiled once, per locale.
+
+    A locale can override a template with a file named like `email_template.<locale>.html`; otherwise it
+    uses the default file. Each locale renders with its own static context (e.g. the locale itself).
+    load() compiles every template for every locale up front; get() compiles a missing one on first use.
+    """
+
+    def __init__(self, folder: Path, locales: dict[str, dict], default_locale: str):
+        self.env = Environment(loader=FileSystemLoader(folder), autoescape=select_autoescape(["html", "xml"]),
+                               auto_reload=False)
+        self.locales = locales
+        self.default_locale = default_locale
+        self._compiled: dict[tuple[str, str], CompiledTemplate] = {}
+
+    def _source_name(self, name: str, locale: str) -> str:
+        stem, dot, suffix = name.rpartition(".")
+        localized = f"{stem}.{locale}.{suffix}" if dot else f"{name}.{locale}"
+        try:
+            self.env.get_template(localized)
+            return localized
+        except TemplateNotFound:
+            return name
+
+    def compile(self, name: str, locale: str) -> CompiledTemplate:
+        source_name = self._source_name(name, locale)
+        source, _, _ = self.env.loader.get_source(self.env, source_name)
+        ast = self.env.parse(source)
+        static = {"locale": locale, **self.locales.get(locale, {})}
+        names = meta.find_undeclared_variables(ast) - static.keys()
+        # a Template of its own per locale, with the locale's static context as its globals
+        template = self.env.template_class.from_code(self.env, self.env.compile(ast, source_name, source_name),
+                                                     self.env.make_globals(static))
+        compiled = CompiledTemplate(template, sorted(names) if printed_only(ast, names) else None,
+                                    autoescape=self.env.autoescape(source_name))
+        self._compiled[name, locale] = compiled
+        return compiled
+
+    def load(self) -> None:
+        localized = {f".{locale}." for locale in self.locales}
+        for name in self.env.list_templates():
+            if not any(part in name for part in localized):
+                for locale in self.locales:
+                    self.compile(name, locale)
+
+    def get(self, name: str, locale: str | None = None) -> CompiledTemplate:
+        locale = locale if locale in self.locales else self.default_locale
+        compiled = self._compiled.get((name, locale))
+        return compiled if compiled is not None else self.compile(name, locale)
+
+    def render(self, name: str, locale: str | None = None, /, **context) -> str:
+        return self.get(name, locale).render(**context)
@@ -0,0 +1,156 @@
+import logging
+import math
+import time
+from dataclasses import dataclass
+
+import redis.asyncio as redis
+from fastapi import Depends, HTTPException, Request, status
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.conf.config import settings
+from src.database.models import User
+from src.database.redis_pool import redis_client
+from src.services.auth import auth_service
+from src.services.user_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# GCRA: the key holds the theoretical arrival time (TAT) of the next request in ms.
+# A request is allowed while it would not push the TAT more than one period ahead of now.
+# Mirrors gcra() below, which the in-process pre-check uses.
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local period = interval * tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+if tat < now then tat = now end
+local new_tat = tat + interval
+if new_tat - period > now then
+    return {0, 0, new_tat - period - now, tat - now}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now)
+return {1, math.floor((period - (new_tat - now)) / interval), 0, new_tat - now}
+"""
+
+
+@dataclass(slots=True)
+class Decision:
+    allowed: bool
+    remaining: int
+    retry_after: int
+    reset: int
+
+
+def gcra(tat: int | None, now: int, interval: int, limit: int) -> tuple[Decision, int | None]:
+    """Return the decision for one request and the new TAT to store, or None if it is rejected."""
+    period = interval * limit
+    tat = max(tat or now, now)
+    new_tat = tat + interval
+    if new_tat - period > now:
+        return Decision(False, 0, new_tat - period - now, tat - now), None
+    return Decision(True, (period - (new_tat - now)) // interval, 0, new_tat - now), new_tat
+
+
+class RateLimitStore:
+    """Runs GCRA_SCRIPT in Redis: one EVALSHA round trip per request, falling back to EVAL once per script load."""
+
+    def __init__(self, client: redis.Redis):
+        self.redis = client
+        self._script = client.register_script(GCRA_SCRIPT)
+
+    async def hit(self, key: str, now: int, interval: int, limit: int) -> Decision:
+        allowed, remaining, retry_after, reset = await self._script(keys=[key], args=[now, interval, limit],
+                                                                    client=self.redis)
+        return Decision(bool(allowed), int(remaining), int(retry_after), int(reset))
+
+
+rate_limit_store = RateLimitStore(redis_client)
+
+
+class RateLimiter:
+    """
+    Route dependency allowing `times` requests per `seconds` to each authenticated user, per route.
+
+    The budget is kept in Redis with GCRA, so it is shared by all workers. When
+    settings.rate_limit_local_precheck is on, each worker also keeps the same budget in memory: a worker
+    only sees part of the user's traffic, so a local rejection is always a global one and can be answered
+    without touching Redis. Responses carry RateLimit-Limit/Remaining/Reset and RateLimit-Policy headers
+    (added by RateLimitHeadersMiddleware, so routes returning a Response directly get them too),
+    and 429 responses a Retry-After header. If Redis is unavailable the limiter fails open.
+    """
+
+    def __init__(self, times: int, seconds: int, name: str | None = None):
+        self.times = times
+        self.seconds = seconds
+        self.name = name
+        self.interval = max(seconds * 1000 // times, 1)
+        self.local = LRUCache(settings.rate_limit_local_size, ttl=seconds) \
+            if settings.rate_limit_local_precheck else None
+
+    def key(self, request: Request, user_id: int) -> str:
+        name = self.name
+        if name is None:
+            endpoint = request.scope["endpoint"]
+            name = f"{endpoint.__module__}.{endpoint.__qualname__}"
+        return f"ratelimit:v1:{name}:{user_id}"
+
+    def headers(self, decision: Decision) -> dict:
+        headers = {
+            "RateLimit-Limit": str(self.times),
+            "RateLimit-Remaining": str(decision.remaining),
+            "RateLimit-Reset": str(math.ceil(decision.reset / 1000)),
+            "RateLimit-Policy": f"{self.times};w={self.seconds}",
+        }
+        if not decision.allowed:
+            headers["Retry-After"] = str(math.ceil(decision.retry_after / 1000))
+        return headers
+
+    def reject(self, decision: Decision):
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests",
+                            headers=self.headers(decision))
+
+    async def __call__(self, request: Request, current_user: User = Depends(auth_service.get_current_user)):
+        key = self.key(request, current_user.id)
+        previous = decision = None
+        if self.local is not None:
+            previous = self.local.get(key)
+            decision, tat = gcra(previous, int(time.monotonic() * 1000), self.interval, self.times)
+            if not decision.allowed:
+                self.reject(decision)
+            self.local.set(key, tat)
+        try:
+            decision = await rate_limit_store.hit(key, int(time.time() * 1000), self.interval, self.times)
+        except redis.RedisError as err:
+            logger.warning("rate limiter unavailable, allowing request: %s", err)
+        if decision is None:
+            return
+        if not decision.allowed:
+            if self.local is not None:
+                # the request was not counted globally, so do not count it locally either
+                if previous is None:
+                    self.local.pop(key)
+                else:
+                    self.local.set(key, previous)
+            self.reject(decision)
+        request.state.rate_limit_headers = self.headers(decision)
+
+
+class RateLimitHeadersMiddleware:
+    """Add the RateLimit headers a RateLimiter left on request.state to the response."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                headers = scope.get("state", {}).get("rate_limit_headers")
+                if headers:
+                    message["headers"] = list(message.get("headers", [])) + \
+                        [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
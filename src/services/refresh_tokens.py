@@ -0,0 +1,71 @@
+import enum
+
+from redis.asyncio import Redis
+
+from src.database.redis_pool import redis_client
+
+STORE_VERSION = 1
+
+
+class Rotation(enum.Enum):
+    ROTATED = "rotated"
+    INVALID = "invalid"
+    REUSED = "reused"
+
+
+class RefreshTokenStore:
+    """
+    Redis state of issued refresh tokens, grouped into rotation families.
+
+    Every login starts a new family, so a user can hold as many sessions as they have devices.
+    refresh:v1:token:<jti> holds the token's family and refresh:v1:family:<fam> holds the jti of the
+    family's newest token, both expiring with the token. Rotating a token consumes it and moves the
+    family on to its successor; presenting an already rotated token of a live family is treated as
+    theft and revokes the whole family. Redis errors are not swallowed: without this state a refresh
+    token cannot be checked, so callers must fail closed.
+    """
+
+    def __init__(self, client: Redis):
+        self.redis = client
+
+    @staticmethod
+    def token_key(jti: str) -> str:
+        return f"refresh:v{STORE_VERSION}:token:{jti}"
+
+    @staticmethod
+    def family_key(family: str) -> str:
+        return f"refresh:v{STORE_VERSION}:family:{family}"
+
+    async def start(self, family: str, jti: str, ttl: int) -> None:
+        pipe = self.redis.pipeline()
+        pipe.set(self.token_key(jti), family, ex=ttl)
+        pipe.set(self.family_key(family), jti, ex=ttl)
+        await pipe.execute()
+
+    async def rotate(self, family: str, jti: str, new_jti: str, ttl: int) -> Rotation:
+        family_key, token_key = self.family_key(family), self.token_key(jti)
+        outcome = Rotation.INVALID
+
+        async def apply(pipe):
+            nonlocal outcome
+            current, token_family = await pipe.get(family_key), await pipe.get(token_key)
+            pipe.multi()
+            if current is None:
+                outcome = Rotation.INVALID
+            elif current.decode() == jti and token_family is not None and token_family.decode() == family:
+                pipe.delete(token_key)
+                pipe.set(family_key, new_jti, ex=ttl)
+                pipe.set(self.token_key(new_jti), family, ex=ttl)
+                outcome = Rotation.ROTATED
+            else:
+                pipe.delete(family_key)
+                outcome = Rotation.REUSED
+
+        await self.redis.transaction(apply, family_key, token_key)
+        return outcome
+
+    async def revoke(self, family: str) -> None:
+        await self.redis.delete(self.family_key(family))
+
+
+refresh_token_store = RefreshTokenStore(redis_client)
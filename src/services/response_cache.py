@@ -0,0 +1,103 @@
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable
+
+import redis.asyncio as redis
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import parse_obj_as
+
+from src.conf.config import settings
+from src.database.redis_pool import redis_client
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(etag: str, if_none_match: str | None) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+class ResponseCache:
+    """
+    Redis cache of serialized contact read responses, one key space per user.
+
+    Every key embeds the user's contacts version, which the contacts repository bumps after each write,
+    so a write makes all of the user's cached responses unreachable at once and they age out by TTL.
+    The version is read before the database query, so a write racing a read can only leave a body
+    under a version nobody asks for any more. If Redis is unavailable the cache is bypassed.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int):
+        self.redis = client
+        self.ttl = ttl
+
+    @staticmethod
+    def version_key(user_id: int) -> str:
+        return f"contacts:v{CACHE_VERSION}:{user_id}:version"
+
+    async def version(self, user_id: int) -> int | None:
+        try:
+            return int(await self.redis.get(self.version_key(user_id)) or 0)
+        except redis.RedisError as err:
+            logger.warning("response cache version lookup failed: %s", err)
+            return None
+
+    async def bump(self, user_id: int) -> None:
+        try:
+            await self.redis.incr(self.version_key(user_id))
+        except redis.RedisError as err:
+            logger.warning("response cache version bump failed: %s", err)
+
+    @staticmethod
+    def key(user_id: int, version: int, request: Request, *vary) -> str:
+        query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+        digest = hashlib.sha1(f"{request.url.path}?{query}|{'|'.join(map(str, vary))}".encode()).hexdigest()
+        return f"contacts:v{CACHE_VERSION}:{user_id}:{version}:{digest}"
+
+    async def get(self, key: str) -> bytes | None:
+        try:
+            return await self.redis.get(key)
+        except redis.RedisError as err:
+            logger.warning("response cache get failed: %s", err)
+            return None
+
+    async def set(self, key: str, body: bytes) -> None:
+        try:
+            await self.redis.set(key, body, ex=self.ttl)
+        except redis.RedisError as err:
+            logger.warning("response cache set failed: %s", err)
+
+    async def respond(self, request: Request, user_id: int, response_model: Any,
+                      build: Callable[[], Awaitable[Any]], *vary) -> Response:
+        """
+        Serve a JSON read from the cache, calling build() and storing its serialized result on a miss.
+
+        The ETag is a hash of the exact body, so a matching If-None-Match is answered with 304;
+        on a cache hit that costs no database query at all.
+        vary lists inputs besides the path and query string that change the result, e.g. today's date.
+        """
+        version = await self.version(user_id)
+        key = None if version is None else self.key(user_id, version, request, *vary)
+        body = None if key is None else await self.get(key)
+        if body is None:
+            data = await build()
+            body = JSONResponse(jsonable_encoder(parse_obj_as(response_model, data))).body
+            if key is not None:
+                await self.set(key, body)
+        headers = {"ETag": make_etag(body), "Cache-Control": "private, no-cache"}
+        if etag_matches(headers["ETag"], request.headers.get("if-none-match")):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+
+response_cache = ResponseCache(redis_client, ttl=settings.response_cache_ttl)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from email.message import Message
+
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPool:
+    """
+    Up to `size` persistent SMTP connections, opened on first use and kept open between batches.
+
+    send_batch() sends a list of messages in order over one connection, so a batch pays for the
+    TCP/TLS handshake and login once. A connection the server dropped while idle is reopened and the
+    message retried once; after any other connection error the connection is closed and the rest of
+    the batch fails with it.
+    """
+
+    def __init__(self, config: ConnectionConfig, size: int, timeout: float):
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self._idle: list[aiosmtplib.SMTP] = []
+        self._slots = asyncio.Semaphore(size)
+        self.opened = 0
+
+    async def _open(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(hostname=self.config.MAIL_SERVER, port=self.config.MAIL_PORT,
+                               use_tls=self.config.MAIL_SSL_TLS, start_tls=self.config.MAIL_STARTTLS,
+                               validate_certs=self.config.VALIDATE_CERTS, timeout=self.timeout)
+        await smtp.connect()
+        if self.config.USE_CREDENTIALS:
+            await smtp.login(self.config.MAIL_USERNAME, self.config.MAIL_PASSWORD)
+        self.opened += 1
+        return smtp
+
+    async def _checkout(self) -> aiosmtplib.SMTP:
+        while self._idle:
+            smtp = self._idle.pop()
+            if smtp.is_connected:
+                return smtp
+        return await self._open()
+
+    async def _send(self, smtp: aiosmtplib.SMTP, message: Message) -> aiosmtplib.SMTP:
+        try:
+            await smtp.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            smtp.close()
+            smtp = await self._open()
+            await smtp.send_message(message)
+        return smtp
+
+    async def send_batch(self, messages: list[Message]) -> list[Exception | None]:
+        """Send messages over one pooled connection and return, per message, the error or None."""
+        errors: list[Exception | None] = []
+        async with self._slots:
+            smtp = None
+            try:
+                for message in messages:
+                    try:
+                        if smtp is None:
+                            try:
+                                smtp = await self._checkout()
+                            except aiosmtplib.SMTPResponseException as err:
+                                # e.g. a rejected login: no message of the batch can go out
+                                raise aiosmtplib.SMTPConnectError(str(err)) from err
+                        smtp = await self._send(smtp, message)
+                        errors.append(None)
+                    except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused) as err:
+                        # the server refused this message; the session itself is still usable
+                        errors.append(err)
+                    except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as err:
+                        # the connection is gone: fail the rest of the batch rather than reconnect per message
+                        errors.extend([err] * (len(messages) - len(errors)))
+                        if smtp is not None:
+                            smtp.close()
+                            smtp = None
+                        break
+            finally:
+                if smtp is not None:
+                    self._idle.append(smtp)
+        return errors
+
+    async def close(self) -> None:
+        while self._idle:
+            smtp = self._idle.pop()
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError) as err:
+                logger.debug("smtp quit failed: %s", err)
+                smtp.close()
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+
+import orjson
+import redis.asyncio as redis
+
+from src.conf.config import settings
+from src.database.models import User
+from src.database.redis_pool import redis_client
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# Stored under a user's key when no account has that email; a snapshot is always a JSON array.
+MISSING = b"missing"
+
+
+@dataclass(slots=True, frozen=True)
+class UserSnapshot:
+    """The fields of a user that authenticated requests need, without the password hash or ORM state."""
+    id: int
+    username: str | None
+    email: str
+    created_at: datetime | None
+    avatar: str | None
+    confirmed: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(id=user.id, username=user.username, email=user.email, created_at=user.created_at,
+                   avatar=user.avatar, confirmed=bool(user.confirmed))
+
+    def dumps(self) -> bytes:
+        return orjson.dumps((self.id, self.username, self.email, self.created_at, self.avatar, self.confirmed))
+
+    @classmethod
+    def loads(cls, data: bytes) -> "UserSnapshot":
+        user_id, username, email, created_at, avatar, confirmed = orjson.loads(data)
+        return cls(id=user_id, username=username, email=email,
+                   created_at=datetime.fromisoformat(created_at) if created_at else None,
+                   avatar=avatar, confirmed=confirmed)
+
+
+class LRUCache:
+    """
+    Thread-safe, size- and TTL-bounded LRU map with hit/miss/eviction counters.
+
+    Expired entries are dropped lazily on lookup; when full, the least recently used entry is evicted.
+    set() accepts a per-entry ttl overriding the default one.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, self.clock() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserCache:
+    """
+    Two-tier cache of UserSnapshot objects keyed by email: an in-process LRU in front of Redis.
+
+    Writes go to both tiers and are announced on a pub/sub channel so the other workers drop their
+    local copy; the short local TTL bounds staleness if a message is missed.
+    The key carries SNAPSHOT_VERSION, so changing the snapshot layout simply starts a new key space.
+    Emails without an account are cached as MISSING for negative_ttl seconds, so repeated lookups of
+    unknown emails (e.g. credential stuffing) do not reach the database; writing or invalidating the
+    user replaces the marker in every worker.
+    Redis errors are logged and treated as a cache miss; the database stays the source of truth.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int, local_size: int = 0, local_ttl: float = 0,
+                 negative_ttl: int = 0):
+        self.redis = client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = LRUCache(local_size, local_ttl)
+        self.channel = f"user:v{SNAPSHOT_VERSION}:invalidate"
+        self.node_id = uuid.uuid4().hex
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.negative_hits = 0
+        self.retry_delay = 5.0
+        # below the pool's socket_timeout, so waiting on a quiet channel never reads as a dead socket
+        self.poll_timeout = 1.0
+        self._listener = None
+
+    @staticmethod
+    def key(email: str) -> str:
+        return f"user:v{SNAPSHOT_VERSION}:{email.lower()}"
+
+    async def get(self, email: str) -> UserSnapshot | None:
+        key = self.key(email)
+        snapshot = self.local.get(key)
+        if snapshot is MISSING:
+            self.negative_hits += 1
+            return None
+        if snapshot is not None:
+            return snapshot
+        try:
+            data = await self.redis.get(key)
+        except redis.RedisError as err:
+            logger.warning("user cache get failed: %s", err)
+            return None
+        if data is None:
+            self.redis_misses += 1
+            return None
+        if data == MISSING:
+            self.negative_hits += 1
+            self._remember_missing(key)
+            return None
+        try:
+            snapshot = UserSnapshot.loads(data)
+        except (ValueError, TypeError):
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        self.local.set(key, snapshot)
+        return snapshot
+
+    async def set(self, user: User | UserSnapshot) -> UserSnapshot:
+        snapshot = user if isinstance(user, UserSnapshot) else UserSnapshot.from_user(user)
+        key = self.key(snapshot.email)
+        self.local.set(key, snapshot)
+        try:
+            await self.redis.set(key, snapshot.dumps(), ex=self.ttl)
+        except redis.RedisError as err:
+            logger.warning("user cache set failed: %s", err)
+        await self._publish(key)
+        return snapshot
+
+    async def invalidate(self, email: str) -> None:
+        key = self.key(email)
+        self.local.pop(key)
+        try:
+            await self.redis.delete(key)
+        except redis.RedisError as err:
+            logger.warning("user cache invalidate failed: %s", err)
+        await self._publish(key)
+
+    def _remember_missing(self, key: str) -> None:
+        self.local.set(key, MISSING, ttl=min(self.local.ttl, self.negative_ttl))
+
+    async def is_missing(self, email: str) -> bool:
+        """Return True if the email is cached as having no account; False if unknown or it has one."""
+        if self.negative_ttl <= 0:
+            return False
+        key = self.key(email)
+        cached = self.local.get(key)
+        if cached is not None:
+            if cached is MISSING:
+                self.negative_hits += 1
+            return cached is MISSING
+        try:
+            data = await self.redis.get(key)
+        except redis.RedisError as err:
+            logger.warning("user cache negative lookup failed: %s", err)
+            return False
+        if data == MISSING:
+            self.negative_hits += 1
+            self._remember_missing(key)
+            return True
+        return False
+
+    async def set_missing(self, email: str) -> None:
+        """
+        Cache that the email has no account. NX keeps a snapshot written concurrently by a signup, and the
+        local tier only remembers the miss when Redis took it, so a lost race does not linger in this worker.
+        """
+        if self.negative_ttl <= 0:
+            return
+        key = self.key(email)
+        try:
+            if not await self.redis.set(key, MISSING, ex=self.negative_ttl, nx=True):
+                return
+        except redis.RedisError as err:
+            logger.warning("user cache negative set failed: %s", err)
+        self._remember_missing(key)
+
+    async def _publish(self, key: str) -> None:
+        try:
+            await self.redis.publish(self.channel, f"{self.node_id} {key}")
+        except redis.RedisError as err:
+            logger.warning("user cache publish failed: %s", err)
+
+    def _on_message(self, message: dict) -> None:
+        data = message.get("data")
+        if isinstance(data, bytes):
+            data = data.decode()
+        node_id, _, key = str(data).partition(" ")
+        if node_id != self.node_id:
+            self.local.pop(key)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=self.poll_timeout)
+                    if message is not None:
+                        self._on_message(message)
+            except redis.TimeoutError as err:
+                # a read that outlived socket_timeout, not a lost subscription: resubscribe, keep the local tier
+                logger.debug("user cache listener timed out, resubscribing: %s", err)
+            except redis.RedisError as err:
+                # messages sent while disconnected are lost; the local TTL bounds the staleness
+                logger.warning("user cache listener disconnected, retrying: %s", err)
+                self.local.clear()
+                await asyncio.sleep(self.retry_delay)
+            finally:
+                await pubsub.reset()
+
+    def start_listener(self) -> None:
+        """Subscribe to invalidation messages from the other workers in a background task."""
+        if self._listener is None and self.local.maxsize > 0:
+            self._listener = asyncio.create_task(self._listen())
+
+    def stop_listener(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+    def stats(self) -> dict:
+        return {
+            "local_size": len(self.local),
+            "local_maxsize": self.local.maxsize,
+            "local_hits": self.local.hits,
+            "local_misses": self.local.misses,
+            "local_evictions": self.local.evictions,
+            "redis_hits": self.redis_hits,
+            "redis_misses": self.redis_misses,
+            "negative_hits": self.negative_hits,
+            "listening": self._listener is not None,
+        }
+
+
+user_cache = UserCache(redis_client, ttl=settings.user_cache_ttl, local_size=settings.user_cache_local_size,
+                       local_ttl=settings.user_cache_local_ttl, negative_ttl=settings.user_negative_cache_ttl)
@@ -7,6 +7,7 @@ from sqlalchemy.orm import sessionmaker
 from main import app
 from src.database.models import Base
 from src.database.db import get_db
+from src.services.refresh_tokens import refresh_token_store
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -49,3 +50,65 @@ def client(session):
 @pytest.fixture(scope="module")
 def user():
     return {"username": "IronMan", "email": "Tony@example.com", "password": "123456789"}
+
+
+class FakeRedis:
+    """Dict-backed stand-in for the handful of redis.asyncio.Redis calls the services make."""
+
+    def __init__(self):
+        self.store = {}
+
+    def _set(self, key, value, ex=None, nx=False):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def _delete(self, *keys):
+        return sum(self.store.pop(key, None) is not None for key in keys)
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None, nx=False):
+        return self._set(key, value, ex=ex, nx=nx)
+
+    async def delete(self, *keys):
+        return self._delete(*keys)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    async def transaction(self, func, *keys):
+        await func(self.pipeline())
+
+
+class FakePipeline:
+    """Runs every command straight away; good enough while tests run one request at a time."""
+
+    def __init__(self, client: FakeRedis):
+        self.client = client
+
+    async def get(self, key):
+        return self.client.store.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        self.client._set(key, value, ex=ex, nx=nx)
+        return self
+
+    def delete(self, *keys):
+        self.client._delete(*keys)
+        return self
+
+    def multi(self):
+        pass
+
+    async def execute(self):
+        return []
+
+
+@pytest.fixture()
+def refresh_store(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(refresh_token_store, "redis", fake)
+    return fake
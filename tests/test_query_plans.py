@@ -0,0 +1,82 @@
+import datetime
+import re
+import unittest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.database.models import Base, User
+from src.schemas import ContactModel
+from src.repository import contacts as repository_contacts
+from src.repository import users as repository_users
+
+FULL_SCAN = re.compile(r"\bSCAN (contact|users)\b(?! USING)")
+
+
+class TestQueryPlans(unittest.IsolatedAsyncioTestCase):
+    """Runs every repository query and fails if SQLite plans a full table scan for it."""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(bind=self.engine)
+        self.session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+        self.user = User(username='User1', email='User1@gmail.com', password='qwerty')
+        self.session.add(self.user)
+        self.session.commit()
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self._capture)
+
+    def tearDown(self):
+        event.remove(self.engine, "before_cursor_execute", self._capture)
+        self.session.close()
+        self.engine.dispose()
+
+    def _capture(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            self.statements.append((statement, parameters))
+
+    def assert_no_full_scans(self):
+        self.assertTrue(self.statements)
+        with self.engine.connect() as conn:
+            for statement, parameters in self.statements:
+                plan = "\n".join(row[-1] for row in
+                                 conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters))
+                self.assertIsNone(FULL_SCAN.search(plan), f"full scan for:\n{statement}\nplan:\n{plan}")
+
+    async def test_contact_queries(self):
+        body = ContactModel(first_name='Buster', last_name='Johns', email='buster@meta.ua',
+                            phone='+35428421424', date_of_birth=datetime.date(year=1985, month=10, day=8))
+        contact = await repository_contacts.create_contact(body, self.session, self.user)
+
+        for sort_by in repository_contacts.SORT_KEYS:
+            await repository_contacts.get_contacts(10, '', '', '', self.session, self.user, sort_by=sort_by)
+            cursor = repository_contacts.encode_cursor(sort_by, contact)
+            await repository_contacts.get_contacts(10, '', '', '', self.session, self.user, cursor, sort_by)
+        await repository_contacts.get_contacts(10, 'Buster', '', '', self.session, self.user)
+        await repository_contacts.get_contacts(10, 'Buster', 'Johns', '', self.session, self.user)
+        await repository_contacts.get_contacts(10, '', 'Johns', '', self.session, self.user)
+        await repository_contacts.get_contacts(10, '', 'Johns', 'buster@meta.ua', self.session, self.user)
+        await repository_contacts.get_contacts(10, '', '', 'buster@meta.ua', self.session, self.user)
+        await repository_contacts.get_contact_by_id(contact.id, self.session)
+        await repository_contacts.verify_email_phone('other@meta.ua', '+35428421424', self.session)
+        await repository_contacts.get_contact_birthday(0, 10, self.session, self.user,
+                                                       today=datetime.date(year=2023, month=10, day=5))
+        await repository_contacts.get_contact_birthday(0, 10, self.session, self.user,
+                                                       today=datetime.date(year=2023, month=12, day=28))
+        await repository_contacts.search_contacts('ohns', 0, 10, self.session, self.user)
+        await repository_contacts.search_contacts('jo', 0, 10, self.session, self.user)
+        await repository_contacts.update_contact(contact.id, body, self.session, self.user)
+        await repository_contacts.remove_contact(contact.id, self.session, self.user)
+
+        self.assert_no_full_scans()
+
+    async def test_user_queries(self):
+        await repository_users.get_user_by_email('user1@GMAIL.com', self.session)
+        await repository_users.confirmed_email('user1@gmail.com', self.session)
+
+        self.assert_no_full_scans()
+
+
+if __name__ == '__main__':
+    unittest.main()
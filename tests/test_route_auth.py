@@ -1,10 +1,10 @@
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock
 
 from src.database.models import User
 
 
 def test_create_user(client, user, monkeypatch):
-    mock_send_email = MagicMock()
+    mock_send_email = AsyncMock()
     monkeypatch.setattr("src.routes.auth.send_email", mock_send_email)
     response = client.post(
         "/api/auth/signup",
@@ -26,6 +26,18 @@ def test_repeat_create_user(client, user):
     assert data["detail"] == "Account already exists"
 
 
+def test_concurrent_signup_with_other_case(client, user, monkeypatch):
+    # the other signup commits after this one checked that the email was free
+    monkeypatch.setattr("src.routes.auth.repository_users.get_user_by_email", AsyncMock(return_value=None))
+    monkeypatch.setattr("src.routes.auth.send_email", AsyncMock())
+    response = client.post(
+        "/api/auth/signup",
+        json={**user, "email": user["email"].lower()},
+    )
+    assert response.status_code == 409, response.text
+    assert response.json()["detail"] == "Account already exists"
+
+
 def test_login_user_not_confirmed(client, user):
     response = client.post(
         "/api/auth/login",
@@ -36,7 +48,7 @@ def test_login_user_not_confirmed(client, user):
     assert data["detail"] == "Email not confirmed"
 
 
-def test_login_user(client, session, user):
+def test_login_user(client, session, user, refresh_store):
     current_user: User = session.query(User).filter(User.email == user.get('email')).first()
     current_user.confirmed = True
     session.commit()
@@ -49,6 +61,33 @@ def test_login_user(client, session, user):
     assert data["token_type"] == "bearer"
 
 
+def test_refresh_token_rotation(client, user, refresh_store):
+    tokens = []
+    for _ in range(2):
+        response = client.post(
+            "/api/auth/login",
+            data={"username": user.get('email'), "password": user.get('password')},
+        )
+        assert response.status_code == 200, response.text
+        tokens.append(response.json()["refresh_token"])
+    first, second = tokens
+
+    response = client.get("/api/auth/refresh_token", headers={"Authorization": f"Bearer {first}"})
+    assert response.status_code == 200, response.text
+    rotated = response.json()["refresh_token"]
+    assert rotated != first
+
+    # reusing a rotated token revokes its family
+    response = client.get("/api/auth/refresh_token", headers={"Authorization": f"Bearer {first}"})
+    assert response.status_code == 401, response.text
+    response = client.get("/api/auth/refresh_token", headers={"Authorization": f"Bearer {rotated}"})
+    assert response.status_code == 401, response.text
+
+    # the other session is not affected
+    response = client.get("/api/auth/refresh_token", headers={"Authorization": f"Bearer {second}"})
+    assert response.status_code == 200, response.text
+
+
 def test_login_wrong_password(client, user):
     response = client.post(
         "/api/auth/login",
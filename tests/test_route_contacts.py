@@ -1,15 +1,20 @@
-from unittest.mock import MagicMock, patch, AsyncMock
+import gzip
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
 from datetime import datetime
 
 import pytest
 
 from src.database.models import Contact, User
-from src.services.auth import auth_service
+from src.repository import contacts as repository_contacts
+from src.services.rate_limit import rate_limit_store
+from src.services.response_cache import response_cache
+from src.services.user_cache import user_cache
 
 
 @pytest.fixture()
-def token(client, user, session, monkeypatch):
-    mock_send_email = MagicMock()
+def token(client, user, session, monkeypatch, refresh_store):
+    mock_send_email = AsyncMock()
     monkeypatch.setattr("src.routes.auth.send_email", mock_send_email)
     client.post("/api/auth/signup", json=user)
     current_user: User = session.query(User).filter(User.email == user.get('email')).first()
@@ -23,12 +28,27 @@ def token(client, user, session, monkeypatch):
     return data["access_token"]
 
 
+def limiter_redis(allowed=1, remaining=9, retry_after=0, reset=6000):
+    r_mock = AsyncMock()
+    r_mock.evalsha.return_value = [allowed, remaining, retry_after, reset]
+    return r_mock
+
+
+@pytest.fixture()
+def cache_store():
+    store = {}
+    r_mock = AsyncMock()
+    r_mock.get.side_effect = store.get
+    r_mock.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+    r_mock.incr.side_effect = lambda key: store.__setitem__(key, int(store.get(key, 0)) + 1)
+    with patch.object(response_cache, 'redis', r_mock):
+        yield store
+
+
 def test_create_contact(client, token, monkeypatch):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
-        monkeypatch.setattr('fastapi_limiter.FastAPILimiter.redis', AsyncMock())
-        monkeypatch.setattr('fastapi_limiter.FastAPILimiter.identifier', AsyncMock())
-        monkeypatch.setattr('fastapi_limiter.FastAPILimiter.http_callback', AsyncMock())
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
         response = client.post("/api/contacts/",
                                json={
                                    "first_name": "Tom",
@@ -45,20 +65,64 @@ def test_create_contact(client, token, monkeypatch):
         assert "id" in data
 
 
+def test_repeat_create_contact(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
+        response = client.post("/api/contacts/",
+                               json={
+                                   "first_name": "Tom",
+                                   "last_name": "Soyer",
+                                   "email": "Tomas@example.com",
+                                   "phone": "+31462454652",
+                                   "date_of_birth": "2018-04-30"
+                               },
+                               headers={"Authorization": f"Bearer {token}"}
+                               )
+        assert response.status_code == 409, response.text
+        data = response.json()
+        assert data["detail"] == "Email or phone is existed"
+
+
 def test_get_contact_by_name(client, token, monkeypatch):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
-        monkeypatch.setattr('fastapi_limiter.FastAPILimiter.redis', AsyncMock())
-        monkeypatch.setattr('fastapi_limiter.FastAPILimiter.identifier', AsyncMock())
-        monkeypatch.setattr('fastapi_limiter.FastAPILimiter.http_callback', AsyncMock())
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
         response = client.get("/api/contacts/",
                               headers={"Authorization": f"Bearer {token}"}
                               )
         assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["items"][0]["first_name"] == "Tom"
+        assert data["next_cursor"] is None
+        assert response.headers["RateLimit-Limit"] == "10"
+        assert response.headers["RateLimit-Remaining"] == "9"
+
+
+def test_get_contacts_rate_limited(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis(allowed=0, remaining=0, retry_after=5500))
+        response = client.get("/api/contacts/",
+                              headers={"Authorization": f"Bearer {token}"}
+                              )
+        assert response.status_code == 429, response.text
+        assert response.headers["Retry-After"] == "6"
+        assert response.headers["RateLimit-Remaining"] == "0"
+
+
+def test_get_contacts_invalid_cursor(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
+        response = client.get("/api/contacts/", params={"cursor": "broken", "sort_by": "last_name"},
+                              headers={"Authorization": f"Bearer {token}"}
+                              )
+        assert response.status_code == 400, response.text
 
 
 def test_get_contact_by_id(client, token):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
         response = client.get("/api/contacts/1",
                               headers={"Authorization": f"Bearer {token}"}
@@ -68,8 +132,52 @@ def test_get_contact_by_id(client, token):
         assert data["first_name"] == "Tom"
 
 
+def test_get_contact_by_id_etag(client, token, cache_store):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        headers = {"Authorization": f"Bearer {token}"}
+        response = client.get("/api/contacts/1", headers=headers)
+        assert response.status_code == 200, response.text
+        etag = response.headers["ETag"]
+        headers["If-None-Match"] = etag
+
+        with patch.object(repository_contacts, 'get_contact_by_id', side_effect=AssertionError) as db_read:
+            response = client.get("/api/contacts/1", headers=headers)
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        db_read.assert_not_called()
+
+        response = client.patch("/api/contacts/bulk",
+                                json={"selection": {"ids": [1]}, "values": {"last_name": "Soyer"}},
+                                headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200, response.text
+
+        with patch.object(repository_contacts, 'get_contact_by_id',
+                          wraps=repository_contacts.get_contact_by_id) as db_read:
+            response = client.get("/api/contacts/1", headers=headers)
+        assert response.status_code == 200, response.text
+        assert response.headers["ETag"] != etag
+        db_read.assert_called_once()
+
+
+def test_get_contact_of_other_user(client, token, session):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        other = User(username="other", email="other@example.com", password="x", confirmed=True)
+        session.add(other)
+        session.commit()
+        contact = Contact(first_name="Other", last_name="Owner", email="owner@example.com", phone="+100000001",
+                          date_of_birth=datetime(2000, 1, 1).date(), user_id=other.id)
+        session.add(contact)
+        session.commit()
+        response = client.get(f"/api/contacts/{contact.id}", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 404, response.text
+        session.delete(contact)
+        session.commit()
+
+
 def test_get_birthday(client, token):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
         response = client.get("/api/contacts/birthday",
                               headers={"Authorization": f"Bearer {token}"}
@@ -77,8 +185,159 @@ def test_get_birthday(client, token):
         assert response.status_code == 200, response.text
 
 
+def test_search_contacts(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.get("/api/contacts/search", params={"q": "soy"},
+                              headers={"Authorization": f"Bearer {token}"}
+                              )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data[0]["last_name"] == "Soyer"
+
+
+def test_import_contacts_csv(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
+        content = ("first_name,last_name,email,phone,date_of_birth\n"
+                   "Huck,Finn,huck@example.com,+31462450001,2017-05-01\n"
+                   "Tom,Again,Tomas@example.com,+31462450002,2018-04-30\n"
+                   "\n"
+                   "Becky,\"Thatcher\nJr\",not-an-email,+31462450003,2018-01-01\n")
+        response = client.post("/api/contacts/import",
+                               files={"file": ("contacts.csv", content, "text/csv")},
+                               headers={"Authorization": f"Bearer {token}"}
+                               )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["imported"] == 1
+        assert data["failed"] == 2
+        assert [error["line"] for error in data["errors"]] == [5, 3]
+
+
+def test_import_contacts_ndjson(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
+        content = ('{"first_name": "Joe", "last_name": "Harper", "email": "joe@example.com", '
+                   '"phone": "+31462450004", "date_of_birth": "2017-06-01"}\n'
+                   '\n'
+                   '{"first_name": "broken"\n')
+        response = client.post("/api/contacts/import", params={"format": "ndjson"},
+                               files={"file": ("contacts.txt", content, "application/x-ndjson")},
+                               headers={"Authorization": f"Bearer {token}"}
+                               )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["imported"] == 1
+        assert data["errors"][0]["line"] == 3
+
+
+def test_export_contacts_ndjson(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.get("/api/contacts/export",
+                              headers={"Authorization": f"Bearer {token}"}
+                              )
+        assert response.status_code == 200, response.text
+        assert response.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["first_name"] for row in rows] == ["Tom", "Huck", "Joe"]
+
+
+def test_export_contacts_csv_gzip(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.get("/api/contacts/export", params={"format": "csv", "gzip": True},
+                              headers={"Authorization": f"Bearer {token}"}
+                              )
+        assert response.status_code == 200, response.text
+        lines = gzip.decompress(response.content).decode().splitlines()
+        assert lines[0].startswith("id,first_name,last_name,email")
+        assert len(lines) == 4
+
+
+def test_import_contacts_unreadable_csv(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
+        header = b"first_name,last_name,email,phone,date_of_birth\n"
+        for content, lines in ((header + b"Sid,Sawyer,not-an-email,+31462450005,2017-05-01\n"
+                                + "\u0411\u0435\u043a\u0438,Thatcher,becky@example.com,+31462450006,2018-01-01\n"
+                                .encode("cp1251"), [2, 3]),
+                               (header + b"Sid," + b"x" * 200_000 + b",sid@example.com,+31462450005,2017-05-01\n",
+                                [2])):
+            response = client.post("/api/contacts/import",
+                                   files={"file": ("contacts.csv", content, "text/csv")},
+                                   headers={"Authorization": f"Bearer {token}"}
+                                   )
+            assert response.status_code == 200, response.text
+            data = response.json()
+            assert data["imported"] == 0
+            assert [error["line"] for error in data["errors"]] == lines
+            assert data["errors"][-1]["detail"].startswith("Unreadable CSV")
+
+
+def test_import_contacts_ndjson_bad_encoding(client, token, monkeypatch):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        monkeypatch.setattr(rate_limit_store, 'redis', limiter_redis())
+        content = ('{"first_name": "\u0411\u0435\u043a\u0438"}\n'.encode("cp1251")
+                   + b'{"first_name": "Sid"}\n')
+        response = client.post("/api/contacts/import", params={"format": "ndjson"},
+                               files={"file": ("contacts.txt", content, "application/x-ndjson")},
+                               headers={"Authorization": f"Bearer {token}"}
+                               )
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["failed"] == 2
+        assert [error["line"] for error in data["errors"]] == [1, 2]
+        assert "utf-8" in data["errors"][0]["detail"]
+
+
+def test_bulk_update_contacts(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.patch("/api/contacts/bulk",
+                                json={"selection": {"ids": [2, 3, 999]}, "values": {"last_name": "Bulk"}},
+                                headers={"Authorization": f"Bearer {token}"}
+                                )
+        assert response.status_code == 200, response.text
+        assert sorted(response.json()["ids"]) == [2, 3]
+
+
+def test_bulk_update_contacts_conflict(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.patch("/api/contacts/bulk",
+                                json={"selection": {"last_name": "Bulk"}, "values": {"phone": "+31462454652"}},
+                                headers={"Authorization": f"Bearer {token}"}
+                                )
+        assert response.status_code == 409, response.text
+
+
+def test_bulk_remove_contacts_requires_selection(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.post("/api/contacts/bulk/delete", json={},
+                               headers={"Authorization": f"Bearer {token}"}
+                               )
+        assert response.status_code == 422, response.text
+
+
+def test_bulk_remove_contacts(client, token):
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
+        r_mock.get.return_value = None
+        response = client.post("/api/contacts/bulk/delete", json={"last_name": "Bulk"},
+                               headers={"Authorization": f"Bearer {token}"}
+                               )
+        assert response.status_code == 200, response.text
+        assert sorted(response.json()["ids"]) == [2, 3]
+
+
 def test_update_contact(client, token):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
         response = client.put("/api/contacts/1",
                               json={
@@ -96,7 +355,7 @@ def test_update_contact(client, token):
 
 
 def test_remove_contact(client, token):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
         response = client.delete("/api/contacts/1",
                                  headers={"Authorization": f"Bearer {token}"}
@@ -105,7 +364,7 @@ def test_remove_contact(client, token):
 
 
 def test_repeat_remove_contact(client, token):
-    with patch.object(auth_service, 'r') as r_mock:
+    with patch.object(user_cache, 'redis', new_callable=AsyncMock) as r_mock:
         r_mock.get.return_value = None
         response = client.delete("/api/contacts/1",
                                  headers={"Authorization": f"Bearer {token}"}
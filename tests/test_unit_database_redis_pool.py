@@ -0,0 +1,42 @@
+import unittest
+
+import redis.asyncio as redis
+
+from src.conf.config import settings
+from src.database.redis_pool import pool, redis_client, redis_pool_status
+
+
+class TestRedisPool(unittest.TestCase):
+
+    def test_shared_pool_settings(self):
+        self.assertIs(redis_client.connection_pool, pool)
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, settings.redis_max_connections)
+        self.assertEqual(pool.timeout, settings.redis_pool_timeout)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], settings.redis_socket_timeout)
+
+    def test_redis_pool_status(self):
+        connection_pool = redis.BlockingConnectionPool(max_connections=3)
+        self.assertEqual(redis_pool_status(connection_pool),
+                         {"max_connections": 3, "created": 0, "in_use": 0, "idle": 0})
+        # check out two connections the way get_connection does, without connecting them
+        connections = []
+        for _ in range(2):
+            connection_pool.pool.get_nowait()
+            connections.append(connection_pool.make_connection())
+        self.assertEqual(redis_pool_status(connection_pool),
+                         {"max_connections": 3, "created": 2, "in_use": 2, "idle": 0})
+        connection_pool.pool.put_nowait(connections.pop())
+        self.assertEqual(redis_pool_status(connection_pool),
+                         {"max_connections": 3, "created": 2, "in_use": 1, "idle": 1})
+
+    def test_redis_pool_status_without_internals(self):
+        class Pool:
+            max_connections = 3
+
+        self.assertEqual(redis_pool_status(Pool()),
+                         {"max_connections": 3, "created": None, "in_use": None, "idle": None})
+
+
+if __name__ == '__main__':
+    unittest.main()
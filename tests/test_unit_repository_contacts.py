@@ -1,20 +1,32 @@
 import datetime
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, AsyncMock, patch
 from datetime import date
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 
-from src.database.models import Contact, User
-from src.schemas import ContactModel
+from src.database.models import Base, Contact, User
+from src.schemas import ContactModel, ContactSelection, ContactPartialModel
+from src.services.birthday_digest import birthday_digest
 from src.repository.contacts import (
     get_contact_by_id,
     get_contacts,
+    encode_cursor,
+    decode_cursor,
     verify_email_phone,
     get_contact_birthday,
+    get_birthday_digest,
+    search_contacts,
+    stream_contacts,
+    stream_upcoming_birthdays,
     create_contact,
+    create_contacts,
     update_contact,
+    update_contacts,
     remove_contact,
+    remove_contacts,
 )
 
 
@@ -34,48 +46,82 @@ class TestContacts(unittest.IsolatedAsyncioTestCase):
 
     async def test_get_contacts(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().offset().limit().all.return_value = contacts
-        result = await get_contacts(skip=0, limit=10, first_name='', last_name='', email='', db=self.session)
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name='', last_name='', email='',
+                                                 db=self.session, user=self.user)
         self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
 
     async def test_get_contacts_by_first_name(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts(skip=0, limit=10, first_name=self.contact_test.first_name,
-                                    last_name='', email='', db=self.session)
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name=self.contact_test.first_name,
+                                                 last_name='', email='', db=self.session, user=self.user)
         self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
 
     async def test_get_contacts_by_first_name_and_email(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().select_from().filter().all.return_value = contacts
-        result = await get_contacts(skip=0, limit=10, first_name=self.contact_test.first_name,
-                                    last_name='', email=self.contact_test.email, db=self.session)
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name=self.contact_test.first_name,
+                                                 last_name='', email=self.contact_test.email, db=self.session,
+                                                 user=self.user)
         self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
 
     async def test_get_contacts_by_last_name(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts(skip=0, limit=10, first_name='',
-                                    last_name=self.contact_test.last_name, email='', db=self.session)
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name='',
+                                                 last_name=self.contact_test.last_name, email='',
+                                                 db=self.session, user=self.user)
         self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
 
     async def test_get_contacts_by_last_name_and_email(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().select_from().filter().all.return_value = contacts
-        result = await get_contacts(skip=0, limit=10, first_name='', last_name=self.contact_test.last_name,
-                                    email=self.contact_test.email, db=self.session)
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name='',
+                                                 last_name=self.contact_test.last_name,
+                                                 email=self.contact_test.email, db=self.session,
+                                                 user=self.user)
         self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
 
     async def test_get_contacts_by_email(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts(skip=0, limit=10, first_name='',
-                                    last_name='', email=self.contact_test.email, db=self.session)
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name='', last_name='',
+                                                 email=self.contact_test.email, db=self.session,
+                                                 user=self.user)
+        self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
+
+    async def test_get_contacts_next_cursor(self):
+        contacts = [self.contact_test, Contact(id=2, last_name='Smith'), Contact(id=3, last_name='Young')]
+        self.session.execute().scalars().all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=2, first_name='', last_name='', email='',
+                                                 db=self.session, user=self.user, sort_by='last_name')
+        self.assertEqual(result, contacts[:2])
+        self.assertEqual(decode_cursor(next_cursor, 'last_name'), ('Smith', 2))
+
+    async def test_get_contacts_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            await get_contacts(limit=10, first_name='', last_name='', email='', db=self.session,
+                               user=self.user, cursor='not-a-cursor')
+        with self.assertRaises(ValueError):
+            await get_contacts(limit=10, first_name='', last_name='', email='', db=self.session,
+                               user=self.user, cursor=encode_cursor('email', self.contact_test))
+
+    async def test_search_contacts(self):
+        contacts = [self.contact_test]
+        self.session.execute().scalars().all.return_value = contacts
+        result = await search_contacts(q='bu', skip=0, limit=10, db=self.session, user=self.user)
         self.assertEqual(result, contacts)
 
     async def test_get_contact_by_id(self):
         contacts = [self.contact_test, Contact(), Contact()]
-        self.session.query().filter().first.return_value = contacts
+        self.session.execute().scalars().first.return_value = contacts
         result = await get_contact_by_id(contact_id=self.contact_test.id, db=self.session)
         self.assertEqual(result, contacts)
 
@@ -87,22 +133,29 @@ class TestContacts(unittest.IsolatedAsyncioTestCase):
             phone=self.contact_test.email,
             date_of_birth=self.contact_test.date_of_birth,
         )
+        self.session.execute.return_value.scalars.return_value.one.return_value = self.contact_test
         result = await create_contact(body=body, db=self.session, user=self.user)
-        self.assertEqual(result.first_name, body.first_name)
-        self.assertEqual(result.last_name, body.last_name)
-        self.assertEqual(result.email, body.email)
-        self.assertEqual(result.phone, body.phone)
-        self.assertEqual(result.date_of_birth, body.date_of_birth)
-        self.assertTrue(hasattr(result, "id"))
+        self.assertEqual(result, self.contact_test)
+        self.session.execute.assert_called_once()
+        params = self.session.execute.call_args[0][0].compile().params
+        self.assertEqual(params["first_name"], body.first_name)
+        self.assertEqual(params["last_name"], body.last_name)
+        self.assertEqual(params["email"], body.email)
+        self.assertEqual(params["phone"], body.phone)
+        self.assertEqual(params["date_of_birth"], body.date_of_birth)
+        self.assertEqual(params["birthday_key"], 1008)
+        self.assertEqual(params["user_id"], self.user.id)
+        self.session.commit.assert_called_once()
+        self.session.refresh.assert_not_called()
 
     async def test_remove_contact(self):
         contact = self.contact_test
-        self.session.query().filter().first.return_value = contact
+        self.session.execute().scalars().first.return_value = contact
         result = await remove_contact(contact_id=self.contact_test.id, db=self.session, user=self.user)
         self.assertEqual(result, contact)
 
     async def test_remove_contact_not_found(self):
-        self.session.query().filter().first.return_value = None
+        self.session.execute().scalars().first.return_value = None
         result = await remove_contact(contact_id=self.contact_test.id, db=self.session, user=self.user)
         self.assertIsNone(result)
 
@@ -114,7 +167,7 @@ class TestContacts(unittest.IsolatedAsyncioTestCase):
             email=self.contact_test.email,
             phone=self.contact_test.email,
             date_of_birth=self.contact_test.date_of_birth)
-        self.session.query().filter().first.return_value = contact
+        self.session.execute().scalars().first.return_value = contact
         result = await update_contact(contact_id=self.contact_test.id, body=body, db=self.session, user=self.user)
         self.assertEqual(result, contact)
 
@@ -125,31 +178,256 @@ class TestContacts(unittest.IsolatedAsyncioTestCase):
             email=self.contact_test.email,
             phone=self.contact_test.email,
             date_of_birth=self.contact_test.date_of_birth)
-        self.session.query().filter().first.return_value = None
+        self.session.execute().scalars().first.return_value = None
         result = await update_contact(contact_id=self.contact_test.id, body=body, db=self.session, user=self.user)
         self.assertIsNone(result)
 
     async def test_verify_email(self):
         contacts = self.contact_test
-        self.session.query().filter().first.return_value = contacts
+        self.session.execute().first.return_value = contacts
         result = await verify_email_phone(email=self.contact_test.email, phone='', db=self.session)
         self.assertEqual(result, contacts)
 
     async def test_verify_phone(self):
         contacts = self.contact_test
-        self.session.query().filter().first.return_value = contacts
+        self.session.execute().first.return_value = contacts
         result = await verify_email_phone(email='', phone=self.contact_test.phone, db=self.session)
         self.assertEqual(result, contacts)
 
-    async def get_contact_birthday(self):
+    async def test_get_contact_birthday(self):
         contacts = [self.contact_test,
                     Contact(date_of_birth=datetime.date(year=1986, month=4, day=25)),
                     Contact(date_of_birth=datetime.date(year=1987, month=4, day=27))]
-        self.session.query().offset().limit().all.return_value = contacts
+        self.session.execute().scalars().all.return_value = contacts
 
-        result = await get_contact_birthday(skip=0, limit=10, db=self.session)
+        result = await get_contact_birthday(skip=0, limit=10, db=self.session, user=self.user)
         self.assertListEqual(result, contacts)
 
+    def test_birthday_key_follows_date_of_birth(self):
+        self.assertEqual(self.contact_test.birthday_key, 1008)
+        self.contact_test.date_of_birth = datetime.date(year=1985, month=2, day=3)
+        self.assertEqual(self.contact_test.birthday_key, 203)
+
+
+class TestContactsAsyncSession(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.session = AsyncMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
+        self.user = User(id=1)
+        self.contact_test = Contact(
+            id=1,
+            first_name='Buster',
+            last_name='Johns',
+            email='buster@meta.ua',
+            phone='+35428421424',
+            date_of_birth=datetime.date(year=1985, month=10, day=8),
+        )
+
+    async def test_get_contacts(self):
+        contacts = [self.contact_test, Contact(), Contact()]
+        self.session.execute.return_value.scalars.return_value.all.return_value = contacts
+        result, next_cursor = await get_contacts(limit=10, first_name='', last_name='', email='',
+                                                 db=self.session, user=self.user)
+        self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
+        self.session.execute.assert_awaited_once()
+
+    async def test_create_contact(self):
+        body = ContactModel(
+            first_name=self.contact_test.first_name,
+            last_name=self.contact_test.last_name,
+            email=self.contact_test.email,
+            phone=self.contact_test.phone,
+            date_of_birth=self.contact_test.date_of_birth,
+        )
+        self.session.execute.return_value.scalars.return_value.one.return_value = self.contact_test
+        result = await create_contact(body=body, db=self.session, user=self.user)
+        self.assertEqual(result, self.contact_test)
+        self.session.execute.assert_awaited_once()
+        self.session.commit.assert_awaited_once()
+        self.session.refresh.assert_not_called()
+
+    async def test_remove_contact(self):
+        contact = self.contact_test
+        self.session.execute.return_value.scalars.return_value.first.return_value = contact
+        result = await remove_contact(contact_id=self.contact_test.id, db=self.session, user=self.user)
+        self.assertEqual(result, contact)
+        self.session.delete.assert_awaited_once_with(contact)
+        self.session.commit.assert_awaited_once()
+
+
+class TestContactsAioSqlite(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://")
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session = async_sessionmaker(bind=self.engine, expire_on_commit=False)()
+        self.user = User(username='User1', email='user1@gmail.com', password='qwerty')
+        self.session.add(self.user)
+        await self.session.commit()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.engine.dispose()
+
+    async def test_create_and_get_contact(self):
+        body = ContactModel(
+            first_name='Buster',
+            last_name='Johns',
+            email='buster@meta.ua',
+            phone='+35428421424',
+            date_of_birth=datetime.date(year=1985, month=10, day=8),
+        )
+        contact = await create_contact(body=body, db=self.session, user=self.user)
+        result = await get_contact_by_id(contact_id=contact.id, db=self.session)
+        self.assertEqual(result.email, body.email)
+        self.assertIsNotNone(await verify_email_phone(email=body.email, phone='', db=self.session))
+        result, next_cursor = await get_contacts(limit=10, first_name='Buster', last_name='', email='',
+                                                 db=self.session, user=self.user)
+        self.assertEqual([c.id for c in result], [contact.id])
+        self.assertIsNone(next_cursor)
+
+
+    async def test_keyset_pages(self):
+        for i, last_name in enumerate(['Young', 'Adams', 'Smith', 'Adams']):
+            body = ContactModel(first_name=f'Name{i}', last_name=last_name, email=f'user{i}@meta.ua',
+                                phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=1, day=1))
+            await create_contact(body=body, db=self.session, user=self.user)
+        seen, cursor = [], None
+        while True:
+            page, cursor = await get_contacts(limit=3, first_name='', last_name='', email='', db=self.session,
+                                              user=self.user, cursor=cursor, sort_by='last_name')
+            seen.extend(c.last_name for c in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['Adams', 'Adams', 'Smith', 'Young'])
+
+    async def test_get_contact_birthday_year_wrap(self):
+        births = [(12, 30), (1, 2), (1, 10), (12, 20), (12, 28)]
+        for i, (month, day) in enumerate(births):
+            body = ContactModel(first_name=f'Name{i}', last_name='Johns', email=f'user{i}@meta.ua',
+                                phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=month, day=day))
+            await create_contact(body=body, db=self.session, user=self.user)
+        result = await get_contact_birthday(skip=0, limit=10, db=self.session, user=self.user,
+                                            days=7, today=datetime.date(year=2023, month=12, day=28))
+        self.assertEqual([(c.date_of_birth.month, c.date_of_birth.day) for c in result],
+                         [(12, 28), (12, 30), (1, 2)])
+
+    async def test_get_birthday_digest(self):
+        store = {}
+        r_mock = AsyncMock()
+        r_mock.get.side_effect = store.get
+        r_mock.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+        for i, (month, day) in enumerate([(12, 30), (1, 2), (12, 20)]):
+            body = ContactModel(first_name=f'Name{i}', last_name='Johns', email=f'user{i}@meta.ua',
+                                phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=month, day=day))
+            await create_contact(body=body, db=self.session, user=self.user)
+        today = datetime.date(year=2023, month=12, day=28)
+        with patch.object(birthday_digest, 'redis', r_mock):
+            first = await get_birthday_digest(skip=0, limit=10, db=self.session, user=self.user, days=7, today=today)
+            with patch.object(self.session, 'execute', side_effect=AssertionError):
+                second = await get_birthday_digest(skip=0, limit=10, db=self.session, user=self.user, days=7,
+                                                   today=today)
+        self.assertEqual([c['first_name'] for c in first], ['Name0', 'Name1'])
+        self.assertEqual(second, first)
+
+    async def test_search_contacts(self):
+        for i, (first_name, last_name) in enumerate([('Buster', 'Johns'), ('Anna', 'Johnson'), ('Tom', 'Soyer')]):
+            body = ContactModel(first_name=first_name, last_name=last_name, email=f'{first_name.lower()}@meta.ua',
+                                phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=1, day=1))
+            await create_contact(body=body, db=self.session, user=self.user)
+        result = await search_contacts(q='ohns', skip=0, limit=10, db=self.session, user=self.user)
+        self.assertEqual({c.last_name for c in result}, {'Johns', 'Johnson'})
+        result = await search_contacts(q='to', skip=0, limit=10, db=self.session, user=self.user)
+        self.assertEqual([c.first_name for c in result], ['Tom'])
+
+        contact = result[0]
+        body = ContactModel(first_name='Thomas', last_name='Sawyer', email=contact.email, phone=contact.phone,
+                            date_of_birth=contact.date_of_birth)
+        await update_contact(contact_id=contact.id, body=body, db=self.session, user=self.user)
+        self.assertEqual(await search_contacts(q='Soyer', skip=0, limit=10, db=self.session, user=self.user), [])
+        result = await search_contacts(q='Sawyer', skip=0, limit=10, db=self.session, user=self.user)
+        self.assertEqual([c.id for c in result], [contact.id])
+
+    async def test_create_contacts(self):
+        bodies = [ContactModel(first_name='Name', last_name='Johns', email=f'user{i % 2}@meta.ua',
+                               phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=3, day=4))
+                  for i in range(3)]
+        inserted = await create_contacts(bodies=bodies, db=self.session, user=self.user)
+        self.assertEqual(inserted, {'user0@meta.ua', 'user1@meta.ua'})
+        result = await get_contact_birthday(skip=0, limit=10, db=self.session, user=self.user,
+                                            today=datetime.date(year=2023, month=3, day=1))
+        self.assertEqual(len(result), 2)
+
+    async def test_stream_contacts(self):
+        bodies = [ContactModel(first_name=f'Name{i}', last_name='Johns', email=f'user{i}@meta.ua',
+                               phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=3, day=4))
+                  for i in range(5)]
+        await create_contacts(bodies=bodies, db=self.session, user=self.user)
+        partitions = [partition async for partition in
+                      stream_contacts(db=self.session, user=self.user, columns=('id', 'email'), batch_size=2)]
+        self.assertEqual([len(partition) for partition in partitions], [2, 2, 1])
+        self.assertEqual([row.email for partition in partitions for row in partition],
+                         [body.email for body in bodies])
+
+    async def test_stream_upcoming_birthdays(self):
+        other = User(username='User2', email='user2@gmail.com', password='qwerty', confirmed=True)
+        unconfirmed = User(username='User3', email='user3@gmail.com', password='qwerty')
+        self.session.add_all([other, unconfirmed])
+        self.user.confirmed = True
+        await self.session.commit()
+        for i, (owner, month, day) in enumerate([(other, 1, 2), (self.user, 12, 30), (self.user, 6, 1),
+                                                 (other, 12, 29), (unconfirmed, 12, 30), (self.user, 12, 28)]):
+            body = ContactModel(first_name=f'Name{i}', last_name='Johns', email=f'user{i}@meta.ua',
+                                phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=month, day=day))
+            await create_contact(body=body, db=self.session, user=owner)
+        today = datetime.date(year=2023, month=12, day=28)
+        partitions = [partition async for partition in
+                      stream_upcoming_birthdays(db=self.session, today=today, days=7, after_user_id=0, batch_size=2)]
+        self.assertEqual([len(partition) for partition in partitions], [2, 2])
+        self.assertEqual([(row.email, row.first_name) for partition in partitions for row in partition],
+                         [('user1@gmail.com', 'Name5'), ('user1@gmail.com', 'Name1'),
+                          ('user2@gmail.com', 'Name3'), ('user2@gmail.com', 'Name0')])
+        partitions = [partition async for partition in
+                      stream_upcoming_birthdays(db=self.session, today=today, days=7, after_user_id=self.user.id,
+                                                batch_size=10)]
+        self.assertEqual([row.username for partition in partitions for row in partition], ['User2', 'User2'])
+
+    async def test_update_and_remove_contacts(self):
+        bodies = [ContactModel(first_name=f'Name{i}', last_name='Johns', email=f'user{i}@meta.ua',
+                               phone=f'+3800000000{i}', date_of_birth=datetime.date(year=1990, month=3, day=4))
+                  for i in range(3)]
+        await create_contacts(bodies=bodies, db=self.session, user=self.user)
+        other = User(username='User2', email='user2@gmail.com', password='qwerty')
+        self.session.add(other)
+        await self.session.commit()
+
+        ids = await update_contacts(selection=ContactSelection(last_name='Johns'),
+                                    body=ContactPartialModel(date_of_birth=datetime.date(year=1991, month=7, day=1)),
+                                    db=self.session, user=self.user)
+        self.assertEqual(sorted(ids), [1, 2, 3])
+        result = await get_contact_birthday(skip=0, limit=10, db=self.session, user=self.user,
+                                            today=datetime.date(year=2023, month=6, day=30))
+        self.assertEqual(len(result), 3)
+
+        self.assertEqual(await remove_contacts(selection=ContactSelection(ids=[1, 2]), db=self.session, user=other),
+                         [])
+        ids = await remove_contacts(selection=ContactSelection(ids=[1, 2]), db=self.session, user=self.user)
+        self.assertEqual(sorted(ids), [1, 2])
+
+    async def test_create_contact_duplicate(self):
+        body = ContactModel(first_name='Buster', last_name='Johns', email='buster@meta.ua',
+                            phone='+35428421424', date_of_birth=datetime.date(year=1985, month=10, day=8))
+        contact = await create_contact(body=body, db=self.session, user=self.user)
+        self.assertIsNotNone(contact.created_at)
+        with self.assertRaises(IntegrityError):
+            await create_contact(body=body, db=self.session, user=self.user)
+        await self.session.refresh(self.user)
+        result, _ = await get_contacts(limit=10, first_name='', last_name='', email='', db=self.session,
+                                       user=self.user)
+        self.assertEqual([c.id for c in result], [contact.id])
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,21 @@
 import datetime
+import threading
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, AsyncMock, patch
 
 
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.database.models import Contact, User
 from src.schemas import UserModel
+from src.services.bloom import registered_emails
+from src.services.user_cache import MISSING, user_cache, UserSnapshot
 from src.repository.users import (
     get_user_by_email,
     create_user,
-    update_token,
+    stream_user_emails,
+    update_password,
     confirmed_email,
     update_avatar,
 )
@@ -19,6 +24,10 @@ from src.repository.users import (
 class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
+        redis_patcher = patch.object(user_cache, 'redis', new_callable=AsyncMock)
+        self.redis = redis_patcher.start()
+        self.addCleanup(redis_patcher.stop)
+        self.addCleanup(user_cache.local.clear)
         self.session = MagicMock(spec=Session)
         self.user = User(
             id=1,
@@ -38,10 +47,71 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     async def test_get_user_by_email(self):
         user = self.user
-        self.session.query().filter().first.return_value = user
+        self.session.execute().scalars().first.return_value = user
         result = await get_user_by_email(email=self.user.email, db=self.session)
         self.assertEqual(result, user)
 
+    async def test_unknown_email_is_cached_as_missing(self):
+        self.redis.get.return_value = None
+        self.session.execute.return_value.scalars.return_value.first.return_value = None
+        self.assertIsNone(await get_user_by_email(email='nobody@gmail.com', db=self.session))
+        self.assertEqual(self.redis.set.call_args[0], (user_cache.key('nobody@gmail.com'), MISSING))
+        self.assertTrue(self.redis.set.call_args[1]['nx'])
+        self.assertIsNone(await get_user_by_email(email='Nobody@gmail.com', db=self.session))
+        self.session.execute.assert_called_once()
+
+    async def test_missing_marker_from_another_worker(self):
+        self.redis.get.return_value = MISSING
+        self.assertIsNone(await get_user_by_email(email='nobody@gmail.com', db=self.session))
+        self.session.execute.assert_not_called()
+
+    async def test_bloom_filter_skips_query(self):
+        self.redis.get.return_value = None
+        with patch('src.repository.users.settings.user_bloom_enabled', True), \
+                patch.object(registered_emails, 'might_contain', AsyncMock(return_value=False)) as might_contain:
+            self.assertIsNone(await get_user_by_email(email='Nobody@gmail.com', db=self.session))
+        might_contain.assert_awaited_once_with('nobody@gmail.com')
+        self.session.execute.assert_not_called()
+
+    async def test_create_user_drops_missing_marker(self):
+        self.redis.get.return_value = None
+        self.session.execute.return_value.scalars.return_value.first.return_value = None
+        await get_user_by_email(email=self.user.email, db=self.session)
+        body = UserModel(username=self.user.username, email=self.user.email, password=self.user.password)
+        with patch('src.repository.users.settings.user_bloom_enabled', True), \
+                patch.object(registered_emails, 'add', AsyncMock()) as add:
+            await create_user(body=body, db=self.session)
+        add.assert_awaited_once_with(self.user.email)
+        self.assertEqual(self.redis.set.call_args[0][0], user_cache.key(self.user.email))
+        self.assertNotEqual(self.redis.set.call_args[0][1], MISSING)
+        self.assertFalse(await user_cache.is_missing(self.user.email))
+
+    async def test_lookup_racing_signup_does_not_cache_missing(self):
+        store = {}
+
+        async def set_(key, value, ex=None, nx=False):
+            if nx and key in store:
+                return None
+            store[key] = value
+            return True
+
+        async def execute(statement):
+            # the signup commits after the lookup read no row but before it caches the miss
+            await create_user(body=body, db=self.session)
+            return no_rows
+
+        body = UserModel(username=self.user.username, email=self.user.email, password=self.user.password)
+        no_rows = MagicMock()
+        no_rows.scalars.return_value.first.return_value = None
+        self.redis.get.side_effect = store.get
+        self.redis.set.side_effect = set_
+        self.session.execute.side_effect = execute
+        self.assertIsNone(await get_user_by_email(email=self.user.email, db=self.session))
+        self.assertFalse(await user_cache.is_missing(self.user.email))
+        user_cache.local.clear()
+        self.assertFalse(await user_cache.is_missing(self.user.email))
+        self.assertEqual((await user_cache.get(self.user.email)).username, self.user.username)
+
     async def test_create_user(self):
         body = UserModel(
             username=self.user.username,
@@ -55,15 +125,38 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(result.password, body.password)
         self.assertTrue(hasattr(result, "id"))
 
+    async def test_stream_user_emails_off_the_event_loop(self):
+        threads = []
+
+        def execute(statement):
+            threads.append(threading.current_thread())
+            result = MagicMock()
+            result.scalars.return_value.partitions.return_value = iter([('a@x.com', 'b@x.com'), ('c@x.com',)])
+            return result
+
+        self.session.execute.side_effect = execute
+        batches = [batch async for batch in stream_user_emails(self.session, batch_size=2)]
+        self.assertEqual(batches, [['a@x.com', 'b@x.com'], ['c@x.com']])
+        self.assertNotEqual(threads, [threading.current_thread()])
+
     async def test_confirmed_email(self):
+        self.session.execute().scalars().first.return_value = self.user
         result = await confirmed_email(email=self.user.email, db=self.session)
         self.assertIsNone(result)
 
-    async def test_update_token(self):
-        user = self.user
-        token = None
-        result = await update_token(user=user, token=token, db=self.session)
+    async def test_update_password(self):
+        result = await update_password(user=self.user, password='new hash', db=self.session)
         self.assertIsNone(result)
+        self.assertEqual(self.user.password, 'new hash')
+        self.session.commit.assert_called_once()
+
+    async def test_confirmed_email_rewrites_cache(self):
+        self.user.confirmed = False
+        self.session.execute.return_value.scalars.return_value.first.return_value = self.user
+        await confirmed_email(email=self.user.email, db=self.session)
+        key, data = self.redis.set.call_args[0]
+        self.assertEqual(key, user_cache.key(self.user.email))
+        self.assertEqual(UserSnapshot.loads(data), UserSnapshot.from_user(self.user))
 
     async def update_avatar(self):
         url = 'https://res.cloudinary.com/web9storage/image/upload/c_fill,h_250,w_250/v1/Web9_FastapiAPP/Johny3'
@@ -71,6 +164,34 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
         result = await update_avatar(email=self.user.email, url=url, db=self.session)
         self.assertEqual(result, user)
 
+class TestUsersAsyncSession(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        redis_patcher = patch.object(user_cache, 'redis', new_callable=AsyncMock)
+        self.redis = redis_patcher.start()
+        self.addCleanup(redis_patcher.stop)
+        self.session = AsyncMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
+        self.user = User(
+            id=1,
+            username='User1',
+            email='user1@gmail.com',
+            password='qwerty',
+            confirmed=False,
+        )
+
+    async def test_get_user_by_email(self):
+        self.session.execute.return_value.scalars.return_value.first.return_value = self.user
+        result = await get_user_by_email(email=self.user.email, db=self.session)
+        self.assertEqual(result, self.user)
+        self.session.execute.assert_awaited_once()
+
+    async def test_confirmed_email(self):
+        self.session.execute.return_value.scalars.return_value.first.return_value = self.user
+        await confirmed_email(email=self.user.email, db=self.session)
+        self.assertTrue(self.user.confirmed)
+        self.session.commit.assert_awaited_once()
+        self.assertTrue(UserSnapshot.loads(self.redis.set.call_args[0][1]).confirmed)
 
 
 if __name__ == '__main__':
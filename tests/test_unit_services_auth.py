@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import redis
+from fastapi import HTTPException
+from jose import JWTError, jwt
+from passlib.context import CryptContext
+
+from src.services.auth import Auth
+from src.services.refresh_tokens import refresh_token_store
+from src.services.user_cache import LRUCache
+
+
+class TestVerifiedTokenCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        client = MagicMock()
+        client.pipeline.return_value.execute = AsyncMock()
+        redis_patcher = patch.object(refresh_token_store, 'redis', client)
+        redis_patcher.start()
+        self.addCleanup(redis_patcher.stop)
+        self.auth = Auth()
+        self.now = time.monotonic()
+        self.auth.token_cache = LRUCache(16, ttl=0, clock=lambda: self.now)
+
+    async def test_repeat_decode_skips_verification(self):
+        token = await self.auth.create_access_token(data={"sub": "user@example.com"})
+        with patch('src.services.auth.jwt.decode', wraps=jwt.decode) as decode:
+            first = self.auth.decode_token(token)
+            second = self.auth.decode_token(token)
+        decode.assert_called_once()
+        self.assertIs(first, second)
+        self.assertEqual(second["sub"], "user@example.com")
+        with self.assertRaises(TypeError):
+            second["sub"] = "other@example.com"
+
+    async def test_cached_claims_expire_with_token(self):
+        token = await self.auth.create_access_token(data={"sub": "user@example.com"}, expires_delta=1)
+        self.auth.decode_token(token)
+        self.now += 61
+        with patch('src.services.auth.jwt.decode', side_effect=jwt.ExpiredSignatureError) as decode:
+            with self.assertRaises(JWTError):
+                self.auth.decode_token(token)
+        decode.assert_called_once()
+
+    async def test_expired_token_is_rejected(self):
+        token = await self.auth.create_access_token(data={"sub": "user@example.com"}, expires_delta=-1)
+        with self.assertRaises(JWTError):
+            self.auth.decode_token(token)
+        self.assertEqual(len(self.auth.token_cache), 0)
+
+    async def test_invalid_token_is_not_cached(self):
+        token = await self.auth.create_access_token(data={"sub": "user@example.com"})
+        with self.assertRaises(JWTError):
+            self.auth.decode_token(token[:-2] + "xx")
+        self.assertEqual(len(self.auth.token_cache), 0)
+
+    async def test_forget_token(self):
+        token = await self.auth.create_refresh_token(data={"sub": "user@example.com"})
+        self.assertEqual(self.auth.decode_token(token)["sub"], "user@example.com")
+        self.auth.forget_token(token)
+        self.assertEqual(len(self.auth.token_cache), 0)
+
+    async def test_session_store_down_fails_closed(self):
+        refresh_token_store.redis.pipeline.side_effect = redis.ConnectionError
+        with self.assertRaises(HTTPException) as ctx:
+            await self.auth.create_refresh_token(data={"sub": "user@example.com"})
+        self.assertEqual(ctx.exception.status_code, 503)
+
+    async def test_refresh_token_without_family_is_rejected(self):
+        token = jwt.encode({"sub": "user@example.com", "scope": "refresh_token", "exp": time.time() + 60},
+                           self.auth.SECRET_KEY, algorithm=self.auth.ALGORITHM)
+        with self.assertRaises(HTTPException) as ctx:
+            await self.auth.rotate_refresh_token(token)
+        self.assertEqual(ctx.exception.status_code, 401)
+
+    async def test_scope_is_still_checked(self):
+        token = await self.auth.create_access_token(data={"sub": "user@example.com"})
+        self.auth.decode_token(token)
+        with self.assertRaises(HTTPException) as ctx:
+            await self.auth.rotate_refresh_token(token)
+        self.assertEqual(ctx.exception.status_code, 401)
+
+
+class TestPasswordHashing(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.auth = Auth()
+        self.auth.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=5)
+        self.auth.hash_executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(self.auth.hash_executor.shutdown, wait=True)
+
+    async def test_hash_and_verify_run_off_the_event_loop(self):
+        loop_thread = threading.get_ident()
+        worker_threads = []
+
+        def record(password):
+            worker_threads.append(threading.get_ident())
+            return CryptContext.hash(self.auth.pwd_context, password)
+
+        with patch.object(self.auth.pwd_context, 'hash', side_effect=record):
+            hashed = await self.auth.get_password_hash('secret')
+        self.assertNotIn(loop_thread, worker_threads)
+        self.assertTrue(await self.auth.verify_password('secret', hashed))
+        self.assertFalse(await self.auth.verify_password('wrong', hashed))
+
+    async def test_outdated_cost_needs_update(self):
+        weak = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash('secret')
+        self.assertTrue(self.auth.password_needs_update(weak))
+        self.assertFalse(self.auth.password_needs_update(await self.auth.get_password_hash('secret')))
+
+    async def test_queue_timeout_returns_503(self):
+        release = threading.Event()
+        self.auth.hash_executor.submit(release.wait)
+        try:
+            with patch('src.services.auth.settings.password_hash_timeout', 0.05):
+                with self.assertRaises(HTTPException) as ctx:
+                    await self.auth.get_password_hash('secret')
+            self.assertEqual(ctx.exception.status_code, 503)
+        finally:
+            release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import io
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import redis.asyncio as redis
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+from src.conf.config import Settings
+from src.services.avatar_storage import (AvatarStorage, CloudinaryStorage, LocalStorage, S3Storage,
+                                         create_avatar_storage)
+from src.services.avatars import AvatarPipeline, sniff
+
+
+def encode(size: tuple[int, int], fmt: str = "JPEG", mode: str = "RGB", **params) -> bytes:
+    out = io.BytesIO()
+    Image.new(mode, size, "red").save(out, format=fmt, **params)
+    return out.getvalue()
+
+
+def upload_file(data: bytes) -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), filename="avatar")
+
+
+class TestAvatarPipeline(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.root = Path(folder.name)
+        self.urls = {}
+        self.redis = MagicMock()
+        self.redis.get = AsyncMock(side_effect=lambda key: self.urls.get(key))
+        self.redis.set = AsyncMock(side_effect=lambda key, value, ex: self.urls.__setitem__(key, value.encode()))
+        self.pipeline = AvatarPipeline(LocalStorage(self.root, "/static/avatars/"), self.redis, size=250,
+                                       max_bytes=1024 * 1024, max_pixels=20_000_000, quality=80, workers=1,
+                                       timeout=5, url_ttl=60, chunk_size=1024)
+        self.addCleanup(self.pipeline.executor.shutdown)
+
+    def test_sniff(self):
+        self.assertEqual(sniff(encode((1, 1))[:12]), "JPEG")
+        self.assertEqual(sniff(encode((1, 1), "PNG")[:12]), "PNG")
+        self.assertEqual(sniff(encode((1, 1), "GIF")[:12]), "GIF")
+        self.assertEqual(sniff(encode((1, 1), "WEBP")[:12]), "WEBP")
+        self.assertIsNone(sniff(b"<svg xmlns="))
+
+    def test_resize_crops_to_square_webp(self):
+        for data in (encode((4000, 3000)), encode((300, 900), "PNG", mode="RGBA"), encode((100, 100), "GIF")):
+            with Image.open(io.BytesIO(self.pipeline.resize(data))) as avatar:
+                self.assertEqual(avatar.format, "WEBP")
+                self.assertEqual(avatar.size, (250, 250))
+
+    def test_resize_applies_exif_orientation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        data = encode((400, 200), exif=exif.tobytes())
+        with patch("src.services.avatars.ImageOps.fit", side_effect=lambda image, size, method: image) as fit:
+            self.pipeline.resize(data)
+        self.assertEqual(fit.call_args.args[0].size, (200, 400))
+
+    def test_resize_rejects_bad_images(self):
+        with self.assertRaises(HTTPException) as cm:
+            self.pipeline.resize(encode((5000, 5000), "PNG", mode="L"))
+        self.assertEqual(cm.exception.status_code, 413)
+        with self.assertRaises(HTTPException) as cm:
+            self.pipeline.resize(encode((10, 10))[:200])
+        self.assertEqual(cm.exception.status_code, 415)
+
+    async def test_read_enforces_limits(self):
+        self.assertEqual(await self.pipeline.read(upload_file(encode((10, 10)))), encode((10, 10)))
+        for data, code in ((b"%PDF-1.4" + b"0" * 4096, 415), (b"", 415),
+                           (b"\xff\xd8\xff" + b"0" * 2 * 1024 * 1024, 413)):
+            with self.subTest(code=code, size=len(data)):
+                file = upload_file(data)
+                with self.assertRaises(HTTPException) as cm:
+                    await self.pipeline.read(file)
+                self.assertEqual(cm.exception.status_code, code)
+        self.assertLessEqual(file.file.tell(), 1024 * 1024 + 1024)
+
+    async def test_process_stores_resized_avatar_off_loop(self):
+        threads = []
+        put = self.pipeline.storage.put
+
+        def record(name, data):
+            threads.append(threading.current_thread().name)
+            return put(name, data)
+
+        with patch.object(self.pipeline.storage, "put", side_effect=record):
+            url = await self.pipeline.process(upload_file(encode((1200, 800))))
+        name = self.pipeline.name(encode((1200, 800)))
+        self.assertEqual(url, f"/static/avatars/{name}")
+        self.assertTrue(threads[0].startswith("avatar"))
+        with Image.open(self.root / name) as avatar:
+            self.assertEqual((avatar.format, avatar.size), ("WEBP", (250, 250)))
+        self.assertEqual(self.urls, {f"avatars:local:{name}": url.encode()})
+
+    async def test_same_image_is_stored_once(self):
+        data = encode((600, 600))
+        first = await self.pipeline.process(upload_file(data))
+        with patch.object(self.pipeline, "resize") as resize, patch.object(self.pipeline.storage, "put") as put:
+            self.assertEqual(await self.pipeline.process(upload_file(data)), first)
+        resize.assert_not_called()
+        put.assert_not_called()
+        self.assertNotEqual(await self.pipeline.process(upload_file(encode((600, 601)))), first)
+        self.assertEqual(len(list(self.root.iterdir())), 2)
+
+    async def test_redis_down_still_stores(self):
+        self.redis.get.side_effect = redis.ConnectionError("down")
+        self.redis.set.side_effect = redis.ConnectionError("down")
+        data = encode((300, 300))
+        url = await self.pipeline.process(upload_file(data))
+        self.assertEqual(await self.pipeline.process(upload_file(data)), url)
+        self.assertEqual(len(list(self.root.iterdir())), 1)
+
+    async def test_busy_pipeline_answers_503(self):
+        self.pipeline.timeout = 0.05
+        release = threading.Event()
+        self.pipeline.executor.submit(release.wait)
+        try:
+            with self.assertRaises(HTTPException) as cm:
+                await self.pipeline.process(upload_file(encode((10, 10))))
+        finally:
+            release.set()
+        self.assertEqual(cm.exception.status_code, 503)
+
+
+class ClientError(Exception):
+
+    def __init__(self, code):
+        self.response = {"Error": {"Code": code}}
+
+
+class TestAvatarStorage(unittest.TestCase):
+
+    def test_s3_puts_missing_objects_only(self):
+        client = MagicMock()
+        client.exceptions.ClientError = ClientError
+        client.head_object.side_effect = [ClientError("404"), None]
+        storage = S3Storage("bucket", "avatars", "https://cdn.example.com/", client=client)
+        self.assertEqual(storage.put("abc.webp", b"data"), "https://cdn.example.com/avatars/abc.webp")
+        self.assertEqual(storage.put("abc.webp", b"data"), "https://cdn.example.com/avatars/abc.webp")
+        client.put_object.assert_called_once()
+        self.assertEqual(client.put_object.call_args.kwargs["ContentType"], "image/webp")
+        client.head_object.side_effect = ClientError("403")
+        with self.assertRaises(ClientError):
+            storage.put("abc.webp", b"data")
+
+    def test_cloudinary_keeps_existing_public_id(self):
+        storage = CloudinaryStorage("Web9_FastapiAPP", "demo", 1, "secret")
+        with patch("src.services.avatar_storage.cloudinary.uploader.upload",
+                   return_value={"secure_url": "https://res.cloudinary.com/x.webp"}) as upload:
+            self.assertEqual(storage.put("abc.webp", b"data"), "https://res.cloudinary.com/x.webp")
+        self.assertEqual(upload.call_args.kwargs, {"public_id": "Web9_FastapiAPP/abc", "overwrite": False,
+                                                   "format": "webp"})
+
+    def test_backend_without_put_is_rejected(self):
+        class Incomplete(AvatarStorage):
+            kind = "incomplete"
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_create_from_settings(self):
+        self.assertIsInstance(create_avatar_storage(Settings(avatar_storage="local")), LocalStorage)
+        self.assertIsInstance(create_avatar_storage(Settings(avatar_storage="cloudinary")), CloudinaryStorage)
+        with self.assertRaises(ValueError):
+            create_avatar_storage(Settings(avatar_storage="ftp"))
+
+
+if __name__ == '__main__':
+    unittest.main()
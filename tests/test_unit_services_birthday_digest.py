@@ -0,0 +1,115 @@
+import datetime
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+import redis.asyncio as redis
+
+from src.database.models import Contact
+from src.services.birthday_digest import BirthdayDigest
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio.Redis for the digest: get/set/delete and WATCH-style transactions."""
+
+    def __init__(self):
+        self.store = {}
+
+    def _set(self, key, value, ex=None, nx=False):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value
+        return True
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None, nx=False):
+        return self._set(key, value, ex=ex, nx=nx)
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    async def transaction(self, func, *keys):
+        pipe = MagicMock()
+        pipe.get = AsyncMock(side_effect=self.store.get)
+        pipe.set.side_effect = self._set
+        await func(pipe)
+
+
+def make_contact(contact_id: int, month: int, day: int) -> Contact:
+    now = datetime.datetime(2023, 1, 1)
+    return Contact(id=contact_id, first_name=f'Name{contact_id}', last_name='Johns', email=f'user{contact_id}@meta.ua',
+                   phone=f'+38000000{contact_id:03}', date_of_birth=datetime.date(1990, month, day), user_id=1,
+                   created_at=now, updated_at=now)
+
+
+class TestBirthdayDigest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.redis = FakeRedis()
+        self.digest = BirthdayDigest(self.redis, days=30, size=10, ttl=90000)
+        self.today = datetime.date(2023, 12, 28)
+        # ordered like get_contact_birthday for a window that wraps into January
+        contacts = [make_contact(1, 12, 28), make_contact(2, 12, 30), make_contact(3, 1, 2), make_contact(4, 1, 20)]
+        await self.digest.store(1, self.today, contacts)
+
+    async def ids(self, days=30, skip=0, limit=50):
+        digest = await self.digest.get(1, self.today)
+        return [c["id"] for c in self.digest.select(digest, self.today, days, skip, limit)]
+
+    async def test_select_filters_shorter_windows(self):
+        self.assertEqual(await self.ids(), [1, 2, 3, 4])
+        self.assertEqual(await self.ids(days=7), [1, 2, 3])
+        self.assertEqual(await self.ids(days=0), [1])
+        self.assertEqual(await self.ids(skip=1, limit=2), [2, 3])
+
+    async def test_upsert_inserts_in_order_and_moves(self):
+        await self.digest.upsert(make_contact(5, 12, 31), today=self.today)
+        self.assertEqual(await self.ids(), [1, 2, 5, 3, 4])
+        await self.digest.upsert(make_contact(2, 1, 25), today=self.today)
+        self.assertEqual(await self.ids(), [1, 5, 3, 4, 2])
+        await self.digest.upsert(make_contact(3, 6, 1), today=self.today)
+        self.assertEqual(await self.ids(), [1, 5, 4, 2])
+
+    async def test_discard(self):
+        await self.digest.discard(1, 3, today=self.today)
+        self.assertEqual(await self.ids(), [1, 2, 4])
+
+    async def test_patch_without_digest_is_a_no_op(self):
+        await self.digest.upsert(make_contact(5, 12, 31), today=self.today + datetime.timedelta(days=1))
+        self.assertIsNone(await self.digest.get(1, self.today + datetime.timedelta(days=1)))
+
+    async def test_truncated_digest_falls_back_past_its_end(self):
+        digest = BirthdayDigest(self.redis, days=30, size=2, ttl=90000)
+        data = await digest.store(2, self.today,
+                                  [make_contact(1, 12, 28), make_contact(2, 12, 30), make_contact(3, 1, 2)])
+        self.assertTrue(data["truncated"])
+        self.assertEqual([c["id"] for c in digest.select(data, self.today, 30, 0, 2)], [1, 2])
+        self.assertIsNone(digest.select(data, self.today, 30, 0, 3))
+
+    async def test_truncated_digest_does_not_append_past_its_end(self):
+        digest = BirthdayDigest(self.redis, days=30, size=3, ttl=90000)
+        today = datetime.date(2023, 10, 1)
+        await digest.store(1, today, [make_contact(i, 10, i + 1) for i in range(1, 5)])
+        await digest.discard(1, 2, today=today)
+        await digest.upsert(make_contact(5, 10, 20), today=today)
+        data = await digest.get(1, today)
+        self.assertEqual([e["contact"]["id"] for e in data["entries"]], [1, 3])
+        self.assertIsNone(digest.select(data, today, 30, 0, 3))
+        await digest.upsert(make_contact(2, 10, 3), today=today)
+        data = await digest.get(1, today)
+        self.assertEqual([e["contact"]["id"] for e in data["entries"]], [1, 2, 3])
+
+    async def test_claim_day_once(self):
+        self.assertTrue(await self.digest.claim_day(self.today))
+        self.assertFalse(await self.digest.claim_day(self.today))
+
+    async def test_failed_patch_drops_digest(self):
+        client = AsyncMock()
+        client.transaction.side_effect = redis.ConnectionError
+        await BirthdayDigest(client, days=30, size=10, ttl=90000).discard(1, 3, today=self.today)
+        client.delete.assert_awaited_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import asyncio
+import datetime
+import unittest
+from collections import namedtuple
+from unittest.mock import AsyncMock, patch
+
+from src.services.birthday_reminders import BirthdayReminders
+from src.services.email import BIRTHDAY_REMINDER, render_birthday_reminder
+from src.services.mail_outbox import MailOutbox
+
+Row = namedtuple("Row", "user_id email username first_name last_name date_of_birth")
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio.Redis for the scheduler: hashes, NX locks and pipelines."""
+
+    def __init__(self):
+        self.store = {}
+        self.ttl = {}
+
+    async def hgetall(self, key):
+        return {k.encode(): str(v).encode() for k, v in self.store.get(key, {}).items()}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.store:
+            return None
+        self.store[key], self.ttl[key] = value, ex
+        return True
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    def register_script(self, script):
+        async def release(keys, args, client):
+            if client.store.get(keys[0]) == args[0]:
+                await client.delete(keys[0])
+                return 1
+            return 0
+        return release
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+
+    def hset(self, key, mapping):
+        self.client.store.setdefault(key, {}).update(mapping)
+
+    def expire(self, key, seconds):
+        if key in self.client.store:
+            self.client.ttl[key] = seconds
+
+    async def execute(self):
+        return []
+
+
+class FakeOutbox:
+    """
+    Records queued digests and, like the real outbox, drops a second one under a dedup key that has not
+    expired yet on `clock`.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.queued = {}
+        self.dedup = {}
+
+    async def enqueue(self, kind, recipient, data, dedup_ttl=None, dedup_id=None):
+        key = MailOutbox.dedup_key(kind, recipient, dedup_id)
+        now = self.clock().timestamp()
+        if self.dedup.get(key, 0) > now:
+            return False
+        self.dedup[key] = now + dedup_ttl
+        self.queued[kind, recipient] = data
+        return True
+
+
+def rows_for(user_id: int, count: int) -> list[Row]:
+    return [Row(user_id, f"user{user_id}@example.com", f"User{user_id}", f"Name{i}", "Johns",
+                datetime.date(1990, 1, i + 1)) for i in range(count)]
+
+
+def batches(rows: list[Row], size: int, fail_after: int | None = None):
+    def stream(after_user_id):
+        async def generate():
+            remaining = [row for row in rows if row.user_id > after_user_id]
+            for n, i in enumerate(range(0, len(remaining), size)):
+                if n == fail_after:
+                    raise ConnectionError("database went away")
+                yield remaining[i:i + size]
+        return generate()
+    return stream
+
+
+class TestBirthdayReminders(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.now = datetime.datetime(2023, 12, 28, 9, 0)
+        self.outbox = FakeOutbox(lambda: self.now)
+        self.reminders = BirthdayReminders(self.redis, self.outbox, days=7, hour=8, batch_size=3, lease=300,
+                                           poll_interval=0, clock=lambda: self.now)
+        self.today = self.now.date()
+        self.rows = rows_for(1, 2) + rows_for(2, 5) + rows_for(4, 1)
+
+    async def test_one_digest_per_user_across_batches(self):
+        self.assertEqual(await self.reminders.send(self.today, batches(self.rows, 3)), 3)
+        self.assertEqual(sorted(recipient for _, recipient in self.outbox.queued),
+                         ["user1@example.com", "user2@example.com", "user4@example.com"])
+        digest = self.outbox.queued[BIRTHDAY_REMINDER, "user2@example.com"]
+        self.assertEqual(digest["username"], "User2")
+        self.assertEqual(digest["days"], 7)
+        self.assertEqual([c["first_name"] for c in digest["contacts"]], [f"Name{i}" for i in range(5)])
+        self.assertEqual(digest["contacts"][0]["date_of_birth"], "1990-01-01")
+        self.assertEqual(await self.reminders.checkpoint(self.today), (4, True))
+        self.assertEqual(await self.reminders.send(self.today, batches(self.rows, 3)), 0)
+
+    async def test_crash_resumes_after_checkpoint(self):
+        with self.assertRaises(ConnectionError):
+            await self.reminders.send(self.today, batches(self.rows, 3, fail_after=2))
+        self.assertEqual(await self.reminders.checkpoint(self.today), (1, False))
+        self.assertEqual(list(self.outbox.queued), [(BIRTHDAY_REMINDER, "user1@example.com")])
+
+        seen = []
+        stream = batches(self.rows, 3)
+        self.assertEqual(await self.reminders.send(self.today, lambda after: seen.append(after) or stream(after)), 2)
+        self.assertEqual(seen, [1])
+        self.assertEqual(len(self.outbox.queued), 3)
+        self.assertEqual(len(self.outbox.queued[BIRTHDAY_REMINDER, "user2@example.com"]["contacts"]), 5)
+
+    async def test_late_run_does_not_block_next_day(self):
+        self.now = datetime.datetime(2023, 12, 28, 23, 30)
+        self.assertEqual(await self.reminders.send(self.now.date(), batches(self.rows, 3)), 3)
+        self.outbox.queued.clear()
+        self.now = datetime.datetime(2023, 12, 29, 8, 0)
+        self.assertEqual(await self.reminders.send(self.now.date(), batches(self.rows, 3)), 3)
+        self.assertEqual(len(self.outbox.queued), 3)
+
+    async def test_run_daily_sends_once_when_due(self):
+        async def send(today):
+            return await self.reminders.send(today, batches(self.rows, 3))
+
+        send_day = AsyncMock(side_effect=send)
+        self.reminders.clock = iter([self.now.replace(hour=7), self.now.replace(hour=8), self.now,
+                                     self.now.replace(hour=10)]).__next__
+        sleep = AsyncMock(side_effect=[None, None, None, asyncio.CancelledError])
+        with patch("src.services.birthday_reminders.asyncio.sleep", sleep), self.assertRaises(asyncio.CancelledError):
+            await self.reminders.run_daily(send_day)
+        send_day.assert_awaited_once_with(self.today)
+        self.assertNotIn(self.reminders.lock_key(self.today), self.redis.store)
+
+    async def test_lease_is_held_by_one_worker(self):
+        self.assertTrue(await self.reminders.claim(self.today))
+        self.assertFalse(await self.reminders.claim(self.today))
+        await self.reminders.save(self.today, 1)
+        self.assertEqual(self.redis.ttl[self.reminders.lock_key(self.today)], 300)
+        await self.reminders.release(self.today)
+        self.assertTrue(await self.reminders.claim(self.today))
+
+    async def test_release_keeps_a_lease_taken_over_by_another_worker(self):
+        other = BirthdayReminders(self.redis, self.outbox, days=7, hour=8, batch_size=3, lease=300,
+                                  poll_interval=0, clock=lambda: self.now)
+        self.assertTrue(await self.reminders.claim(self.today))
+        # the lease runs out while this worker is still sending
+        del self.redis.store[self.reminders.lock_key(self.today)]
+        self.assertTrue(await other.claim(self.today))
+        await self.reminders.release(self.today)
+        self.assertFalse(await self.reminders.claim(self.today))
+        await other.release(self.today)
+        self.assertTrue(await self.reminders.claim(self.today))
+
+    async def test_render_birthday_reminder(self):
+        message = await render_birthday_reminder("user@example.com", {
+            "username": "User", "days": 7,
+            "contacts": [{"first_name": "Ann", "last_name": "O'Neil", "date_of_birth": "1990-12-30"}]})
+        self.assertEqual(message["To"], "user@example.com")
+        body = message.get_content()
+        self.assertIn("Greeting User!", body)
+        self.assertIn("Ann O&#39;Neil, 1990-12-30", body)
+
+
+if __name__ == '__main__':
+    unittest.main()
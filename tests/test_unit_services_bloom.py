@@ -0,0 +1,106 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+import redis.asyncio as redis
+
+from src.services.bloom import BloomFilter
+
+
+class FakeBitmapRedis:
+    """Just enough of redis.asyncio.Redis for the filter: bitmaps, flags and non-transactional pipelines."""
+
+    def __init__(self):
+        self.bits = {}
+        self.store = {}
+
+    async def exists(self, key):
+        return int(key in self.store)
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value
+        return True
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakeBitmapPipeline(self)
+
+
+class FakeBitmapPipeline:
+
+    def __init__(self, client: FakeBitmapRedis):
+        self.client = client
+        self.commands = []
+
+    def setbit(self, key, offset, value):
+        self.commands.append(lambda: self.client.bits.setdefault(key, set()).add(offset))
+
+    def getbit(self, key, offset):
+        self.commands.append(lambda: int(offset in self.client.bits.get(key, ())))
+
+    def exists(self, key):
+        self.commands.append(lambda: int(key in self.client.store))
+
+    async def execute(self):
+        return [command() for command in self.commands]
+
+
+async def batches(*batch):
+    for emails in batch:
+        yield emails
+
+
+class TestBloomFilter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = FakeBitmapRedis()
+        self.bloom = BloomFilter(self.redis, "test", capacity=1000, error_rate=0.01)
+
+    def test_sizing(self):
+        self.assertEqual(self.bloom.size, 9586)
+        self.assertEqual(self.bloom.hashes, 7)
+        positions = self.bloom.positions("user@example.com")
+        self.assertEqual(positions, self.bloom.positions("user@example.com"))
+        self.assertTrue(all(0 <= position < self.bloom.size for position in positions))
+
+    async def test_unready_filter_cannot_rule_anything_out(self):
+        self.assertTrue(await self.bloom.might_contain("nobody@example.com"))
+
+    async def test_rebuild_then_add(self):
+        self.assertTrue(await self.bloom.claim_rebuild())
+        self.assertFalse(await self.bloom.claim_rebuild())
+        await self.bloom.rebuild(batches([f"user{i}@example.com" for i in range(100)], ["last@example.com"]))
+        self.assertFalse(await self.bloom.claim_rebuild())
+        self.assertTrue(await self.bloom.might_contain("user42@example.com"))
+        self.assertTrue(await self.bloom.might_contain("last@example.com"))
+        self.assertFalse(await self.bloom.might_contain("new@example.com"))
+        await self.bloom.add("new@example.com")
+        self.assertTrue(await self.bloom.might_contain("new@example.com"))
+        false_positives = sum([await self.bloom.might_contain(f"other{i}@example.com") for i in range(1000)])
+        self.assertLess(false_positives, 20)
+
+    async def test_new_geometry_starts_a_new_filter(self):
+        self.assertTrue(await self.bloom.claim_rebuild())
+        await self.bloom.rebuild(batches([f"user{i}@example.com" for i in range(100)]))
+        bigger = BloomFilter(self.redis, "test", capacity=2000, error_rate=0.01)
+        self.assertNotEqual(bigger.key, self.bloom.key)
+        self.assertTrue(await bigger.might_contain("user42@example.com"))
+        self.assertTrue(await bigger.claim_rebuild())
+        await bigger.rebuild(batches([f"user{i}@example.com" for i in range(100)]))
+        self.assertTrue(await bigger.might_contain("user42@example.com"))
+        self.assertFalse(await bigger.might_contain("new@example.com"))
+
+    async def test_redis_errors(self):
+        client = MagicMock()
+        client.pipeline.return_value.execute = AsyncMock(side_effect=redis.ConnectionError)
+        bloom = BloomFilter(client, "test", capacity=1000, error_rate=0.01)
+        self.assertTrue(await bloom.might_contain("nobody@example.com"))
+        with self.assertRaises(redis.RedisError):
+            await bloom.add("new@example.com")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import asyncio
+import unittest
+from email.message import EmailMessage
+from unittest.mock import AsyncMock, patch
+
+import orjson
+from fastapi_mail import ConnectionConfig
+
+from src.services.email import CONFIRM_EMAIL, mail_outbox, render_confirmation_email, send_email
+from src.services.mail_outbox import MailSender, OutboxEntry
+from src.services.smtp_pool import SMTPPool
+
+
+class SMTPStandIn:
+    """Minimal in-process SMTP server: accepts every message except those to `refuse`d recipients."""
+
+    def __init__(self, refuse=()):
+        self.refuse = set(refuse)
+        self.messages = []
+        self.connections = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 stand-in ESMTP\r\n")
+        recipients = []
+        while line := await reader.readline():
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                writer.write(b"250-stand-in\r\n250 8BITMIME\r\n")
+            elif verb == "MAIL":
+                recipients = []
+                writer.write(b"250 OK\r\n")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip().strip("<>")
+                if address in self.refuse:
+                    writer.write(b"550 No such user\r\n")
+                else:
+                    recipients.append(address)
+                    writer.write(b"250 OK\r\n")
+            elif verb == "DATA":
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                await writer.drain()
+                data = await reader.readuntil(b"\r\n.\r\n")
+                self.messages.append((recipients, data))
+                writer.write(b"250 OK\r\n")
+            elif verb in ("RSET", "NOOP"):
+                writer.write(b"250 OK\r\n")
+            elif verb == "QUIT":
+                writer.write(b"221 Bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"502 Not implemented\r\n")
+            await writer.drain()
+        writer.close()
+
+
+class FakeOutbox:
+    """In-memory stand-in for MailOutbox recording what the sender did with each entry."""
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.acked, self.retried, self.dead = [], [], []
+
+    async def promote_due(self, now):
+        return 0
+
+    async def read(self, consumer, count, block_ms, claim_idle_ms):
+        batch, self.entries = self.entries[:count], self.entries[count:]
+        return batch
+
+    async def ack(self, ids):
+        self.acked.extend(ids)
+
+    async def retry(self, entry, due):
+        self.retried.append((entry.id, due))
+
+    async def dead_letter(self, entry, error):
+        self.dead.append(entry.id)
+
+
+async def render(recipient: str, data: dict) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = "noreply@example.com"
+    message["To"] = recipient
+    message["Subject"] = "Hello"
+    message.set_content(f"Hello {data['username']}")
+    return message
+
+
+def make_entries(count: int, attempts: int = 0, kind: str = "hello") -> list[OutboxEntry]:
+    return [OutboxEntry(id=f"1-{i}", kind=kind, recipient=f"user{i}@example.com", data={"username": f"user{i}"},
+                        attempts=attempts) for i in range(count)]
+
+
+class TestMailSender(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.smtp = SMTPStandIn(refuse={"user1@example.com"})
+        await self.smtp.start()
+        self.config = ConnectionConfig(MAIL_USERNAME="", MAIL_PASSWORD="", MAIL_FROM="noreply@example.com",
+                                       MAIL_PORT=self.smtp.port, MAIL_SERVER="127.0.0.1", MAIL_STARTTLS=False,
+                                       MAIL_SSL_TLS=False, USE_CREDENTIALS=False, VALIDATE_CERTS=False)
+        self.pool = SMTPPool(self.config, size=2, timeout=5)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        await self.smtp.stop()
+
+    def sender(self, outbox, max_attempts=3):
+        return MailSender(outbox, self.pool, renderers={"hello": render}, batch_size=10, max_attempts=max_attempts,
+                          retry_base=5, retry_max=60, claim_idle=300, clock=lambda: 1000.0)
+
+    async def test_batches_reuse_pooled_connections(self):
+        outbox = FakeOutbox(make_entries(25))
+        sender = self.sender(outbox)
+        self.assertEqual(await sender.run_once("test"), 10)
+        self.assertEqual(await sender.run_once("test"), 10)
+        self.assertEqual(await sender.run_once("test"), 5)
+        self.assertEqual(self.smtp.connections, 2)
+        self.assertEqual(self.pool.opened, 2)
+        self.assertEqual(len(self.smtp.messages), 24)
+        self.assertEqual(len(outbox.acked), 24)
+        self.assertEqual(outbox.retried, [("1-1", 1005.0)])
+
+    async def test_failures_back_off_then_dead_letter(self):
+        self.assertEqual([self.sender(FakeOutbox([])).backoff(n) for n in range(6)], [5, 10, 20, 40, 60, 60])
+        outbox = FakeOutbox(make_entries(2, attempts=2) + make_entries(1, kind="unknown"))
+        await self.sender(outbox).run_once("test")
+        self.assertEqual(outbox.acked, ["1-0"])
+        self.assertEqual(outbox.dead, ["1-0", "1-1"])
+        self.assertEqual(outbox.retried, [])
+
+    async def test_smtp_down_retries_whole_batch(self):
+        await self.smtp.stop()
+        outbox = FakeOutbox(make_entries(3))
+        await self.sender(outbox).run_once("test")
+        self.assertEqual(outbox.acked, [])
+        self.assertEqual(sorted(entry_id for entry_id, _ in outbox.retried), ["1-0", "1-1", "1-2"])
+
+    async def test_dropped_idle_connection_is_reopened(self):
+        outbox = FakeOutbox(make_entries(1) + make_entries(1))
+        sender = self.sender(outbox)
+        sender.batch_size = 1
+        await sender.run_once("test")
+        for smtp in self.pool._idle:
+            smtp.close()
+        await sender.run_once("test")
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(self.pool.opened, 2)
+
+
+class TestConfirmationEmail(unittest.IsolatedAsyncioTestCase):
+
+    async def test_send_email_queues_once(self):
+        with patch.object(mail_outbox, '_enqueue', AsyncMock(side_effect=[b"1-0", None])) as enqueue:
+            self.assertTrue(await send_email("user@example.com", "User", "http://testserver/"))
+            self.assertFalse(await send_email("User@example.com", "User", "http://testserver/"))
+        keys, args = enqueue.call_args_list[0].kwargs["keys"], enqueue.call_args_list[0].kwargs["args"]
+        self.assertEqual(keys, [mail_outbox.stream, mail_outbox.dedup_key(CONFIRM_EMAIL, "user@example.com")])
+        self.assertEqual(orjson.loads(args[4]), {"username": "User", "host": "http://testserver/"})
+        self.assertEqual(enqueue.call_args_list[1].kwargs["keys"][1], keys[1])
+
+    async def test_render_confirmation_email(self):
+        message = await render_confirmation_email("user@example.com", {"username": "User",
+                                                                       "host": "http://testserver/"})
+        self.assertEqual(message["To"], "user@example.com")
+        body = message.get_content()
+        self.assertIn("Greeting User!", body)
+        self.assertIn("http://testserver/api/auth/confirmed_email/", body)
+
+    def test_entry_from_stream(self):
+        entry = OutboxEntry.from_stream(b"1-0", {b"kind": b"confirm_email", b"recipient": b"user@example.com",
+                                                 b"data": b'{"username":"User"}', b"attempts": b"2"})
+        self.assertEqual(entry, OutboxEntry("1-0", "confirm_email", "user@example.com", {"username": "User"}, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
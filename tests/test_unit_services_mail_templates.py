@@ -0,0 +1,56 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from src.services.email import mail_templates
+from src.services.mail_templates import TemplateRegistry
+
+
+class TestTemplateRegistry(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+        (self.folder / "hello.html").write_text("<p>{{ greeting }} {{ name }} ({{ locale }})</p><a href=\"{{ link }}\">")
+        (self.folder / "hello.uk.html").write_text("<p>Привіт {{ name }}</p>")
+        (self.folder / "list.html").write_text("{% for item in items %}<li>{{ item }}</li>{% endfor %}{{ name|upper }}")
+        self.registry = TemplateRegistry(self.folder, {"en": {"greeting": "Hello"}, "uk": {}}, default_locale="en")
+
+    def test_static_parts_per_locale(self):
+        self.registry.load()
+        english = self.registry.get("hello.html", "en")
+        self.assertTrue(english.static_parts)
+        self.assertEqual(english.names, ["name", "link"])
+        self.assertEqual(english.parts[0], "<p>Hello ")
+        self.assertEqual(self.registry.render("hello.html", "en", name="<Bob>", link="https://x/?a=1&b=2"),
+                         '<p>Hello &lt;Bob&gt; (en)</p><a href="https://x/?a=1&amp;b=2">')
+        self.assertEqual(self.registry.render("hello.html", "uk", name="Bob"), "<p>Привіт Bob</p>")
+        self.assertEqual(self.registry.render("hello.html", "fr", name="Bob", link=""),
+                         '<p>Hello Bob (en)</p><a href="">')
+
+    def test_matches_plain_jinja_render(self):
+        context = {"name": "<b>O'Neil</b>", "link": None}
+        self.assertEqual(self.registry.render("hello.html", "en", **context),
+                         self.registry.env.get_template("hello.html").render(greeting="Hello", locale="en", **context))
+
+    def test_control_flow_and_filters_use_compiled_template(self):
+        compiled = self.registry.get("list.html")
+        self.assertFalse(compiled.static_parts)
+        self.assertEqual(compiled.render(items=["a", "<b>"], name="bob"), "<li>a</li><li>&lt;b&gt;</li>BOB")
+
+    def test_templates_are_compiled_once(self):
+        self.registry.load()
+        compiled = self.registry.get("hello.html", "en")
+        (self.folder / "hello.html").write_text("changed {{ name }}")
+        self.assertIs(self.registry.get("hello.html", "en"), compiled)
+        self.assertTrue(self.registry.render("hello.html", "en", name="Bob", link="").startswith("<p>Hello Bob"))
+
+    def test_app_templates(self):
+        mail_templates.load()
+        self.assertTrue(mail_templates.get("email_template.html").static_parts)
+        self.assertFalse(mail_templates.get("birthday_reminder.html").static_parts)
+
+
+if __name__ == '__main__':
+    unittest.main()
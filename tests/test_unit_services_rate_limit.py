@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import redis
+from fastapi import HTTPException
+
+from src.services.rate_limit import Decision, RateLimiter, gcra, rate_limit_store
+
+
+class TestGcra(unittest.TestCase):
+
+    def test_burst_then_steady_rate(self):
+        interval, limit, now, tat = 6000, 10, 1_000_000, None
+        for remaining in range(9, -1, -1):
+            decision, tat = gcra(tat, now, interval, limit)
+            self.assertTrue(decision.allowed)
+            self.assertEqual(decision.remaining, remaining)
+        decision, new_tat = gcra(tat, now, interval, limit)
+        self.assertFalse(decision.allowed)
+        self.assertIsNone(new_tat)
+        self.assertEqual(decision.retry_after, interval)
+        self.assertEqual(decision.reset, limit * interval)
+        decision, _ = gcra(tat, now + interval, interval, limit)
+        self.assertTrue(decision.allowed)
+        self.assertEqual(decision.remaining, 0)
+
+    def test_idle_key_starts_full(self):
+        decision, _ = gcra(1_000, 1_000_000, 6000, 10)
+        self.assertEqual(decision.remaining, 9)
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.request = MagicMock()
+        self.request.scope = {"endpoint": TestRateLimiter}
+        self.request.state = MagicMock()
+        self.user = MagicMock(id=7)
+        self.hit = patch.object(rate_limit_store, 'hit').start()
+        self.addCleanup(patch.stopall)
+
+    async def test_sets_headers_and_keys_per_user_and_route(self):
+        self.hit.return_value = Decision(True, 4, 0, 12000)
+        limiter = RateLimiter(times=5, seconds=60)
+        await limiter(self.request, self.user)
+        headers = self.request.state.rate_limit_headers
+        key = self.hit.call_args[0][0]
+        self.assertTrue(key.endswith(f"{__name__}.TestRateLimiter:7"))
+        self.assertEqual(headers["RateLimit-Remaining"], "4")
+        self.assertEqual(headers["RateLimit-Reset"], "12")
+        self.assertEqual(headers["RateLimit-Policy"], "5;w=60")
+
+    async def test_local_precheck_rejects_without_redis(self):
+        self.hit.return_value = Decision(True, 0, 0, 60000)
+        limiter = RateLimiter(times=2, seconds=60)
+        for _ in range(2):
+            await limiter(self.request, self.user)
+        with self.assertRaises(HTTPException) as ctx:
+            await limiter(self.request, self.user)
+        self.assertEqual(ctx.exception.status_code, 429)
+        self.assertEqual(self.hit.call_count, 2)
+
+    async def test_global_rejection_is_not_counted_locally(self):
+        limiter = RateLimiter(times=1, seconds=60)
+        self.hit.return_value = Decision(False, 0, 30000, 60000)
+        with self.assertRaises(HTTPException) as ctx:
+            await limiter(self.request, self.user)
+        self.assertEqual(ctx.exception.headers["Retry-After"], "30")
+        self.hit.return_value = Decision(True, 0, 0, 60000)
+        await limiter(self.request, self.user)
+
+    async def test_fails_open_without_redis(self):
+        self.hit.side_effect = redis.ConnectionError
+        limiter = RateLimiter(times=5, seconds=60)
+        await limiter(self.request, self.user)
+
+
+if __name__ == '__main__':
+    unittest.main()
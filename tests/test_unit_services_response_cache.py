@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import AsyncMock
+
+import redis.asyncio as redis
+from starlette.requests import Request
+
+from src.services.response_cache import ResponseCache, etag_matches, make_etag
+
+
+def make_request(query: str) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/api/contacts/", "query_string": query.encode(),
+                    "headers": []})
+
+
+class TestResponseCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = AsyncMock()
+        self.cache = ResponseCache(self.redis, ttl=300)
+
+    def test_etag_matches(self):
+        etag = make_etag(b'[]')
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches(etag, f'"other", W/{etag}'))
+        self.assertTrue(etag_matches(etag, '*'))
+        self.assertFalse(etag_matches(etag, '"other"'))
+        self.assertFalse(etag_matches(etag, None))
+
+    def test_key_ignores_query_order_and_includes_version(self):
+        first = self.cache.key(1, 0, make_request("limit=5&sort_by=email"))
+        self.assertEqual(first, self.cache.key(1, 0, make_request("sort_by=email&limit=5")))
+        self.assertNotEqual(first, self.cache.key(1, 1, make_request("limit=5&sort_by=email")))
+        self.assertNotEqual(first, self.cache.key(2, 0, make_request("limit=5&sort_by=email")))
+
+    async def test_version(self):
+        self.redis.get.return_value = None
+        self.assertEqual(await self.cache.version(1), 0)
+        self.redis.get.return_value = b'3'
+        self.assertEqual(await self.cache.version(1), 3)
+        await self.cache.bump(1)
+        self.redis.incr.assert_awaited_once_with('contacts:v1:1:version')
+
+    async def test_redis_errors_bypass_cache(self):
+        self.redis.get.side_effect = redis.ConnectionError
+        self.redis.incr.side_effect = redis.ConnectionError
+        self.assertIsNone(await self.cache.version(1))
+        await self.cache.bump(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
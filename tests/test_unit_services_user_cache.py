@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import redis.asyncio as redis
+
+from src.database.models import User
+from src.services.user_cache import MISSING, LRUCache, UserCache, UserSnapshot
+
+
+class TestUserCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = AsyncMock()
+        self.cache = UserCache(self.redis, ttl=900)
+        self.user = User(
+            id=1,
+            username='User1',
+            email='User1@gmail.com',
+            password='qwerty',
+            created_at=datetime.datetime(2023, 4, 1, 12, 30),
+            confirmed=True,
+        )
+
+    def test_snapshot_round_trip(self):
+        snapshot = UserSnapshot.from_user(self.user)
+        self.assertEqual(UserSnapshot.loads(snapshot.dumps()), snapshot)
+        self.assertNotIn(b'qwerty', snapshot.dumps())
+        self.assertFalse(hasattr(snapshot, '__dict__'))
+
+    async def test_set_and_get(self):
+        snapshot = await self.cache.set(self.user)
+        key, data = self.redis.set.call_args[0]
+        self.assertEqual(key, 'user:v1:user1@gmail.com')
+        self.assertEqual(self.redis.set.call_args[1], {'ex': 900})
+        self.redis.get.return_value = data
+        self.assertEqual(await self.cache.get('user1@gmail.com'), snapshot)
+
+    async def test_get_miss_and_corrupt_entry(self):
+        self.redis.get.return_value = None
+        self.assertIsNone(await self.cache.get(self.user.email))
+        self.redis.get.return_value = b'not a snapshot'
+        self.assertIsNone(await self.cache.get(self.user.email))
+
+    async def test_redis_errors_are_cache_misses(self):
+        self.redis.get.side_effect = redis.ConnectionError
+        self.redis.set.side_effect = redis.ConnectionError
+        self.assertIsNone(await self.cache.get(self.user.email))
+        self.assertEqual(await self.cache.set(self.user), UserSnapshot.from_user(self.user))
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.evictions), (2, 1, 1))
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.now = 10.0
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestTwoTierUserCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = AsyncMock()
+        self.cache = UserCache(self.redis, ttl=900, local_size=10, local_ttl=30, negative_ttl=60)
+        self.user = User(id=1, username='User1', email='user1@gmail.com', confirmed=False)
+
+    async def test_local_tier_skips_redis(self):
+        await self.cache.set(self.user)
+        self.assertEqual(await self.cache.get(self.user.email), UserSnapshot.from_user(self.user))
+        self.redis.get.assert_not_called()
+        self.assertEqual(self.cache.stats()['local_hits'], 1)
+
+    async def test_redis_hit_fills_local_tier(self):
+        self.redis.get.return_value = UserSnapshot.from_user(self.user).dumps()
+        await self.cache.get(self.user.email)
+        await self.cache.get(self.user.email)
+        self.redis.get.assert_called_once()
+        self.assertEqual(self.cache.stats()['redis_hits'], 1)
+
+    async def test_writes_are_published_and_other_workers_drop_local_copy(self):
+        other = UserCache(AsyncMock(), ttl=900, local_size=10, local_ttl=30)
+        other.local.set(other.key(self.user.email), UserSnapshot.from_user(self.user))
+        await self.cache.set(self.user)
+        channel, message = self.redis.publish.call_args[0]
+        self.assertEqual(channel, other.channel)
+        other._on_message({'type': 'message', 'data': message.encode()})
+        self.assertEqual(len(other.local), 0)
+
+    async def test_own_messages_are_ignored(self):
+        await self.cache.set(self.user)
+        self.cache._on_message({'type': 'message', 'data': self.redis.publish.call_args[0][1]})
+        self.assertEqual(len(self.cache.local), 1)
+
+    async def test_invalidate_clears_both_tiers(self):
+        await self.cache.set(self.user)
+        await self.cache.invalidate(self.user.email)
+        self.redis.delete.assert_called_once_with(self.cache.key(self.user.email))
+        self.assertEqual(len(self.cache.local), 0)
+
+    async def test_missing_email(self):
+        self.redis.get.return_value = None
+        self.assertFalse(await self.cache.is_missing(self.user.email))
+        await self.cache.set_missing(self.user.email)
+        self.redis.set.assert_awaited_once_with(self.cache.key(self.user.email), MISSING, ex=60, nx=True)
+        self.assertTrue(await self.cache.is_missing(self.user.email))
+        self.assertIsNone(await self.cache.get(self.user.email))
+        self.assertEqual(self.cache.stats()['negative_hits'], 2)
+        await self.cache.set(self.user)
+        self.assertFalse(await self.cache.is_missing(self.user.email))
+
+    async def test_missing_marker_in_redis_fills_local_tier(self):
+        self.redis.get.return_value = MISSING
+        self.assertIsNone(await self.cache.get(self.user.email))
+        self.assertTrue(await self.cache.is_missing(self.user.email))
+        self.redis.get.assert_awaited_once()
+
+    async def test_listener_drops_local_tier_and_retries_after_disconnect(self):
+        pubsub = MagicMock()
+        pubsub.subscribe = AsyncMock(side_effect=[redis.ConnectionError, asyncio.CancelledError])
+        pubsub.reset = AsyncMock()
+        self.redis.pubsub = MagicMock(return_value=pubsub)
+        self.cache.retry_delay = 0
+        await self.cache.set(self.user)
+        with self.assertRaises(asyncio.CancelledError):
+            await self.cache._listen()
+        self.assertEqual(len(self.cache.local), 0)
+        self.assertEqual(pubsub.subscribe.await_count, 2)
+        self.assertEqual(pubsub.reset.await_count, 2)
+
+    async def test_listener_survives_idle_channel(self):
+        pubsub = MagicMock()
+        pubsub.subscribe = AsyncMock()
+        pubsub.reset = AsyncMock()
+        pubsub.get_message = AsyncMock(side_effect=[None, None, redis.TimeoutError, None,
+                                                    {'type': 'message', 'data': b'other-node user:v1:x'},
+                                                    asyncio.CancelledError])
+        self.redis.pubsub = MagicMock(return_value=pubsub)
+        await self.cache.set(self.user)
+        with patch('src.services.user_cache.asyncio.sleep', AsyncMock()) as sleep, \
+                self.assertRaises(asyncio.CancelledError):
+            await self.cache._listen()
+        sleep.assert_not_awaited()
+        self.assertEqual(len(self.cache.local), 1)
+        self.assertEqual(pubsub.subscribe.await_count, 2)
+        pubsub.get_message.assert_awaited_with(ignore_subscribe_messages=True, timeout=self.cache.poll_timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()